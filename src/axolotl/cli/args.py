@@ -19,6 +19,18 @@ class PreprocessCliArgs:
             "help": "Use IterableDataset for streaming processing of large datasets"
         },
     )
+    shard_index: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": "Index of the slice of every dataset to tokenize, used with --num-shards"
+        },
+    )
+    num_shards: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": "Split tokenization into this many slices, e.g. one per node. Run once more without it to merge the slices"
+        },
+    )
 
 
 @dataclass
@@ -22,6 +22,7 @@ from axolotl.cli.utils import (
     fetch_from_github,
     filter_none_kwargs,
 )
+from axolotl.integrations.kd.cli import kd_generate
 from axolotl.integrations.lm_eval.cli import lm_eval
 from axolotl.utils import set_pytorch_cuda_alloc_conf
 from axolotl.utils.config.models.input.v0_4_1 import AxolotlInputConfig
@@ -316,6 +317,7 @@ def fetch(directory: str, dest: Optional[str]) -> None:
 
 
 cli.add_command(lm_eval)
+cli.add_command(kd_generate)
 
 
 def main():
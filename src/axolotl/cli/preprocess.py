@@ -18,7 +18,9 @@ from axolotl.cli.checks import check_accelerate_default_config, check_user_token
 from axolotl.cli.config import load_cfg
 from axolotl.common.const import DEFAULT_DATASET_PREPARED_PATH
 from axolotl.common.datasets import load_datasets, load_preference_datasets
+from axolotl.utils.data.pieces import tokenize_dataset_slices
 from axolotl.utils.dict import DictDefault
+from axolotl.utils.models import load_processor, load_tokenizer
 from axolotl.utils.trainer import disable_datasets_caching
 
 LOG = logging.getLogger(__name__)
@@ -46,6 +48,10 @@ def do_preprocess(cfg: DictDefault, cli_args: PreprocessCliArgs) -> None:
         LOG.warning(msg)
         cfg.dataset_prepared_path = DEFAULT_DATASET_PREPARED_PATH
 
+    if cli_args.num_shards:
+        do_preprocess_shard(cfg, cli_args)
+        return
+
     with disable_datasets_caching():
         if cfg.rl:
             load_preference_datasets(cfg=cfg, cli_args=cli_args)
@@ -75,6 +81,41 @@ def do_preprocess(cfg: DictDefault, cli_args: PreprocessCliArgs) -> None:
     )
 
 
+def do_preprocess_shard(cfg: DictDefault, cli_args: PreprocessCliArgs) -> None:
+    """
+    Tokenizes one slice of every dataset specified in axolotl config, e.g. on one of
+    several nodes sharing `dataset_prepared_path`. Running `axolotl preprocess`
+    without `--num-shards` after all slices are written merges them.
+
+    Args:
+        cfg: Dictionary mapping `axolotl` config keys to values.
+        cli_args: Preprocessing-specific CLI arguments.
+    """
+    if cfg.rl:
+        raise ValueError("--num-shards is not supported for preference datasets")
+    shard_index, num_shards = cli_args.shard_index, cli_args.num_shards
+    if num_shards is None or shard_index is None or not 0 <= shard_index < num_shards:
+        raise ValueError("--shard-index must be set between 0 and --num-shards - 1")
+
+    tokenizer = load_tokenizer(cfg)
+    processor = load_processor(cfg, tokenizer=tokenizer) if cfg.processor_type else None
+    with disable_datasets_caching():
+        tokenize_dataset_slices(
+            tokenizer,
+            cfg,
+            shard_index,
+            num_shards,
+            processor=processor,
+        )
+
+    LOG.info(
+        Fore.GREEN
+        + f"Success! Preprocessed shard {shard_index} of {num_shards}. "
+        + "Run `axolotl preprocess` without `--num-shards` once all shards are done to merge them."
+        + Fore.RESET
+    )
+
+
 def do_cli(
     config: Union[Path, str] = Path("examples/"),
     **kwargs,
@@ -26,7 +26,7 @@ import math
 import sys
 from abc import abstractmethod
 from pathlib import Path
-from typing import List, Type, Union
+from typing import Any, Dict, List, Type, Union
 
 import torch
 import transformers
@@ -85,8 +85,10 @@ from axolotl.utils.collators import (
     V2BatchSamplerDataCollatorForSeq2Seq,
 )
 from axolotl.utils.collators.mm_chat import MultiModalChatDataCollator
+from axolotl.utils.compact_schema import CompactSchemaCollator, is_compact
 from axolotl.utils.config.models.input.v0_4_1 import CustomSupportedOptimizers
 from axolotl.utils.models import ensure_dtype
+from axolotl.utils.samplers import get_sample_ratios
 
 try:
     import torch._dynamo  # pylint: disable=ungrouped-imports
@@ -96,6 +98,11 @@ except ImportError:
 LOG = logging.getLogger(__name__)
 
 
+def get_trainer_seed(cfg) -> int:
+    """the seed of the trainer built for `cfg`, the transformers default if unset"""
+    return cfg.seed if cfg.seed else AxolotlTrainingArguments.seed
+
+
 class TrainerBuilderBase(abc.ABC):
     """Base class for trainer builder."""
 
@@ -231,6 +238,11 @@ class HFCausalTrainerBuilder(TrainerBuilderBase):
     using TRL.
     """
 
+    def __init__(self, cfg, model, tokenizer, processor=None):
+        super().__init__(cfg, model, tokenizer, processor)
+        # KD targets of the train and eval datasets, from `axolotl kd-generate`
+        self.teacher_logprobs: Dict[str, Any] = {}
+
     def get_callbacks(self):
         callbacks = super().get_callbacks()
         callbacks.append(GPUStatsCallback(self.cfg))
@@ -312,7 +324,28 @@ class HFCausalTrainerBuilder(TrainerBuilderBase):
             return AxolotlPRMTrainer
         return AxolotlTrainer
 
+    def _join_teacher_logprobs(self):
+        self.teacher_logprobs = {}
+        if not (self.cfg.kd_trainer and self.cfg.kd_teacher_model):
+            return
+
+        from axolotl.integrations.kd.generate import (
+            get_teacher_logprobs_path,
+            join_teacher_logprobs,
+        )
+
+        path = get_teacher_logprobs_path(self.cfg)
+        self.train_dataset, self.teacher_logprobs["train"] = join_teacher_logprobs(
+            self.train_dataset, path
+        )
+        if self.eval_dataset:
+            self.eval_dataset, self.teacher_logprobs["eval"] = join_teacher_logprobs(
+                self.eval_dataset, path
+            )
+
     def build(self, total_num_steps):
+        self._join_teacher_logprobs()
+
         warmup_steps = None
         if self.cfg.warmup_steps is not None:
             warmup_steps = self.cfg.warmup_steps
@@ -347,8 +380,7 @@ class HFCausalTrainerBuilder(TrainerBuilderBase):
         training_arguments_kwargs["warmup_steps"] = warmup_steps
         training_arguments_kwargs["logging_steps"] = logging_steps
 
-        if self.cfg.seed:
-            training_arguments_kwargs["seed"] = self.cfg.seed
+        training_arguments_kwargs["seed"] = get_trainer_seed(self.cfg)
 
         if self.cfg.gradient_checkpointing:
             training_arguments_kwargs[
@@ -532,6 +564,9 @@ class HFCausalTrainerBuilder(TrainerBuilderBase):
         )
         training_arguments_kwargs["group_by_length"] = self.cfg.group_by_length
         training_arguments_kwargs["curriculum_sampling"] = self.cfg.curriculum_sampling
+        training_arguments_kwargs["dataset_sample_ratios"] = get_sample_ratios(
+            self.cfg.datasets
+        )
         report_to = []
         if self.cfg.use_wandb:
             report_to.append("wandb")
@@ -587,6 +622,30 @@ class HFCausalTrainerBuilder(TrainerBuilderBase):
             training_arguments_kwargs[
                 "sample_packing_group_size"
             ] = self.cfg.sample_packing_group_size
+        if self.cfg.sample_packing_algorithm is not None:
+            training_arguments_kwargs[
+                "sample_packing_algorithm"
+            ] = self.cfg.sample_packing_algorithm
+        if self.cfg.sample_packing_balance_cost:
+            training_arguments_kwargs["sample_packing_balance_cost"] = True
+            if self.cfg.sample_packing_cost_linear is not None:
+                training_arguments_kwargs[
+                    "sample_packing_cost_linear"
+                ] = self.cfg.sample_packing_cost_linear
+            if self.cfg.sample_packing_cost_quadratic is not None:
+                training_arguments_kwargs[
+                    "sample_packing_cost_quadratic"
+                ] = self.cfg.sample_packing_cost_quadratic
+        training_arguments_kwargs["sample_packing_balance_ranks"] = bool(
+            self.cfg.sample_packing_balance_ranks
+        )
+        training_arguments_kwargs["sample_packing_plan_cache"] = bool(
+            self.cfg.sample_packing_plan_cache
+        )
+        if self.cfg.sample_packing_mp_start_method is not None:
+            training_arguments_kwargs[
+                "sample_packing_mp_start_method"
+            ] = self.cfg.sample_packing_mp_start_method
         if self.cfg.sample_packing_eff_est:
             training_arguments_kwargs[
                 "sample_packing_efficiency"
@@ -763,6 +822,10 @@ class HFCausalTrainerBuilder(TrainerBuilderBase):
             training_arguments_kwargs[
                 "kd_top_k_before_softmax"
             ] = self.cfg.kd_top_k_before_softmax
+        if self.cfg.kd_loss_chunk_size is not None:
+            training_arguments_kwargs[
+                "kd_loss_chunk_size"
+            ] = self.cfg.kd_loss_chunk_size
 
         if self.cfg.reward_model:
             training_args_cls = AxolotlRewardConfig
@@ -906,15 +969,22 @@ class HFCausalTrainerBuilder(TrainerBuilderBase):
                     collator = KDBatchSamplerDataCollatorForSeq2Seq
                 else:
                     collator = DataCollatorForKD
+                if teacher_logprobs := self.teacher_logprobs.get(
+                    "eval" if is_eval else "train"
+                ):
+                    kwargs["teacher_logprobs"] = teacher_logprobs
             else:
                 collator = DataCollatorForSeq2Seq
 
         kwargs["return_tensors"] = "pt"
 
-        return collator(
+        data_collator = collator(
             *collator_args,
             **kwargs,
         )
+        if is_compact(self.eval_dataset if is_eval else self.train_dataset):
+            return CompactSchemaCollator(data_collator)
+        return data_collator
 
 
 class HFRLTrainerBuilder(TrainerBuilderBase):
@@ -16,16 +16,29 @@ from datasets import Dataset
 from peft.optimizers import create_loraplus_optimizer
 from torch import nn
 from torch.optim.lr_scheduler import OneCycleLR
-from torch.utils.data import BatchSampler, DataLoader, RandomSampler, SequentialSampler
+from torch.utils.data import (
+    BatchSampler,
+    DataLoader,
+    RandomSampler,
+    Sampler,
+    SequentialSampler,
+)
 from transformers import Trainer
 from transformers.trainer_utils import PREFIX_CHECKPOINT_DIR, seed_worker
 from transformers.utils import is_sagemaker_mp_enabled
 from trl import CPOTrainer, KTOTrainer, ORPOTrainer, PRMTrainer, RewardTrainer
 from trl.trainer.utils import pad_to_length
 
+from axolotl.datasets import SOURCE_COLUMN
 from axolotl.integrations.base import BaseOptimizerFactory
 from axolotl.monkeypatch.relora import ReLoRAScheduler
-from axolotl.utils.samplers import MultipackBatchSampler, get_dataset_lengths
+from axolotl.utils.samplers import (
+    MultipackBatchSampler,
+    PackingCostModel,
+    get_dataset_cache_dir,
+    get_dataset_lengths,
+    get_mixture_sampler,
+)
 from axolotl.utils.schedulers import (
     RexLR,
     get_cosine_schedule_with_min_lr,
@@ -39,6 +52,13 @@ if is_sagemaker_mp_enabled():
 LOG = logging.getLogger("axolotl.core.trainer_builder")
 
 
+def _without_source_column(dataset):
+    # the dataset every row comes from is only read by the mixture sampler
+    if isinstance(dataset, Dataset) and SOURCE_COLUMN in dataset.column_names:
+        return dataset.remove_columns(SOURCE_COLUMN)
+    return dataset
+
+
 def _sanitize_kwargs_for_tagging(tag_names, kwargs=None):
     if isinstance(tag_names, str):
         tag_names = [tag_names]
@@ -394,7 +414,36 @@ class AxolotlTrainer(SchedulerMixin, OptimizerMixin, Trainer):
             )
         return super()._wrap_model(model, training=training, dataloader=dataloader)
 
+    def _multipack_kwargs(self, dataset: Dataset) -> dict:
+        kwargs = {
+            "group_size": self.args.sample_packing_group_size,
+            "bin_size": self.args.sample_packing_bin_size,
+            "mp_start_method": self.args.sample_packing_mp_start_method,
+            "packing_algorithm": self.args.sample_packing_algorithm,
+        }
+        if self.args.sample_packing_balance_cost:
+            kwargs["cost_model"] = PackingCostModel.from_terms(
+                linear=self.args.sample_packing_cost_linear,
+                quadratic=self.args.sample_packing_cost_quadratic,
+            )
+            kwargs["num_ranks"] = self.args.world_size
+        if self.args.sample_packing_balance_ranks:
+            kwargs["num_ranks"] = self.args.world_size
+            kwargs["balance_ranks"] = True
+            # every rank lays out the full plan, so they have to agree on it
+            kwargs["seed"] = self.args.seed
+        if self.args.sample_packing_plan_cache:
+            kwargs["seed"] = self.args.seed
+            kwargs["plan_cache_dir"] = get_dataset_cache_dir(dataset)
+            kwargs["fingerprint"] = getattr(dataset, "_fingerprint", None)
+        return kwargs
+
     def _get_train_sampler(self) -> Optional[torch.utils.data.Sampler]:
+        mixture_sampler = get_mixture_sampler(
+            self.train_dataset,
+            self.args.dataset_sample_ratios,
+            shuffle=not self.args.curriculum_sampling,
+        )
         if self.args.sample_packing and not self.args.pretraining:
             if self.args.multipack_real_batches:
                 batch_size = self.args.per_device_train_batch_size
@@ -406,7 +455,10 @@ class AxolotlTrainer(SchedulerMixin, OptimizerMixin, Trainer):
                 )
                 batch_max_len = train_batch_size * self.args.max_seq_length
 
-            if self.args.curriculum_sampling:
+            sampler: Sampler
+            if mixture_sampler is not None:
+                sampler = mixture_sampler
+            elif self.args.curriculum_sampling:
                 sampler = SequentialSampler(self.train_dataset)
             else:
                 sampler = RandomSampler(self.train_dataset)
@@ -417,10 +469,11 @@ class AxolotlTrainer(SchedulerMixin, OptimizerMixin, Trainer):
                 packing_efficiency_estimate=self.args.sample_packing_efficiency,
                 batch_max_len=batch_max_len,
                 batch_size=batch_size,
-                group_size=self.args.sample_packing_group_size,
-                bin_size=self.args.sample_packing_bin_size,
                 drop_last=True,
+                **self._multipack_kwargs(self.train_dataset),
             )
+        if mixture_sampler is not None:
+            return mixture_sampler
         if self.args.curriculum_sampling:
             return SequentialSampler(self.train_dataset)
         return super()._get_train_sampler()
@@ -443,9 +496,8 @@ class AxolotlTrainer(SchedulerMixin, OptimizerMixin, Trainer):
                 packing_efficiency_estimate=self.args.sample_packing_efficiency,
                 batch_max_len=batch_max_len,
                 batch_size=batch_size,
-                group_size=self.args.sample_packing_group_size,
-                bin_size=self.args.sample_packing_bin_size,
                 drop_last=True,
+                **self._multipack_kwargs(eval_dataset),
             )
         return super()._get_eval_sampler(eval_dataset)
 
@@ -454,6 +506,7 @@ class AxolotlTrainer(SchedulerMixin, OptimizerMixin, Trainer):
             train_dataset = self.train_dataset
             if "length" in train_dataset.features.keys():
                 train_dataset = train_dataset.remove_columns(["length"])
+            train_dataset = _without_source_column(train_dataset)
             data_collator = self.data_collator
             dataloader_params = {
                 "batch_size": self._train_batch_size,
@@ -500,7 +553,9 @@ class AxolotlTrainer(SchedulerMixin, OptimizerMixin, Trainer):
             )
 
             eval_sampler = self._get_eval_sampler(eval_dataset)
-            eval_dataset = eval_dataset.remove_columns(["length"])
+            eval_dataset = _without_source_column(
+                eval_dataset.remove_columns(["length"])
+            )
             data_collator = self.data_collator
             dataloader_params = {
                 "batch_size": self.args.eval_batch_size,
@@ -527,6 +582,13 @@ class AxolotlTrainer(SchedulerMixin, OptimizerMixin, Trainer):
 
         return super().get_eval_dataloader(eval_dataset)
 
+    def _remove_unused_columns(
+        self, dataset: Dataset, description: Optional[str] = None
+    ):
+        return super()._remove_unused_columns(
+            _without_source_column(dataset), description
+        )
+
     def _get_bench_sampler(
         self, bench_dataset: Dataset
     ) -> Optional[torch.utils.data.Sampler]:
@@ -2,7 +2,7 @@
 extra axolotl specific training args
 """
 from dataclasses import dataclass, field
-from typing import Optional
+from typing import List, Optional
 
 from transformers import TrainingArguments
 from trl import CPOConfig, KTOConfig, ORPOConfig, PRMConfig, RewardConfig
@@ -56,6 +56,44 @@ class AxolotlTrainingMixins:
             "help": "The number of samples to group together for packing. Increase for better packing."
         },
     )
+    sample_packing_algorithm: str = field(
+        default="ffd",
+        metadata={"help": "The bin packing algorithm: ffd, bfd or multifit."},
+    )
+    sample_packing_balance_cost: bool = field(
+        default=False,
+        metadata={
+            "help": "Balance the estimated attention cost of packed bins within each step and across ranks."
+        },
+    )
+    sample_packing_balance_ranks: bool = field(
+        default=False,
+        metadata={
+            "help": "Balance per-rank token and compute load of packed bins and keep the epoch's last bins."
+        },
+    )
+    sample_packing_cost_linear: float = field(
+        default=1.0,
+        metadata={"help": "Per-token term of the packing cost model."},
+    )
+    sample_packing_cost_quadratic: float = field(
+        default=0.0,
+        metadata={
+            "help": "Per-squared-document-length term of the packing cost model."
+        },
+    )
+    sample_packing_plan_cache: bool = field(
+        default=False,
+        metadata={
+            "help": "Seed the packing plan per epoch and cache it next to the dataset."
+        },
+    )
+    sample_packing_mp_start_method: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "The multiprocessing start method used to pack groups in parallel."
+        },
+    )
     max_seq_length: int = field(
         default=2048,
         metadata={"help": "The maximum sequence length the model can handle"},
@@ -156,6 +194,12 @@ class AxolotlTrainingMixins:
         default=None,
         metadata={"help": "whether to use sequential sampling for curriculum learning"},
     )
+    dataset_sample_ratios: Optional[List[float]] = field(
+        default=None,
+        metadata={
+            "help": "rows drawn every epoch from each merged dataset, as a multiple of its size"
+        },
+    )
     alternate_optimizer: Optional[str] = field(
         default=None,
         metadata={
@@ -206,6 +250,13 @@ class AxolotlTrainingMixins:
         },
     )
 
+    kd_loss_chunk_size: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": "Compute the KD loss over chunks of this many positions, recomputing them in the backward pass"
+        },
+    )
+
 
 @dataclass
 class AxolotlTrainingArguments(AxolotlTrainingMixins, TrainingArguments):
@@ -1,13 +1,24 @@
 """Module containing Dataset functionality"""
 
+import hashlib
+import json
 import logging
 import os
-from typing import List, Optional, Union
+import shutil
+from contextlib import ExitStack, nullcontext
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Type, Union
 
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
 import torch
-from datasets import Dataset, IterableDataset
+from datasets import Dataset, Features, IterableDataset, Sequence, Value
+from datasets.fingerprint import Hasher
 
 from .prompt_tokenizers import PromptTokenizingStrategy
+from .prompters import IGNORE_TOKEN_ID
+from .utils.tokenization import record_prefix_cache_stats
 
 # We want this to be a wrapper for an existing dataset that we have loaded
 # lets use the concept of middlewares to wrap each dataset, for example
@@ -17,6 +28,10 @@ from .prompt_tokenizers import PromptTokenizingStrategy
 
 LOG = logging.getLogger("axolotl")
 
+# column of a merged prepared dataset with the index of the configured dataset
+# every row comes from, so that it follows the rows through filters and splits
+SOURCE_COLUMN = "source_idx"
+
 
 class TokenizedPromptDataset(Dataset):
     """
@@ -49,9 +64,11 @@ class TokenizedPromptDataset(Dataset):
         num_proc = min(64, self.process_count if self.process_count else os.cpu_count())
 
         map_kwargs = {}
+        tokenize = self.prompt_tokenizer.tokenize_prompt
         if self.prompt_tokenizer.supports_batched:
             map_kwargs["batched"] = True
             map_kwargs["batch_size"] = 1_000
+            tokenize = self.prompt_tokenizer.tokenize_prompts
 
         if (
             hasattr(self.prompt_tokenizer, "filter_rows")
@@ -63,14 +80,40 @@ class TokenizedPromptDataset(Dataset):
                 desc="Strategy Filtering Rows",
             )
 
-        return dataset.map(
-            self.prompt_tokenizer.tokenize_prompt,
-            num_proc=num_proc,
-            remove_columns=features,
-            keep_in_memory=self.keep_in_memory,
-            desc="Tokenizing Prompts",
-            **map_kwargs,
+        prefix_cache = getattr(
+            getattr(self.prompt_tokenizer, "prompter", None), "prefix_cache", None
         )
+        if prefix_cache is not None:
+            # hash the cache before it carries the stats directory, which is new for
+            # every run, to the workers
+            map_kwargs["new_fingerprint"] = Hasher.hash(
+                [
+                    dataset._fingerprint,  # pylint: disable=protected-access
+                    tokenize,
+                    map_kwargs,
+                ]
+            )
+        with (
+            record_prefix_cache_stats(prefix_cache)
+            if prefix_cache is not None
+            else nullcontext()
+        ) as stats:
+            dataset = dataset.map(
+                tokenize,
+                num_proc=num_proc,
+                remove_columns=features,
+                keep_in_memory=self.keep_in_memory,
+                desc="Tokenizing Prompts",
+                **map_kwargs,
+            )
+        if stats and stats["lookups"]:
+            LOG.info(
+                f"Prompt prefix cache: {int(stats['hits'])} hits out of "
+                f"{int(stats['lookups'])} tokenizations "
+                f"({stats['hits'] / stats['lookups']:.1%}), "
+                f"~{stats['seconds_saved']:.1f}s of tokenization saved"
+            )
+        return dataset
 
 
 def wrap_dataset_for_tokenized_prompt(
@@ -80,11 +123,13 @@ def wrap_dataset_for_tokenized_prompt(
 ):
     if isinstance(dataset, IterableDataset):
         map_kwargs = {}
+        tokenize = prompt_tokenizer.tokenize_prompt
         if prompt_tokenizer.supports_batched:
             map_kwargs["batched"] = True
+            tokenize = prompt_tokenizer.tokenize_prompts
         features = dataset.features.keys()
         return dataset.map(
-            prompt_tokenizer.tokenize_prompt,
+            tokenize,
             remove_columns=features,
             **map_kwargs,
         )
@@ -215,3 +260,390 @@ class ConstantLengthDataset(IterableDataset):
                         buffer["labels"].append(labels_with_concat)
                         buffer["position_ids"].append(position_ids)
                         buffer_len += len(input_ids)
+
+
+class TokenStore:
+    """
+    Read-only prepared dataset backed by memory-mapped flat arrays instead of Arrow
+    `list<int64>` columns: the token ids of all rows back to back as `uint16` or
+    `uint32`, a bitmap of the tokens that are trained on, and an `int64` offsets
+    index. Rows are returned as numpy views into the mapped token ids, with
+    `labels`, `attention_mask` and `position_ids` rebuilt from the bitmap and the
+    row length.
+
+    Only datasets whose labels are either the input id or -100, and whose
+    attention mask and position ids are the defaults, can be stored.
+
+    The top-k teacher targets of KD datasets are stored as one `[num_tokens, K]`
+    `float16` array of logprobs and one `int32` array of token ids, indexed by the
+    same offsets as the token ids. Their mask is derived from the labels and the
+    finite logprobs instead of being stored.
+
+    The `SOURCE_COLUMN` of a merged dataset is stored as an `int32` array of the
+    `sources` of the rows, which aren't returned with them.
+    """
+
+    COLUMNS = ("input_ids", "labels", "attention_mask", "position_ids")
+    TEACHER_COLUMNS = ("target_logprobs", "target_token_ids", "target_mask")
+
+    def __init__(
+        self,
+        path: Union[str, os.PathLike],
+        indices: Optional[np.ndarray] = None,
+        column_names: Optional[List[str]] = None,
+        added_columns: Optional[Dict[str, np.ndarray]] = None,
+    ):
+        self.path = Path(path)
+        with open(self.path / "meta.json", encoding="utf-8") as fin:
+            self.meta = json.load(fin)
+
+        self._input_ids = self._memmap("input_ids.bin", self.meta["dtype"])
+        self._label_mask = self._memmap("label_mask.bin", np.uint8)
+        self._offsets = np.load(self.path / "offsets.npy", mmap_mode="r")
+        self._num_supervised = np.load(self.path / "num_supervised.npy", mmap_mode="r")
+        if top_k := self.meta.get("top_k"):
+            self._target_logprobs = self._memmap(
+                "target_logprobs.bin", np.float16
+            ).reshape(-1, top_k)
+            self._target_token_ids = self._memmap(
+                "target_token_ids.bin", np.int32
+            ).reshape(-1, top_k)
+        self._sources = None
+        if (self.path / "sources.npy").exists():
+            self._sources = np.load(self.path / "sources.npy", mmap_mode="r")
+        self._indices = indices
+        # in-memory columns of one value per row of this view, see `add_column`
+        self._added_columns = dict(added_columns or {})
+        self.column_names = list(column_names or self.meta["columns"])
+
+        self._fingerprint = self.meta["fingerprint"]
+        if indices is not None:
+            self._fingerprint = hashlib.md5(
+                self._fingerprint.encode() + indices.tobytes(),
+                usedforsecurity=False,
+            ).hexdigest()
+        for name, values in self._added_columns.items():
+            self._fingerprint = hashlib.md5(
+                self._fingerprint.encode() + name.encode() + values.tobytes(),
+                usedforsecurity=False,
+            ).hexdigest()
+
+    def _memmap(self, name: str, dtype) -> np.ndarray:
+        if not os.path.getsize(self.path / name):
+            # np.memmap can't map empty files
+            return np.empty(0, dtype=dtype)
+        return np.memmap(self.path / name, dtype=dtype, mode="r")
+
+    @classmethod
+    def write(
+        cls,
+        dataset: Dataset,
+        path: Union[str, os.PathLike],
+        vocab_size: int,
+        batch_size: int = 10_000,
+    ) -> "TokenStore":
+        """write `dataset` as a token store at `path` and open it"""
+        column_names = [
+            name
+            for name in dataset.column_names
+            if name not in ("length", SOURCE_COLUMN)
+        ]
+        if unsupported := set(column_names) - set(cls.COLUMNS + cls.TEACHER_COLUMNS):
+            raise ValueError(
+                f"columns {sorted(unsupported)} can't be stored in a token store"
+            )
+        teacher_columns = [name for name in cls.TEACHER_COLUMNS if name in column_names]
+        if teacher_columns and (
+            len(teacher_columns) < len(cls.TEACHER_COLUMNS)
+            or "labels" not in column_names
+        ):
+            raise ValueError(
+                f"teacher targets need all of {list(cls.TEACHER_COLUMNS)} and labels"
+            )
+        top_k = cls._max_top_k(dataset, batch_size) if teacher_columns else None
+        dtype: Type[np.unsignedinteger] = np.uint32
+        if vocab_size <= np.iinfo(np.uint16).max + 1:
+            dtype = np.uint16
+
+        path = Path(path)
+        tmp_path = path.with_name(f"{path.name}.tmp-{os.getpid()}")
+        tmp_path.mkdir(parents=True)
+        try:
+            offsets = [np.zeros(1, dtype=np.int64)]
+            num_supervised = []
+            num_tokens = 0
+            carry_bits = np.zeros(0, dtype=bool)
+            with ExitStack() as stack:
+                ids_out = stack.enter_context(open(tmp_path / "input_ids.bin", "wb"))
+                mask_out = stack.enter_context(open(tmp_path / "label_mask.bin", "wb"))
+                teacher_outs = [
+                    stack.enter_context(open(tmp_path / f"{name}.bin", "wb"))
+                    for name in ("target_logprobs", "target_token_ids")
+                    if top_k
+                ]
+                for batch in dataset.with_format("arrow").iter(batch_size=batch_size):
+                    columns = {
+                        name: batch[name].combine_chunks() for name in column_names
+                    }
+                    row_lengths = pc.list_value_length(columns["input_ids"]).to_numpy()
+                    row_ends = np.cumsum(row_lengths)
+                    input_ids = columns["input_ids"].flatten().to_numpy()
+                    if input_ids.size and (
+                        input_ids.min() < 0 or input_ids.max() > np.iinfo(dtype).max
+                    ):
+                        raise ValueError(
+                            f"token ids don't fit in {np.dtype(dtype).name}"
+                        )
+
+                    label_mask = np.ones(len(input_ids), dtype=bool)
+                    if "labels" in columns:
+                        labels = columns["labels"].flatten().to_numpy()
+                        label_mask = labels != IGNORE_TOKEN_ID
+                        if not np.array_equal(
+                            labels[label_mask], input_ids[label_mask]
+                        ):
+                            raise ValueError("labels must be the input ids or -100")
+                    if "attention_mask" in columns:
+                        if not columns["attention_mask"].flatten().to_numpy().all():
+                            raise ValueError("attention_mask must be all ones")
+                    if "position_ids" in columns:
+                        expected = np.arange(len(input_ids)) - np.repeat(
+                            row_ends - row_lengths, row_lengths
+                        )
+                        position_ids = columns["position_ids"].flatten().to_numpy()
+                        if not np.array_equal(position_ids, expected):
+                            raise ValueError(
+                                "position_ids must count up from 0 per row"
+                            )
+
+                    if top_k:
+                        for targets, teacher_out in zip(
+                            cls._teacher_targets(columns, label_mask, top_k),
+                            teacher_outs,
+                        ):
+                            targets.tofile(teacher_out)
+
+                    input_ids.astype(dtype).tofile(ids_out)
+                    bits = np.concatenate([carry_bits, label_mask])
+                    num_full_bytes = len(bits) // 8
+                    np.packbits(bits[: num_full_bytes * 8]).tofile(mask_out)
+                    carry_bits = bits[num_full_bytes * 8 :]
+
+                    cu_mask = np.concatenate([[0], np.cumsum(label_mask)])
+                    num_supervised.append(
+                        cu_mask[row_ends] - cu_mask[row_ends - row_lengths]
+                    )
+                    offsets.append(num_tokens + row_ends)
+                    num_tokens += len(input_ids)
+                np.packbits(carry_bits).tofile(mask_out)
+
+            np.save(tmp_path / "offsets.npy", np.concatenate(offsets))
+            np.save(
+                tmp_path / "num_supervised.npy",
+                np.concatenate(num_supervised or [np.zeros(0, dtype=np.int64)]),
+            )
+            if SOURCE_COLUMN in dataset.column_names:
+                np.save(
+                    tmp_path / "sources.npy",
+                    dataset.select_columns(SOURCE_COLUMN)
+                    .with_format("numpy")[SOURCE_COLUMN]
+                    .astype(np.int32),
+                )
+            with open(tmp_path / "meta.json", "w", encoding="utf-8") as fout:
+                json.dump(
+                    {
+                        "dtype": np.dtype(dtype).name,
+                        "num_rows": len(dataset),
+                        "num_tokens": num_tokens,
+                        "columns": column_names,
+                        "top_k": top_k,
+                        "fingerprint": dataset._fingerprint,  # pylint: disable=protected-access
+                    },
+                    fout,
+                )
+        except BaseException:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+        if path.exists():
+            shutil.rmtree(path)
+        os.rename(tmp_path, path)
+        return cls(path)
+
+    @staticmethod
+    def _max_top_k(dataset: Dataset, batch_size: int) -> int:
+        top_k = 0
+        for batch in (
+            dataset.select_columns("target_logprobs")
+            .with_format("arrow")
+            .iter(batch_size=batch_size)
+        ):
+            positions = pc.list_flatten(batch["target_logprobs"])
+            top_k = max(top_k, pc.max(pc.list_value_length(positions)).as_py() or 0)
+        return top_k
+
+    @staticmethod
+    def _teacher_targets(
+        columns: Dict[str, pa.Array], label_mask: np.ndarray, top_k: int
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """the teacher targets of a batch as [num_tokens, top_k] arrays"""
+        positions = columns["target_logprobs"].flatten()
+        if len(positions) != len(label_mask):
+            raise ValueError("teacher targets must have one position per token")
+        counts = pc.list_value_length(positions).to_numpy(zero_copy_only=False)
+        rows = np.repeat(np.arange(len(counts)), counts)
+        cols = np.arange(len(rows)) - np.repeat(np.cumsum(counts) - counts, counts)
+
+        target_logprobs = np.full((len(counts), top_k), -np.inf, dtype=np.float16)
+        with np.errstate(over="ignore"):
+            # logprobs below the float16 range, like padding, become -inf
+            target_logprobs[rows, cols] = positions.flatten().to_numpy()
+        target_token_ids = np.zeros((len(counts), top_k), dtype=np.int32)
+        token_ids = columns["target_token_ids"].flatten().flatten().to_numpy()
+        if token_ids.size and (
+            token_ids.min() < 0 or token_ids.max() > np.iinfo(np.int32).max
+        ):
+            raise ValueError("teacher token ids don't fit in int32")
+        target_token_ids[rows, cols] = token_ids
+
+        # entries without a finite logprob don't contribute to the loss either way
+        target_mask = (
+            columns["target_mask"].flatten().flatten().to_numpy(zero_copy_only=False)
+        )
+        finite = np.isfinite(target_logprobs[rows, cols])
+        if not np.array_equal(
+            target_mask[finite].astype(bool), np.repeat(label_mask, counts)[finite]
+        ):
+            raise ValueError("target_mask must mask the positions of the labels")
+        return target_logprobs, target_token_ids
+
+    def _rows(self) -> np.ndarray:
+        if self._indices is None:
+            return np.arange(self.meta["num_rows"])
+        return self._indices
+
+    def __len__(self):
+        if self._indices is None:
+            return self.meta["num_rows"]
+        return len(self._indices)
+
+    def __getitem__(self, idx: int) -> Dict[str, np.ndarray]:
+        if not -len(self) <= idx < len(self):
+            raise IndexError(f"index {idx} out of range for {len(self)} rows")
+        row = idx % len(self) if self._indices is None else self._indices[idx]
+        start, end = int(self._offsets[row]), int(self._offsets[row + 1])
+        input_ids = self._input_ids[start:end]
+
+        item = {"input_ids": input_ids}
+        if "labels" in self.column_names or "target_mask" in self.column_names:
+            bits = np.unpackbits(self._label_mask[start // 8 : (end + 7) // 8])
+            label_mask = bits[start % 8 : start % 8 + end - start].astype(bool)
+        if "labels" in self.column_names:
+            item["labels"] = np.where(
+                label_mask, input_ids.astype(np.int64), IGNORE_TOKEN_ID
+            )
+        if "attention_mask" in self.column_names:
+            item["attention_mask"] = np.ones(end - start, dtype=np.int64)
+        if "position_ids" in self.column_names:
+            item["position_ids"] = np.arange(end - start)
+        if "target_logprobs" in self.column_names:
+            item["target_logprobs"] = self._target_logprobs[start:end]
+        if "target_token_ids" in self.column_names:
+            item["target_token_ids"] = self._target_token_ids[start:end]
+        if "target_mask" in self.column_names:
+            item["target_mask"] = label_mask[:, None] & np.isfinite(
+                self._target_logprobs[start:end]
+            )
+        for name, values in self._added_columns.items():
+            item[name] = values[idx]
+        return item
+
+    def __getitems__(self, indices: List[int]) -> List[Dict[str, np.ndarray]]:
+        return [self[idx] for idx in indices]
+
+    @property
+    def lengths(self) -> np.ndarray:
+        return np.diff(self._offsets)[self._rows()]
+
+    @property
+    def num_tokens(self) -> int:
+        return int(self.lengths.sum())
+
+    @property
+    def supervised_counts(self) -> np.ndarray:
+        return np.asarray(self._num_supervised[self._rows()])
+
+    @property
+    def num_supervised_tokens(self) -> int:
+        return int(self.supervised_counts.sum())
+
+    @property
+    def sources(self) -> Optional[np.ndarray]:
+        """the index of the configured dataset every row comes from, when stored"""
+        if self._sources is None:
+            return None
+        return np.asarray(self._sources[self._rows()], dtype=np.int32)
+
+    @property
+    def features(self) -> Features:
+        dtypes = {
+            "target_logprobs": "float16",
+            "target_token_ids": "int32",
+            "target_mask": "bool",
+        }
+        features = {
+            name: (
+                Sequence(Sequence(Value(dtypes[name])))
+                if name in dtypes
+                else Sequence(Value("int64"))
+            )
+            for name in self.column_names
+        }
+        for name, values in self._added_columns.items():
+            features[name] = Value(str(values.dtype))
+        return Features(features)
+
+    @property
+    def cache_files(self) -> List[Dict[str, str]]:
+        return [{"filename": str(self.path / "input_ids.bin")}]
+
+    def select(self, indices) -> "TokenStore":
+        indices = np.asarray(indices, dtype=np.int64)
+        return TokenStore(
+            self.path,
+            indices=self._rows()[indices],
+            column_names=self.column_names,
+            added_columns={
+                name: values[indices] for name, values in self._added_columns.items()
+            },
+        )
+
+    def remove_columns(self, column_names: Union[str, List[str]]) -> "TokenStore":
+        if isinstance(column_names, str):
+            column_names = [column_names]
+        return TokenStore(
+            self.path,
+            indices=self._indices,
+            column_names=[
+                name for name in self.column_names if name not in column_names
+            ],
+            added_columns={
+                name: values
+                for name, values in self._added_columns.items()
+                if name not in column_names
+            },
+        )
+
+    def add_column(self, name: str, column) -> "TokenStore":
+        """
+        A view with a column of one scalar per row held in memory, like the row
+        indices of `join_teacher_logprobs`
+        """
+        column = np.asarray(column)
+        if column.shape != (len(self),):
+            raise ValueError(f"column {name} must have one value per row")
+        return TokenStore(
+            self.path,
+            indices=self._indices,
+            column_names=self.column_names,
+            added_columns={**self._added_columns, name: column},
+        )
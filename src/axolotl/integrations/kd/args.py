@@ -35,3 +35,19 @@ class KDArgs(BaseModel):
     kd_top_k_before_softmax: Optional[
         bool
     ] = None  # whether to sample top k before softmax during KD
+    kd_loss_chunk_size: Optional[
+        int
+    ] = None  # number of positions per chunk to compute the KD loss over
+
+    # offline teacher logprobs, generated with `axolotl kd-generate`
+    kd_teacher_model: Optional[
+        str
+    ] = None  # teacher model to generate logprobs with, and train on them
+    kd_teacher_top_k: Optional[int] = None  # number of logprobs per position, 64
+    kd_teacher_batch_tokens: Optional[
+        int
+    ] = None  # padded tokens per teacher batch, 16384
+    kd_teacher_shard_size: Optional[int] = None  # rows per resumable shard, 10000
+    kd_teacher_logprobs_path: Optional[
+        str
+    ] = None  # where to write them, `dataset_prepared_path`/kd_logprobs
@@ -15,11 +15,12 @@
 """
 Chat template prompt strategy loader with KD support
 """
-from typing import Any, Dict
+from typing import Any, Dict, List
 
-import torch
+import numpy as np
 
 from axolotl.prompt_strategies.chat_template import ChatTemplateStrategy, StrategyLoader
+from axolotl.prompters import IGNORE_TOKEN_ID
 
 
 class ChatTemplateStrategyWithKD(ChatTemplateStrategy):
@@ -35,6 +36,7 @@ class ChatTemplateStrategyWithKD(ChatTemplateStrategy):
         sequence_len,
         roles_to_train=None,
         train_on_eos=None,
+        turn_boundaries=None,
         logprobs_field="logprobs",
         gen_temperature=1.0,
         kd_temperature=1.0,
@@ -50,124 +52,116 @@ class ChatTemplateStrategyWithKD(ChatTemplateStrategy):
             sequence_len,
             roles_to_train=roles_to_train,
             train_on_eos=train_on_eos,
+            turn_boundaries=turn_boundaries,
         )
 
     @property
     def supports_batched(self) -> bool:
-        # batching doesn't work well for logprob data
-        return False
+        return True
 
     def transform_logprobs(self, sample):
         """
         Transform logprobs to target format for KD training
         """
+        return self.transform_logprobs_batch([sample])[0]
 
-        logprobs = sample.pop(self.logprobs_field)
-        target_seq_len = len(logprobs)
-        input_seq_len = len(sample["input_ids"])
-        input_padding_len = input_seq_len - target_seq_len
-        # get non-zero top-k (prune None logprobs from vllm data step)
-        top_k_vals = [
-            len(logprobs[i])
-            for i in range(len(logprobs))
-            if logprobs[i] is not None and len(logprobs[i])
+    def transform_logprobs_batch(self, samples: List[dict]) -> List[dict]:
+        """
+        Transform the logprobs of a batch of tokenized samples to the target format
+        for KD training. The top-k entries of every position of the batch are parsed
+        into one [positions, K] array, so the temperature rescaling runs once per
+        batch instead of once per position.
+        """
+        if not samples:
+            return samples
+
+        logprobs_rows, top_ks = [], []
+        for sample in samples:
+            logprobs = sample.pop(self.logprobs_field)
+            input_seq_len = len(sample["input_ids"])
+            if len(logprobs) > input_seq_len:
+                # logprobs is longer than the input, which was truncated,
+                # so keep the logprobs from the left/beginning
+                logprobs = logprobs[:input_seq_len]
+            logprobs_rows.append(logprobs)
+            top_ks.append(_get_top_k(logprobs))
+
+        # positions with fewer than top_k entries (or None from the vllm data step)
+        # are padded with -inf logprobs, and masked out
+        counts = np.fromiter(
+            (
+                min(len(position or ()), top_k)
+                for logprobs, top_k in zip(logprobs_rows, top_ks)
+                for position in logprobs
+            ),
+            dtype=np.int64,
+        )
+        entries = [
+            entry
+            for logprobs, top_k in zip(logprobs_rows, top_ks)
+            for position in logprobs
+            for entry in (position or ())[:top_k]
         ]
-        max_top_k = max(set(top_k_vals), key=top_k_vals.count)
-        min_top_k = min(set(top_k_vals), key=top_k_vals.count)
-        top_k = min(max_top_k, min_top_k)
-        if top_k == 0:
-            raise ValueError("No non-zero top-k logprobs found.")
-
-        target_logprobs = []
-        target_token_ids = []
-        target_mask = []
-
-        if input_padding_len < 0:
-            # logprobs is longer than target_seq_len,
-            # so we need to slice from the left/beginning of logprobs
-            logprobs = logprobs[:-input_seq_len]
-            input_padding_len = 0
-            # target_seq_len = input_seq_len
-
-        # truncate the second dimension of the logprobs to top_k
-        logprobs = [row[:top_k] for row in logprobs]
-
-        # fill with -inf for padding_len tokens for top_k tokens
-        # extend target_logprobs with a padding_len x top_k 2D list filled with -inf
-
-        # for causal models, if we start the range at 1, then we don't need to shift in the trainer
-        # otherwise, we need to shift in the trainer
-        shift = 0
-        for _ in range(shift, input_padding_len):
-            target_logprobs.append([-float("inf")] * top_k)
-            target_token_ids.append(list(range(top_k)))
-            target_mask.append([0] * top_k)
-
-        for position in range(input_padding_len, input_seq_len):
-            if sample["labels"][position] == -100:
-                target_mask.append([0] * top_k)
-            else:
-                target_mask.append([1] * top_k)
-
-        for _, token_pos_logprobs in enumerate(logprobs):
-            # Initialize collections for logprobs and token_ids
-            position_logprobs = []
-            position_token_ids = []
-
-            # Process each token probability entry
-            for entry in token_pos_logprobs:
-                # Extract logprob value
-                logprob = entry["logprob"]
-
-                # Parse token_id from the "token_id:###" format
-                token_id = int(entry["token"].split(":")[1])
-
-                # Append to our collections
-                position_logprobs.append(logprob)
-                position_token_ids.append(token_id)
-
-            # Convert to a tensor for easier manipulation
-            position_logprobs_tensor = torch.tensor(
-                position_logprobs, dtype=torch.float
-            )
+        num_positions, max_top_k = len(counts), max(top_ks)
+        position_logprobs = np.full(
+            (num_positions, max_top_k), -np.inf, dtype=np.float32
+        )
+        position_token_ids = np.zeros((num_positions, max_top_k), dtype=np.int64)
+        entry_rows = np.repeat(np.arange(num_positions), counts)
+        entry_cols = np.arange(len(entries)) - np.repeat(
+            np.cumsum(counts) - counts, counts
+        )
+        position_logprobs[entry_rows, entry_cols] = np.fromiter(
+            (entry["logprob"] for entry in entries),
+            dtype=np.float32,
+            count=len(entries),
+        )
+        # Parse token_id from the "token_id:###" format
+        position_token_ids[entry_rows, entry_cols] = np.fromiter(
+            (int(entry["token"].split(":")[1]) for entry in entries),
+            dtype=np.int64,
+            count=len(entries),
+        )
 
-            # Now we have distribution at T1 in log form, i.e. log p_{T1}(k).
-            # Next, re-scale to T2 = self.kd_temperature via exponent-based trick
-            # p_{T2}(k) = [p_{T1}(k)]^(T1 / T2) / Z
-            #
-            # Convert from log to probability
-            teacher_probs_t1 = position_logprobs_tensor.exp()
-            if self.kd_temperature != self.gen_temperature:
-                # Exponentiate by factor (T1 / T2)
-                exponent = self.gen_temperature / self.kd_temperature
-                teacher_probs_t2 = teacher_probs_t1**exponent
-            else:
-                teacher_probs_t2 = teacher_probs_t1
-            # Re-normalize
-            teacher_probs_t2 = teacher_probs_t2 / teacher_probs_t2.sum(
-                dim=0, keepdim=True
+        # Now we have distribution at T1 in log form, i.e. log p_{T1}(k).
+        # Next, re-scale to T2 = self.kd_temperature via exponent-based trick
+        # p_{T2}(k) = [p_{T1}(k)]^(T1 / T2) / Z
+        teacher_probs = np.exp(position_logprobs)
+        if self.kd_temperature != self.gen_temperature:
+            teacher_probs **= self.gen_temperature / self.kd_temperature
+        # Re-normalize, positions without logprobs stay at zero
+        norm = teacher_probs.sum(axis=-1, keepdims=True)
+        np.divide(teacher_probs, norm, out=teacher_probs, where=norm > 0)
+        with np.errstate(divide="ignore"):
+            position_logprobs = np.log(teacher_probs)
+
+        position_ends = np.cumsum([len(logprobs) for logprobs in logprobs_rows])
+        for sample, logprobs, top_k, end in zip(
+            samples, logprobs_rows, top_ks, position_ends
+        ):
+            start = end - len(logprobs)
+            input_seq_len = len(sample["input_ids"])
+            # the positions before the logprobs are padded: -inf for top_k tokens
+            input_padding_len = input_seq_len - len(logprobs)
+
+            target_logprobs = np.full((input_seq_len, top_k), -np.inf, dtype=np.float32)
+            target_logprobs[input_padding_len:] = position_logprobs[start:end, :top_k]
+            target_token_ids = np.tile(np.arange(top_k), (input_seq_len, 1))
+            target_token_ids[input_padding_len:] = position_token_ids[start:end, :top_k]
+            target_mask = np.zeros((input_seq_len, top_k), dtype=np.int64)
+            labels = np.asarray(sample["labels"][input_padding_len:input_seq_len])
+            label_mask = labels != IGNORE_TOKEN_ID
+            # entries padded with -inf have no target, like in the token store
+            target_mask[input_padding_len:] = label_mask[:, None] & np.isfinite(
+                target_logprobs[input_padding_len:]
             )
-            # Convert back to log
-            position_logprobs_tensor = torch.log(teacher_probs_t2)
 
-            # Now we have log p_{teacher, T2}(k) stored in position_logprobs_tensor
-            position_logprobs_scaled = position_logprobs_tensor.tolist()
+            # Update sample with transformed logprobs
+            sample["target_logprobs"] = target_logprobs.tolist()
+            sample["target_token_ids"] = target_token_ids.tolist()
+            sample["target_mask"] = target_mask.tolist()
 
-            target_logprobs.append(position_logprobs_scaled)
-            target_token_ids.append(position_token_ids)
-
-        if shift == 1:
-            # since we started at index 1 for causal, we need one more padding token
-            target_logprobs.append([-float("inf")] * top_k)
-            target_token_ids.append(list(range(top_k)))
-            target_mask.append([0] * top_k)
-
-        # Update sample with transformed logprobs
-        sample["target_logprobs"] = target_logprobs
-        sample["target_token_ids"] = target_token_ids
-        sample["target_mask"] = target_mask
-
-        return sample
+        return samples
 
     def _tokenize_single_prompt(self, prompt):
         logprobs = prompt.pop(self.logprobs_field)
@@ -177,6 +171,24 @@ class ChatTemplateStrategyWithKD(ChatTemplateStrategy):
 
         return tokenized_prompt
 
+    def _tokenize_batch(self, rows: List[dict]) -> List[dict]:
+        logprobs = [row.pop(self.logprobs_field) for row in rows]
+        tokenized_prompts = super()._tokenize_batch(rows)
+        for tokenized_prompt, row_logprobs in zip(tokenized_prompts, logprobs):
+            tokenized_prompt[self.logprobs_field] = row_logprobs
+
+        return self.transform_logprobs_batch(tokenized_prompts)
+
+
+def _get_top_k(logprobs: list) -> int:
+    # get non-zero top-k (prune None logprobs from vllm data step)
+    top_k_vals = [len(position) for position in logprobs if position]
+    if not top_k_vals:
+        raise ValueError("No non-zero top-k logprobs found.")
+    max_top_k = max(set(top_k_vals), key=top_k_vals.count)
+    min_top_k = min(set(top_k_vals), key=top_k_vals.count)
+    return min(max_top_k, min_top_k)
+
 
 class KDStrategyLoader(StrategyLoader):
     """
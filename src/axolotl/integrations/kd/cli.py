@@ -0,0 +1,23 @@
+"""
+axolotl CLI for generating the teacher logprobs of KD datasets
+"""
+from typing import Optional
+
+import click
+
+
+@click.command()
+@click.argument("config", type=click.Path(exists=True, path_type=str))
+@click.option(
+    "--device",
+    default=None,
+    help="torch device to run the teacher on, cuda when available",
+)
+def kd_generate(config: str, device: Optional[str] = None):
+    """
+    generate the top-k teacher logprobs of a prepared dataset for KD
+    """
+    from axolotl.cli.config import load_cfg
+    from axolotl.integrations.kd.generate import do_kd_generate
+
+    do_kd_generate(load_cfg(config), device=device)
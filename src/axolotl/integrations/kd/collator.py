@@ -18,7 +18,7 @@ and with a teacher_mask to identify padded positions.
 """
 
 from dataclasses import dataclass
-from typing import Any, Optional, Union
+from typing import Any, Dict, Optional, Union
 
 import numpy as np
 import torch
@@ -27,6 +27,8 @@ from transformers.utils import PaddingStrategy
 
 from axolotl.utils.collators.batching import DataCollatorForSeq2Seq
 
+from .generate import TEACHER_ROW_IDX, TeacherLogprobs
+
 
 @dataclass
 class DataCollatorForKD(DataCollatorForSeq2Seq):
@@ -46,11 +48,30 @@ class DataCollatorForKD(DataCollatorForSeq2Seq):
     label_pad_token_id: int = -100
     position_pad_token_id: int = 0
     return_tensors: str = "pt"
+    # targets generated with `axolotl kd-generate`, of the rows by their index
+    teacher_logprobs: Optional[TeacherLogprobs] = None
+
+    def _fill_teacher_targets(self, features):
+        """
+        set the targets of the features of `join_teacher_logprobs` datasets from
+        `teacher_logprobs`, by their row index
+        """
+        if self.teacher_logprobs is None:
+            return
+        for feature in features:
+            if TEACHER_ROW_IDX in feature:
+                feature.update(
+                    self.teacher_logprobs.dense_targets(
+                        int(feature.pop(TEACHER_ROW_IDX)), len(feature["input_ids"])
+                    )
+                )
 
     def __call__(self, features, return_tensors=None):
         if return_tensors is None:
             return_tensors = self.return_tensors
 
+        self._fill_teacher_targets(features)
+
         padding_side = self.tokenizer.padding_side
 
         # Pad labels and position_ids first
@@ -87,76 +108,23 @@ class DataCollatorForKD(DataCollatorForSeq2Seq):
                             ).astype(np.int64)
 
         # Handle target_logprobs and target_token_ids manually
-        target_logprobs_list = []
-        target_token_ids_list = []
-        target_mask_list = []
         has_teacher_data = ("target_logprobs" in features[0]) and (
             "target_token_ids" in features[0]
         )
 
         if has_teacher_data:
             # Extract and remove from features
-            for f in features:  # pylint: disable=invalid-name
-                target_logprobs_list.append(f.pop("target_logprobs"))
-                target_token_ids_list.append(f.pop("target_token_ids"))
-                target_mask_list.append(f.pop("target_mask"))
-
-            # Determine max lengths
-            max_teacher_seq_len = max(len(seq) for seq in target_logprobs_list)
-            max_k = max(len(seq_k) for seq in target_logprobs_list for seq_k in seq)
-
-            padded_target_logprobs = []
-            padded_target_token_ids = []
-            padded_teacher_mask_list = []
-
-            for t_logprobs, t_ids, t_mask in zip(
-                target_logprobs_list, target_token_ids_list, target_mask_list
-            ):
-                t_logprobs_padded = []
-                t_ids_padded = []
-                t_mask_padded = []
-
-                for lp, ids, mask in zip(  # pylint: disable=invalid-name
-                    t_logprobs, t_ids, t_mask
-                ):
-                    lp_len = len(lp)
-                    if lp_len < max_k:
-                        # Use -1e9 for padding logprobs and 0 for token_ids
-                        pad_len = max_k - lp_len
-                        lp = lp + [-1e9] * pad_len  # pylint: disable=invalid-name
-                        ids = ids + [0] * pad_len
-                        mask = mask + [0] * pad_len
-                    else:
-                        lp = lp[:max_k]  # pylint: disable=invalid-name
-                        ids = ids[:max_k]
-                        mask = mask[:max_k]
-
-                    t_logprobs_padded.append(lp)
-                    t_ids_padded.append(ids)
-                    t_mask_padded.append(mask)
-
-                seq_len_diff = max_teacher_seq_len - len(t_logprobs_padded)
-                if seq_len_diff > 0:
-                    # Pad sequences fully if needed
-                    t_logprobs_padded.extend(
-                        [[-1e9] * max_k for _ in range(seq_len_diff)]
-                    )
-                    t_ids_padded.extend([[0] * max_k for _ in range(seq_len_diff)])
-                    t_mask_padded.extend([[0] * max_k for _ in range(seq_len_diff)])
-
-                padded_target_logprobs.append(t_logprobs_padded)
-                padded_target_token_ids.append(t_ids_padded)
-                padded_teacher_mask_list.append(t_mask_padded)
-
-            # Convert to tensors
-            padded_target_logprobs = torch.tensor(
-                padded_target_logprobs, dtype=torch.float
-            )
-            padded_target_token_ids = torch.tensor(
-                padded_target_token_ids, dtype=torch.long
-            )
-            padded_teacher_mask_list = torch.tensor(
-                padded_teacher_mask_list, dtype=torch.int
+            teacher_data = self._pad_teacher_data(
+                [
+                    [
+                        (
+                            f.pop("target_logprobs"),
+                            f.pop("target_token_ids"),
+                            f.pop("target_mask"),
+                        )
+                    ]
+                    for f in features  # pylint: disable=invalid-name
+                ]
             )
 
         # Pad using tokenizer for regular fields
@@ -170,9 +138,7 @@ class DataCollatorForKD(DataCollatorForSeq2Seq):
 
         # Add back teacher data if present
         if has_teacher_data:
-            features["target_logprobs"] = padded_target_logprobs
-            features["target_token_ids"] = padded_target_token_ids
-            features["target_mask"] = padded_teacher_mask_list
+            features.update(teacher_data)
 
         # Prepare decoder_input_ids if the model supports it
         if (
@@ -187,6 +153,60 @@ class DataCollatorForKD(DataCollatorForSeq2Seq):
 
         return features
 
+    @staticmethod
+    def _pad_teacher_data(packs) -> Dict[str, torch.Tensor]:
+        """
+        Pad teacher data into [B, T, K] tensors allocated once. `packs` holds, for
+        every batch item, the (target_logprobs, target_token_ids, target_mask) of the
+        sequences packed into it, which are copied in one after the other.
+        """
+        seq_lens = [sum(len(lp) for lp, _, _ in pack) for pack in packs]
+        max_k = max(_top_k(lp) for pack in packs for lp, _, _ in pack)
+        shape = (len(packs), max(seq_lens), max_k)
+        # Use -1e9 for padding logprobs and 0 for token_ids
+        padded_target_logprobs = torch.full(shape, -1e9, dtype=torch.float)
+        padded_target_token_ids = torch.zeros(shape, dtype=torch.long)
+        padded_teacher_mask = torch.zeros(shape, dtype=torch.int)
+
+        logprobs_out = padded_target_logprobs.numpy()
+        token_ids_out = padded_target_token_ids.numpy()
+        mask_out = padded_teacher_mask.numpy()
+        for i, pack in enumerate(packs):
+            offset = 0
+            for t_logprobs, t_ids, t_mask in pack:
+                _copy_block(logprobs_out[i, offset:], t_logprobs)
+                _copy_block(token_ids_out[i, offset:], t_ids)
+                _copy_block(mask_out[i, offset:], t_mask)
+                offset += len(t_logprobs)
+
+        # masked entries are multiplied by the mask, so pad them like the rest
+        # instead of -inf, which would turn into nan
+        padded_target_logprobs.clamp_(min=-1e9)
+        return {
+            "target_logprobs": padded_target_logprobs,
+            "target_token_ids": padded_target_token_ids,
+            "target_mask": padded_teacher_mask,
+        }
+
+
+def _top_k(rows) -> int:
+    if isinstance(rows, np.ndarray):
+        return rows.shape[1]
+    return max((len(row) for row in rows), default=0)
+
+
+def _copy_block(out: np.ndarray, rows):
+    """copy [seq_len, K] teacher data to the start of `out`, a [T, max_k] view"""
+    try:
+        block = np.asarray(rows, dtype=out.dtype)
+    except ValueError:
+        # positions with different numbers of entries
+        for pos, row in enumerate(rows):
+            out[pos, : len(row)] = row
+        return
+    if block.size:
+        out[: block.shape[0], : block.shape[1]] = block
+
 
 class KDBatchSamplerDataCollatorForSeq2Seq(DataCollatorForKD):
     """
@@ -205,6 +225,9 @@ class KDBatchSamplerDataCollatorForSeq2Seq(DataCollatorForKD):
         if not isinstance(features[0], list):
             return super().__call__(features, return_tensors=return_tensors)
 
+        for sub_features in features:
+            self._fill_teacher_targets(sub_features)
+
         # 2) Otherwise, we *are* dealing with multiple sequences in each batch item.
         #    We want to produce a single "merged" feature dict for each sub-batch.
         out_features = [{} for _ in features]
@@ -221,15 +244,12 @@ class KDBatchSamplerDataCollatorForSeq2Seq(DataCollatorForKD):
                 if field_name == "length":
                     continue
 
-                # If it’s a KD field that’s a list-of-lists (e.g. target_logprobs),
-                # you typically just want to flatten them by extending.
+                # The KD fields are written at their offsets into the padded
+                # tensors once the rest is collated.
                 if field_name in ["target_logprobs", "target_token_ids", "target_mask"]:
-                    combined = []
-                    for feat in sub_features:
-                        combined.extend(feat[field_name])
-                    out_features[i][field_name] = combined
+                    continue
 
-                elif field_name == "attention_mask":
+                if field_name == "attention_mask":
                     # Here we apply the (j+1) factor to differentiate each sub-sample
                     # within this merged batch item.
                     arrays = []
@@ -250,6 +270,24 @@ class KDBatchSamplerDataCollatorForSeq2Seq(DataCollatorForKD):
 
         # 3) Now call the parent collator, which will do:
         #    - padding of labels/position_ids
-        #    - KD-specific padding for target_logprobs, target_token_ids, etc.
         #    - final conversion to return_tensors
-        return super().__call__(out_features, return_tensors=return_tensors)
+        collated = super().__call__(out_features, return_tensors=return_tensors)
+
+        # 4) Write the KD fields of every sequence at its offset in the pack
+        if "target_logprobs" in features[0][0]:
+            collated.update(
+                self._pad_teacher_data(
+                    [
+                        [
+                            (
+                                feat["target_logprobs"],
+                                feat["target_token_ids"],
+                                feat["target_mask"],
+                            )
+                            for feat in sub_features
+                        ]
+                        for sub_features in features
+                    ]
+                )
+            )
+        return collated
@@ -0,0 +1,367 @@
+# Copyright 2024 Axolotl AI. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Offline generation of the top-k teacher logprobs of a prepared SFT dataset
+"""
+import inspect
+import json
+import logging
+import os
+import shutil
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
+
+import numpy as np
+import torch
+
+from axolotl.prompters import IGNORE_TOKEN_ID
+from axolotl.utils.compact_schema import expand_compact_row
+from axolotl.utils.dataset_stats import carry_dataset_stats
+from axolotl.utils.samplers import get_dataset_lengths
+
+LOG = logging.getLogger("axolotl.integrations.kd.generate")
+
+# column of the row indices the KD collators look the teacher logprobs up by
+TEACHER_ROW_IDX = "teacher_row_idx"
+# files of every shard of teacher logprobs, the positions and targets of its rows
+# back to back, indexed by `row_offsets`
+SHARD_ARRAYS = ("row_offsets", "positions", "target_logprobs", "target_token_ids")
+
+
+def _length_buckets(lengths: np.ndarray, batch_tokens: int) -> Iterator[np.ndarray]:
+    """
+    batches of row indices of similar lengths, longest first, with at most
+    `batch_tokens` tokens once padded
+    """
+    order = np.argsort(-lengths, kind="stable")
+    start = 0
+    while start < len(order):
+        max_len = max(int(lengths[order[start]]), 1)
+        end = start + max(batch_tokens // max_len, 1)
+        yield order[start:end]
+        start = end
+
+
+@torch.no_grad()
+def _teacher_targets(
+    model,
+    rows: List[Dict],
+    top_k: int,
+    temperature: float,
+    pad_token_id: int,
+    chunk_size: int = 1024,
+):
+    """the supervised positions of `rows` and their renormalized top-k teacher targets"""
+    device = next(model.parameters()).device
+    max_len = max(len(row["input_ids"]) for row in rows)
+    input_ids = torch.full((len(rows), max_len), pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(rows), max_len), dtype=torch.long)
+    positions = []
+    for i, row in enumerate(rows):
+        input_ids[i, : len(row["input_ids"])] = torch.as_tensor(
+            np.asarray(row["input_ids"], dtype=np.int64)
+        )
+        attention_mask[i, : len(row["input_ids"])] = 1
+        # the target of a position is the distribution its token is predicted
+        # from, i.e. the logits of the position before
+        labels = np.asarray(row["labels"])
+        supervised = np.flatnonzero(labels != IGNORE_TOKEN_ID)
+        positions.append(supervised[supervised > 0].astype(np.int32))
+    if not sum(len(pos) for pos in positions):
+        empty = np.zeros((0, top_k))
+        return [
+            (pos, empty.astype(np.float16), empty.astype(np.int32)) for pos in positions
+        ]
+
+    logit_positions = np.concatenate(positions).astype(np.int64) - 1
+    # only the logits of the positions a row is supervised at are computed, by the
+    # forward of the model so that it post-processes them (e.g. softcapping)
+    kept = np.unique(logit_positions)
+    forward_kwargs = {}
+    if "logits_to_keep" in inspect.signature(model.forward).parameters:
+        forward_kwargs["logits_to_keep"] = torch.as_tensor(kept, device=device)
+    else:
+        kept = np.arange(max_len)
+    logits = model(
+        input_ids=input_ids.to(device),
+        attention_mask=attention_mask.to(device),
+        **forward_kwargs,
+    ).logits
+    batch_idx = torch.as_tensor(
+        np.repeat(np.arange(len(rows)), [len(pos) for pos in positions])
+    )
+    logit_idx = torch.as_tensor(np.searchsorted(kept, logit_positions))
+
+    target_logprobs, target_token_ids = [], []
+    for start in range(0, len(batch_idx), chunk_size):
+        chunk = logits[
+            batch_idx[start : start + chunk_size].to(device),
+            logit_idx[start : start + chunk_size].to(device),
+        ].float()
+        top_logits, top_ids = torch.topk(chunk / temperature, top_k, dim=-1)
+        # renormalized over the top-k, like the KD chat template strategy does
+        target_logprobs.append(
+            (top_logits - torch.logsumexp(top_logits, dim=-1, keepdim=True))
+            .half()
+            .cpu()
+        )
+        target_token_ids.append(top_ids.int().cpu())
+
+    bounds = np.cumsum([0] + [len(pos) for pos in positions])
+    all_logprobs = torch.cat(target_logprobs).numpy()
+    all_token_ids = torch.cat(target_token_ids).numpy()
+    return [
+        (pos, all_logprobs[start:end], all_token_ids[start:end])
+        for pos, start, end in zip(positions, bounds[:-1], bounds[1:])
+    ]
+
+
+def _write_shard(path: Path, results: List[tuple], top_k: int):
+    tmp_path = path.with_name(f"{path.name}.tmp-{os.getpid()}")
+    tmp_path.mkdir(parents=True)
+    try:
+        row_offsets = np.zeros(len(results) + 1, dtype=np.int64)
+        np.cumsum([len(pos) for pos, _, _ in results], out=row_offsets[1:])
+        arrays = {
+            "row_offsets": row_offsets,
+            "positions": np.concatenate(
+                [pos for pos, _, _ in results] + [np.zeros(0, dtype=np.int32)]
+            ),
+            "target_logprobs": np.concatenate(
+                [lp for _, lp, _ in results] + [np.zeros((0, top_k), np.float16)]
+            ),
+            "target_token_ids": np.concatenate(
+                [ids for _, _, ids in results] + [np.zeros((0, top_k), np.int32)]
+            ),
+        }
+        for name in SHARD_ARRAYS:
+            np.save(tmp_path / f"{name}.npy", arrays[name])
+    except BaseException:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+    # a shard only exists once it is complete, so generation resumes after it
+    os.rename(tmp_path, path)
+
+
+def generate_teacher_logprobs(
+    model,
+    dataset,
+    path: Union[str, os.PathLike],
+    top_k: int = 64,
+    temperature: float = 1.0,
+    batch_tokens: int = 16384,
+    shard_size: int = 10_000,
+    pad_token_id: int = 0,
+    teacher_name: Optional[str] = None,
+) -> Path:
+    """
+    Run `model` over `dataset` in batches of rows of similar length and store the
+    top-k logprobs of the teacher for every supervised position, renormalized over
+    the top-k at `temperature`. They are written to `path/<dataset fingerprint>` in
+    shards of `shard_size` rows, which are skipped when generating again, so an
+    interrupted run resumes with the first missing shard.
+    """
+    output_dir = Path(path) / dataset._fingerprint  # pylint: disable=protected-access
+    meta = {
+        "fingerprint": dataset._fingerprint,  # pylint: disable=protected-access
+        "num_rows": len(dataset),
+        "top_k": top_k,
+        "temperature": temperature,
+        "shard_size": shard_size,
+        "teacher": teacher_name,
+    }
+    if (output_dir / "meta.json").exists():
+        with open(output_dir / "meta.json", encoding="utf-8") as fin:
+            if (existing := json.load(fin)) != meta:
+                raise ValueError(
+                    f"teacher logprobs at {output_dir} were generated with {existing}, "
+                    f"not {meta}, remove them to generate them again"
+                )
+    else:
+        output_dir.mkdir(parents=True, exist_ok=True)
+        with open(output_dir / "meta.json", "w", encoding="utf-8") as fout:
+            json.dump(meta, fout)
+
+    model.eval()
+    lengths = np.asarray(get_dataset_lengths(dataset))
+    num_shards = (len(dataset) + shard_size - 1) // shard_size
+    for shard_idx in range(num_shards):
+        shard_path = output_dir / f"shard-{shard_idx:05d}"
+        if shard_path.exists():
+            continue
+        start = shard_idx * shard_size
+        end = min(start + shard_size, len(dataset))
+        LOG.info(
+            f"Generating teacher logprobs of rows {start} to {end} "
+            f"(shard {shard_idx + 1} of {num_shards})"
+        )
+        rows = [
+            expand_compact_row(row)
+            for row in dataset.__getitems__(list(range(start, end)))
+        ]
+        results: Dict[int, tuple] = {}
+        for bucket in _length_buckets(lengths[start:end], batch_tokens):
+            bucket_results = _teacher_targets(
+                model,
+                [rows[idx] for idx in bucket],
+                top_k,
+                temperature,
+                pad_token_id,
+            )
+            for idx, result in zip(bucket, bucket_results):
+                results[idx] = result
+        _write_shard(shard_path, [results[idx] for idx in range(len(rows))], top_k)
+    return output_dir
+
+
+class TeacherLogprobs:
+    """
+    Read-only teacher logprobs written by `generate_teacher_logprobs`, with the
+    shards memory-mapped.
+    """
+
+    def __init__(self, path: Union[str, os.PathLike]):
+        self.path = Path(path)
+        with open(self.path / "meta.json", encoding="utf-8") as fin:
+            self.meta = json.load(fin)
+        num_shards = (self.meta["num_rows"] + self.meta["shard_size"] - 1) // self.meta[
+            "shard_size"
+        ]
+        self._shards = []
+        for shard_idx in range(num_shards):
+            shard_path = self.path / f"shard-{shard_idx:05d}"
+            if not shard_path.exists():
+                raise FileNotFoundError(
+                    f"{shard_path} is missing, run `axolotl kd-generate` to resume"
+                )
+            self._shards.append(
+                {
+                    name: np.load(shard_path / f"{name}.npy", mmap_mode="r")
+                    for name in SHARD_ARRAYS
+                }
+            )
+
+    def __len__(self):
+        return self.meta["num_rows"]
+
+    def __getitem__(self, idx: int) -> Dict[str, np.ndarray]:
+        """the supervised positions of a row and their [num_positions, K] targets"""
+        shard = self._shards[idx // self.meta["shard_size"]]
+        local_idx = idx % self.meta["shard_size"]
+        start, end = shard["row_offsets"][local_idx : local_idx + 2]
+        return {
+            name: shard[name][start:end]
+            for name in ("positions", "target_logprobs", "target_token_ids")
+        }
+
+    def dense_targets(self, idx: int, seq_len: int) -> Dict[str, np.ndarray]:
+        """
+        the targets of a row as [seq_len, K] arrays, in the format of the KD chat
+        template strategy that the KD collators pad
+        """
+        row = self[idx]
+        top_k = self.meta["top_k"]
+        target_logprobs = np.full((seq_len, top_k), -np.inf, dtype=np.float16)
+        target_logprobs[row["positions"]] = row["target_logprobs"]
+        target_token_ids = np.zeros((seq_len, top_k), dtype=np.int32)
+        target_token_ids[row["positions"]] = row["target_token_ids"]
+        target_mask = np.zeros((seq_len, top_k), dtype=bool)
+        target_mask[row["positions"]] = True
+        return {
+            "target_logprobs": target_logprobs,
+            "target_token_ids": target_token_ids,
+            "target_mask": target_mask,
+        }
+
+
+def get_teacher_logprobs_path(cfg) -> Path:
+    """directory the teacher logprobs of the datasets of `cfg` are written to"""
+    # pylint: disable=import-outside-toplevel
+    from axolotl.common.const import DEFAULT_DATASET_PREPARED_PATH
+
+    return Path(
+        cfg.kd_teacher_logprobs_path
+        or Path(cfg.dataset_prepared_path or DEFAULT_DATASET_PREPARED_PATH)
+        / "kd_logprobs"
+    )
+
+
+def join_teacher_logprobs(
+    dataset, path: Union[str, os.PathLike]
+) -> Tuple[Any, TeacherLogprobs]:
+    """
+    Open the teacher logprobs generated for `dataset` under `path`, and add the
+    `TEACHER_ROW_IDX` column the KD collators fill in the targets of a row by.
+    """
+    fingerprint = dataset._fingerprint  # pylint: disable=protected-access
+    if not (Path(path) / fingerprint / "meta.json").exists():
+        raise FileNotFoundError(
+            f"no teacher logprobs of the dataset in {path}, "
+            "run `axolotl kd-generate` first"
+        )
+    logprobs = TeacherLogprobs(Path(path) / fingerprint)
+    if logprobs.meta["fingerprint"] != fingerprint or len(logprobs) != len(dataset):
+        raise ValueError(
+            f"teacher logprobs at {logprobs.path} were generated for another "
+            f"dataset, of fingerprint {logprobs.meta['fingerprint']} and "
+            f"{len(logprobs)} rows"
+        )
+    with_row_idx = dataset.add_column(
+        TEACHER_ROW_IDX, np.arange(len(dataset), dtype=np.int64)
+    )
+    carry_dataset_stats(with_row_idx, dataset)
+    return with_row_idx, logprobs
+
+
+def do_kd_generate(cfg, device: Optional[str] = None) -> None:
+    """
+    Generate the teacher logprobs of the prepared train and eval datasets of `cfg`
+    with `cfg.kd_teacher_model`.
+    """
+    # pylint: disable=import-outside-toplevel
+    from transformers import AutoModelForCausalLM
+
+    from axolotl.cli.args import TrainerCliArgs
+    from axolotl.common.datasets import load_datasets
+    from axolotl.utils.models import load_tokenizer
+
+    if not cfg.kd_teacher_model:
+        raise ValueError("kd_teacher_model must be set to generate teacher logprobs")
+    device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+
+    dataset_meta = load_datasets(cfg=cfg, cli_args=TrainerCliArgs())
+    tokenizer = load_tokenizer(cfg)
+    model = AutoModelForCausalLM.from_pretrained(
+        cfg.kd_teacher_model,
+        torch_dtype=(torch.bfloat16 if cfg.bf16 and device != "cpu" else torch.float32),
+        trust_remote_code=cfg.trust_remote_code or False,
+    ).to(device)
+
+    logprobs_path = get_teacher_logprobs_path(cfg)
+    for dataset in (dataset_meta.train_dataset, dataset_meta.eval_dataset):
+        if dataset is None:
+            continue
+        path = generate_teacher_logprobs(
+            model,
+            dataset,
+            logprobs_path,
+            top_k=cfg.kd_teacher_top_k or 64,
+            temperature=cfg.kd_temperature or 1.0,
+            batch_tokens=cfg.kd_teacher_batch_tokens or 16384,
+            shard_size=cfg.kd_teacher_shard_size or 10_000,
+            pad_token_id=tokenizer.pad_token_id or 0,
+            teacher_name=cfg.kd_teacher_model,
+        )
+        LOG.info(f"Teacher logprobs written to {path}")
@@ -0,0 +1,163 @@
+# Copyright 2024 Axolotl AI. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+top_k KL divergence computed over chunks of the sequence, so the float32 copy of
+the student logits is never materialized for the whole batch
+"""
+from typing import Any, Dict, List, Optional, Tuple
+
+import torch
+
+from .forward_kl import _kd_loss_sum
+
+
+class ChunkedTopKKDLoss(torch.autograd.Function):
+    """
+    Summed top_k forward KL over chunks of `chunk_size` positions. The backward pass
+    recomputes every chunk instead of keeping the activations of the forward pass,
+    so only one chunk of float32 logits is alive at a time.
+    """
+
+    @staticmethod
+    def forward(  # pylint: disable=arguments-differ
+        ctx,
+        student_logits: torch.Tensor,
+        target_token_ids: torch.Tensor,
+        target_logprobs: torch.Tensor,
+        target_mask: torch.Tensor,
+        chunk_size: int,
+        kd_temperature: float,
+        top_k_before_softmax: bool,
+        zscore_base_temp: Optional[float],
+    ) -> torch.Tensor:
+        loss_kwargs: Dict[str, Any] = {
+            "kd_temperature": kd_temperature,
+            "top_k_before_softmax": top_k_before_softmax,
+            "zscore_base_temp": zscore_base_temp,
+        }
+        chunks = _chunks_with_targets(target_mask, chunk_size)
+
+        loss_sum = torch.zeros((), dtype=torch.float32, device=student_logits.device)
+        for batch_idx, start, end in chunks:
+            loss_sum += _kd_loss_sum(
+                student_logits[batch_idx, start:end],
+                target_token_ids[batch_idx, start:end],
+                target_logprobs[batch_idx, start:end],
+                target_mask[batch_idx, start:end],
+                **loss_kwargs,
+            )
+
+        ctx.save_for_backward(
+            student_logits, target_token_ids, target_logprobs, target_mask
+        )
+        ctx.chunks = chunks
+        ctx.loss_kwargs = loss_kwargs
+        return loss_sum
+
+    @staticmethod
+    def backward(ctx, grad_output):  # pylint: disable=arguments-differ
+        (
+            student_logits,
+            target_token_ids,
+            target_logprobs,
+            target_mask,
+        ) = ctx.saved_tensors
+
+        grad_logits = torch.zeros_like(student_logits)
+        for batch_idx, start, end in ctx.chunks:
+            with torch.enable_grad():
+                logits_chunk = student_logits[batch_idx, start:end].detach()
+                logits_chunk.requires_grad_(True)
+                loss_sum = _kd_loss_sum(
+                    logits_chunk,
+                    target_token_ids[batch_idx, start:end],
+                    target_logprobs[batch_idx, start:end],
+                    target_mask[batch_idx, start:end],
+                    **ctx.loss_kwargs,
+                )
+                (grad_logits[batch_idx, start:end],) = torch.autograd.grad(
+                    loss_sum, logits_chunk, grad_outputs=grad_output
+                )
+
+        return grad_logits, None, None, None, None, None, None, None
+
+
+def _chunks_with_targets(
+    target_mask: torch.Tensor, chunk_size: int
+) -> List[Tuple[int, int, int]]:
+    """(batch index, start, end) of the chunks of the sequence with a valid target"""
+    # one device sync for the whole batch, chunks without targets add nothing
+    has_targets = target_mask.any(dim=-1).cpu()
+    batch_size, seq_len = has_targets.shape
+    return [
+        (batch_idx, start, min(start + chunk_size, seq_len))
+        for batch_idx in range(batch_size)
+        for start in range(0, seq_len, chunk_size)
+        if has_targets[batch_idx, start : start + chunk_size].any()
+    ]
+
+
+def chunked_topk_kd_loss(
+    student_logits: torch.Tensor,
+    target_token_ids: torch.Tensor,
+    target_logprobs: torch.Tensor,
+    target_mask: torch.Tensor,
+    num_items_in_batch: Optional[int] = -1,
+    kd_temperature: float = 1.0,
+    top_k_before_softmax: bool = False,
+    zscore_base_temp: Optional[float] = None,
+    chunk_size: int = 1024,
+) -> torch.Tensor:
+    """
+    The top_k KD loss of `loss`, or of `topk_kd_loss_with_zscore` when
+    `zscore_base_temp` is set, computed `chunk_size` positions at a time.
+
+    Arguments:
+        student_logits (torch.Tensor): The logits of the student model.
+            Shape: [B, student_seq_len, vocab_size]
+        target_token_ids (torch.Tensor): The top-k teacher/target token IDs
+            Shape: [B, teacher_seq_len, top_k]
+        target_logprobs (torch.Tensor): The top-k teacher/target logprobs, these should already be re-normalized.
+            Shape: [B, teacher_seq_len, top_k]
+        target_mask (torch.Tensor): The mask for valid tokens.
+            Shape: [B, teacher_seq_len, top_k] or [B, teacher_seq_len]
+        num_items_in_batch (int, optional): The number of items in the batch.
+        kd_temperature (float, optional): The temperature for KD.
+        top_k_before_softmax (bool, optional): Whether to apply softmax over the student top-k logits only.
+        zscore_base_temp (float, optional): The base temperature of the z-score variant.
+        chunk_size (int, optional): The number of positions per chunk.
+    """
+    if target_mask.dim() == 2:
+        target_mask = target_mask.unsqueeze(-1).expand_as(target_token_ids)
+
+    kd_loss = ChunkedTopKKDLoss.apply(
+        student_logits,
+        target_token_ids,
+        target_logprobs,
+        target_mask,
+        chunk_size,
+        kd_temperature,
+        bool(top_k_before_softmax),
+        zscore_base_temp,
+    )
+
+    # Multiply by T^2 (classical KD scaling)
+    if kd_temperature != 1.0:
+        kd_loss = kd_loss * (kd_temperature**2)
+
+    # Normalize by number of items (if provided) or by valid tokens
+    if num_items_in_batch is not None and num_items_in_batch > 0:
+        return kd_loss / float(num_items_in_batch)
+    return kd_loss / target_mask.bool().sum()
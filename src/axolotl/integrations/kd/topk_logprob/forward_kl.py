@@ -15,6 +15,8 @@
 """
 loss for top_k KL divergence
 """
+from typing import Optional
+
 import torch
 
 
@@ -52,6 +54,65 @@ def zscore_standardize(
     return z
 
 
+def _kd_loss_sum(
+    student_logits: torch.Tensor,
+    target_token_ids: torch.Tensor,
+    target_logprobs: torch.Tensor,
+    target_mask: torch.Tensor,
+    kd_temperature: float,
+    top_k_before_softmax: bool,
+    zscore_base_temp: Optional[float],
+) -> torch.Tensor:
+    """
+    The summed forward KL of the valid top-k targets, with the student logprobs
+    normalized over the top-k logits only, over their z-scores when
+    `zscore_base_temp` is set, or over the full vocabulary.
+
+    Shapes: student_logits [..., vocab_size], the targets [..., K]
+    """
+    target_logprobs = target_logprobs.float()
+    valid_mask = target_mask.to(torch.bool)
+
+    if zscore_base_temp is not None and zscore_base_temp != 0.0:
+        student_topk_logits = torch.gather(
+            student_logits, dim=-1, index=target_token_ids
+        ).float()
+        if kd_temperature != 1.0:
+            student_topk_logits = student_topk_logits / kd_temperature
+        teacher_z = zscore_standardize(
+            target_logprobs, mask=target_mask, base_temperature=zscore_base_temp
+        )
+        student_z = zscore_standardize(
+            student_topk_logits, mask=target_mask, base_temperature=zscore_base_temp
+        )
+        target_logprobs = teacher_z - torch.logsumexp(teacher_z, dim=-1, keepdim=True)
+        student_logprobs_topk = student_z - torch.logsumexp(
+            student_z, dim=-1, keepdim=True
+        )
+    elif top_k_before_softmax:
+        student_logits_topk = torch.gather(
+            student_logits, dim=-1, index=target_token_ids
+        ).float()
+        if kd_temperature != 1.0:
+            student_logits_topk = student_logits_topk / kd_temperature
+        student_logprobs_topk = student_logits_topk - torch.logsumexp(
+            student_logits_topk, dim=-1, keepdim=True
+        )
+    else:
+        # keep in full precision for numerical stability of loss
+        student_logits_for_kd = (student_logits / kd_temperature).float()
+        student_logits_topk = torch.gather(
+            student_logits_for_kd, dim=-1, index=target_token_ids
+        )
+        student_lse = torch.logsumexp(student_logits_for_kd, dim=-1, keepdim=True)
+        student_logprobs_topk = student_logits_topk - student_lse
+
+    student_logprobs_topk = student_logprobs_topk[valid_mask]
+    target_logprobs = target_logprobs[valid_mask]
+    teacher_probs = target_logprobs.exp()
+    return (teacher_probs * (target_logprobs - student_logprobs_topk)).sum()
+
+
 @torch.jit.script
 def loss(
     student_logits: torch.Tensor,
@@ -81,68 +142,17 @@ def loss(
             Default: 0
     """
 
-    target_logprobs = target_logprobs.float()
-
-    # Determine the teacher sequence length
-    # target_token_ids shape: [B, teacher_seq_len, K]
-    # student_logits shape:   [B, student_seq_len, vocab_size]
+    # Slice student logits to match teacher-provided sequence length
     teacher_seq_len = target_token_ids.shape[1]
-
-    if top_k_before_softmax:
-        # Slice student logits to match teacher-provided sequence length
-        student_logits_for_kd = student_logits[
-            :, :teacher_seq_len, :
-        ]  # [B, teacher_seq_len, vocab_size]
-
-        # Gather student logits for teacher's top-K tokens
-        student_logits_topk = torch.gather(
-            student_logits_for_kd, dim=-1, index=target_token_ids
-        )  # [B, teacher_seq_len, K]
-
-        student_logits_topk = student_logits_topk.float()
-
-        # Apply KD temperature to student’s logits
-        if kd_temperature != 1.0:
-            student_logits_topk = student_logits_topk / kd_temperature
-
-        # Convert student top-k logits to logprobs
-        student_logprobs_topk = student_logits_topk - torch.logsumexp(
-            student_logits_topk, dim=-1, keepdim=True
-        )  # [B, teacher_seq_len, K]
-    else:
-        # Slice student logits to match teacher-provided sequence length
-        student_logits_for_kd = (
-            student_logits[:, :teacher_seq_len, :] / kd_temperature
-        )  # [B, teacher_seq_len, vocab_size]
-
-        # keep in full precision for numerical stability of loss
-        student_logits_for_kd = student_logits_for_kd.float()
-
-        # Gather student logits for teacher's top-K tokens
-        student_logits_topk = torch.gather(
-            student_logits_for_kd, dim=-1, index=target_token_ids
-        )  # [B, teacher_seq_len, K]
-
-        # Compute logsumexp across full vocabulary
-        student_lse = torch.logsumexp(student_logits_for_kd, dim=-1, keepdim=True)
-
-        #  Convert just the top-k logits to logprobs
-        student_logprobs_topk = student_logits_topk - student_lse
-
-    # Convert teacher_mask to boolean for indexing
-    # In TorchScript, .bool() is sometimes unsupported, so we do:
-    valid_mask = target_mask.to(torch.bool)
-
-    # Prune tensors to only keep valid tokens
-    student_logprobs_topk = student_logprobs_topk[valid_mask]
-    target_logprobs = target_logprobs[valid_mask]
-
-    # Convert teacher logprobs to probabilities
-    teacher_probs = target_logprobs.exp()
-
-    # Compute forward KL
-    kd_loss_per_token = teacher_probs * (target_logprobs - student_logprobs_topk)
-    kd_loss = kd_loss_per_token.sum()
+    kd_loss = _kd_loss_sum(
+        student_logits[:, :teacher_seq_len, :],
+        target_token_ids,
+        target_logprobs,
+        target_mask,
+        kd_temperature,
+        bool(top_k_before_softmax),
+        None,
+    )
 
     # Multiply by T^2 (classical KD scaling)
     if kd_temperature != 1.0:
@@ -153,7 +163,7 @@ def loss(
         kd_loss = kd_loss / float(num_items_in_batch)
     else:
         # Fall back to average over valid tokens
-        kd_loss = kd_loss / float(kd_loss_per_token.size(0))
+        kd_loss = kd_loss / target_mask.to(torch.bool).sum()
 
     return kd_loss
 
@@ -172,54 +182,22 @@ def topk_kd_loss_with_zscore(
     from "Logit Standardization in Knowledge Distillation".
     """
 
-    target_logprobs = target_logprobs.float()
-
     B, teacher_seq_len, K = target_logprobs.shape  # pylint: disable=invalid-name
-    # 1) Gather the student's top-k logits to match teacher
-    student_logits_for_kd = student_logits[
-        :, :teacher_seq_len, :
-    ]  # [B, seq_len, vocab]
-    student_topk_logits = torch.gather(
-        student_logits_for_kd, dim=-1, index=target_token_ids
-    )  # [B, seq_len, K]
-
-    student_topk_logits = student_topk_logits.float()
-
-    # 2) If you want to keep the "classical" T scaling, apply it first
-    if kd_temperature != 1.0:
-        student_topk_logits = student_topk_logits / kd_temperature
-
-    # 3) Convert teacher logprobs -> treat them as “logits” for z-score
-    #    (They differ by +some_constant from real logits, but in z-score
-    #     that constant is subtracted out anyway.)
-    teacher_logits_for_zscore = target_logprobs  # rename variable for clarity
 
-    # 4) Z-score teacher and student
-    #    If target_mask is 2D, expand to 3D for the K dimension
+    # If target_mask is 2D, expand to 3D for the K dimension
     if target_mask.dim() == 2 and target_mask.shape[:2] == (B, teacher_seq_len):
         target_mask = target_mask.unsqueeze(-1).expand(-1, -1, K)
 
-    teacher_z = zscore_standardize(
-        teacher_logits_for_zscore, mask=target_mask, base_temperature=zscore_base_temp
+    # forward KL of the z-scored teacher logprobs and student top-k logits
+    kd_loss = _kd_loss_sum(
+        student_logits[:, :teacher_seq_len, :],
+        target_token_ids,
+        target_logprobs,
+        target_mask,
+        kd_temperature,
+        False,
+        zscore_base_temp,
     )
-    student_z = zscore_standardize(
-        student_topk_logits, mask=target_mask, base_temperature=zscore_base_temp
-    )
-
-    # 5) Convert to log-probs for KL
-    teacher_logprobs_z = teacher_z - torch.logsumexp(teacher_z, dim=-1, keepdim=True)
-    student_logprobs_z = student_z - torch.logsumexp(student_z, dim=-1, keepdim=True)
-
-    # 6) Restrict to valid tokens if needed
-    valid_mask = target_mask.bool()  # shape [B, seq_len, K]
-    teacher_probs_z = teacher_logprobs_z.exp()
-    teacher_probs_z = teacher_probs_z[valid_mask]
-    teacher_logprobs_z = teacher_logprobs_z[valid_mask]
-    student_logprobs_z = student_logprobs_z[valid_mask]
-
-    # 7) forward KL:  sum( p_teacher * [log(p_teacher) - log(p_student)] )
-    kd_loss_per_token = teacher_probs_z * (teacher_logprobs_z - student_logprobs_z)
-    kd_loss = kd_loss_per_token.sum()
 
     # 8) If using classical KD scaling by T^2
     if kd_temperature != 1.0:
@@ -232,6 +210,6 @@ def topk_kd_loss_with_zscore(
     if num_items_in_batch is not None and num_items_in_batch > 0:
         kd_loss = kd_loss / float(num_items_in_batch)
     else:
-        kd_loss = kd_loss / float(kd_loss_per_token.size(0))
+        kd_loss = kd_loss / target_mask.bool().sum()
 
     return kd_loss
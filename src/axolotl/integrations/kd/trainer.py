@@ -18,6 +18,8 @@ KD trainer
 
 from axolotl.core.trainers.base import AxolotlTrainer
 
+from .generate import TEACHER_ROW_IDX
+from .topk_logprob.chunked_forward_kl import chunked_topk_kd_loss
 from .topk_logprob.forward_kl import loss as topk_kd_loss
 from .topk_logprob.forward_kl import topk_kd_loss_with_zscore
 
@@ -37,6 +39,8 @@ class AxolotlKDTrainer(AxolotlTrainer):
                 columns_to_add.append("target_token_ids")
             if "target_mask" not in self._signature_columns:
                 columns_to_add.append("target_mask")
+            if TEACHER_ROW_IDX not in self._signature_columns:
+                columns_to_add.append(TEACHER_ROW_IDX)
             if columns_to_add:
                 self._signature_columns += columns_to_add
 
@@ -67,14 +71,27 @@ class AxolotlKDTrainer(AxolotlTrainer):
         outputs = model(**inputs)
 
         # FIXME: account for tokenizer.padding_side
-        student_logits = outputs["logits"][:, : seq_len - 1, :].contiguous()
+        student_logits = outputs["logits"][:, : seq_len - 1, :]
 
-        shift_logits = student_logits.contiguous()
         target_logprobs_for_loss = target_logprobs[..., 1:, :].contiguous()
         target_token_ids_for_loss = target_token_ids[..., 1:, :].contiguous()
         target_mask_for_loss = target_mask[..., 1:, :].contiguous()
 
-        if self.args.kd_zscore_base_temp:
+        if self.args.kd_loss_chunk_size:
+            # the chunks are views into the logits, so they aren't copied either
+            loss_kd = chunked_topk_kd_loss(
+                student_logits,
+                target_token_ids_for_loss,
+                target_logprobs_for_loss,
+                target_mask_for_loss,
+                num_items_in_batch=num_items_in_batch,
+                kd_temperature=self.args.kd_temperature,
+                top_k_before_softmax=bool(self.args.kd_top_k_before_softmax),
+                zscore_base_temp=self.args.kd_zscore_base_temp,
+                chunk_size=self.args.kd_loss_chunk_size,
+            )
+        elif self.args.kd_zscore_base_temp:
+            shift_logits = student_logits.contiguous()
             loss_kd = topk_kd_loss_with_zscore(
                 shift_logits,
                 target_token_ids_for_loss,
@@ -85,6 +102,7 @@ class AxolotlKDTrainer(AxolotlTrainer):
                 num_items_in_batch=num_items_in_batch,
             )
         else:
+            shift_logits = student_logits.contiguous()
             loss_kd = topk_kd_loss(
                 shift_logits,
                 target_token_ids_for_loss,
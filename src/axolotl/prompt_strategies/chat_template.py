@@ -2,10 +2,12 @@
 HF Chat Templates prompt strategy
 """
 
+import bisect
 import logging
 from collections import defaultdict
 from typing import Any, Dict, List, Optional, Set, Union
 
+from jinja2.exceptions import TemplateError
 from pydantic import BaseModel
 from transformers import ProcessorMixin
 
@@ -14,6 +16,7 @@ from axolotl.prompt_tokenizers import PromptTokenizingStrategy
 from axolotl.prompters import IGNORE_TOKEN_ID, Prompter
 from axolotl.utils.chat_templates import get_chat_template_from_config
 from axolotl.utils.config.models.input.v0_4_1 import DatasetConfig
+from axolotl.utils.tokenization import PrefixTokenCache
 
 # Configure the logger
 LOG = logging.getLogger("axolotl")
@@ -35,6 +38,7 @@ class ChatTemplatePrompter(Prompter):
         field_messages: str = "messages",
         roles: Optional[Dict[str, List[str]]] = None,
         drop_system_message: bool = False,
+        prefix_cache_size: Optional[int] = None,
     ):
         # check if message_property_mappings is None or empty dict
         if message_property_mappings is None or (not message_property_mappings):
@@ -67,6 +71,10 @@ class ChatTemplatePrompter(Prompter):
         self.chat_template = chat_template
         self.max_length = max_length
         self.drop_system_message = drop_system_message
+        self.prefix_cache: Optional[PrefixTokenCache] = None
+        if prefix_cache_size and not processor:
+            self.prefix_cache = PrefixTokenCache(tokenizer, maxsize=prefix_cache_size)
+        self._renders_system_prefix = True
 
     @property
     def chat_template_msg_variables(self) -> Set[str]:
@@ -96,12 +104,51 @@ class ChatTemplatePrompter(Prompter):
                     batch[k] = val.squeeze().tolist()
             return batch
 
+        if self.prefix_cache is not None:
+            return self.tokenize_rendered(
+                [self.render_prompt(conversation, add_generation_prompt)],
+                [conversation],
+            )[0]
+
+        return self.tokenizer.apply_chat_template(
+            conversation,
+            add_generation_prompt=add_generation_prompt,
+            chat_template=self.chat_template,
+        )
+
+    def render_prompt(self, conversation, add_generation_prompt=False) -> str:
         return self.tokenizer.apply_chat_template(
             conversation,
             add_generation_prompt=add_generation_prompt,
             chat_template=self.chat_template,
+            tokenize=False,
         )
 
+    def tokenize_rendered(
+        self, texts: List[str], conversations: List[list[dict]]
+    ) -> List[List[int]]:
+        """Tokenize the rendered `texts` of `conversations` like `build_prompt`"""
+        if self.prefix_cache is None:
+            return self.tokenizer(texts, add_special_tokens=False)["input_ids"]
+        return self.prefix_cache(
+            texts, [self.render_system_prefix(turns) for turns in conversations]
+        )
+
+    def render_system_prefix(self, conversation: list[dict]) -> Optional[str]:
+        """The rendered system message a conversation starts with, if any"""
+        if (
+            len(conversation) < 2
+            or conversation[0].get("role") != "system"
+            or not self._renders_system_prefix
+        ):
+            return None
+        try:
+            return self.render_prompt(conversation[:1])
+        except TemplateError:
+            # e.g. templates requiring a user turn after the system message
+            self._renders_system_prefix = False
+            return None
+
     def get_offsets_for_train_detail(
         self, text: str, train_details: List[Dict], mask_untrainable: bool = True
     ) -> List[int]:
@@ -224,6 +271,7 @@ class ChatTemplateStrategy(PromptTokenizingStrategy):
         sequence_len,
         roles_to_train=None,
         train_on_eos=None,
+        turn_boundaries=None,
     ):
         super().__init__(prompter, tokenizer, train_on_inputs, sequence_len)
         self.prompter: ChatTemplatePrompter = prompter
@@ -236,6 +284,7 @@ class ChatTemplateStrategy(PromptTokenizingStrategy):
             ]
 
         self.train_on_eos = train_on_eos
+        self.turn_boundaries = turn_boundaries or "diff"
         self.images = "images"
 
         LOG.debug(
@@ -247,32 +296,30 @@ class ChatTemplateStrategy(PromptTokenizingStrategy):
         # Let calling code know we can handle lists of examples
         return True
 
-    def is_prompt_batched(self, prompt: dict[str, Any]) -> bool:
-        try:
-            return all(isinstance(v, list) for v in prompt.values()) and all(
-                isinstance(v, list) for v in prompt[self.prompter.field_messages]
-            )
-        except KeyError:
-            return False
-
     def tokenize_prompt(self, prompt: dict[str, Any]):
         """
-        Public method that can handle either a single prompt or a batch of prompts.
+        Public method that tokenizes a single prompt.
         """
+        return self._tokenize_single_prompt(prompt)
 
-        if not self.is_prompt_batched(prompt) or not self.supports_batched:
-            return self._tokenize_single_prompt(prompt)
-
+    def tokenize_prompts(self, prompts: dict[str, Any]):
+        """
+        Public method that tokenizes a batch of prompts given column-wise.
+        """
         res = defaultdict(lambda: [])
-        feature_names = list(prompt.keys())
+        feature_names = list(prompts.keys())
+        rows = [dict(zip(feature_names, row)) for row in zip(*prompts.values())]
 
-        # Process each prompt individually
-        for row in zip(*prompt.values()):
-            tokenized_prompt = self._tokenize_single_prompt(
-                dict(zip(feature_names, row))
-            )
+        if self.prompter.processor:
+            # Process each prompt individually
+            tokenized_prompts = [self._tokenize_single_prompt(row) for row in rows]
+        else:
+            tokenized_prompts = self._tokenize_batch(rows)
+
+        for tokenized_prompt in tokenized_prompts:
             for key, val in tokenized_prompt.items():
                 res[key].append(val)
+        self._flush_prefix_cache_stats()
 
         # If there are no examples left, return an empty dictionary
         if not res:
@@ -280,14 +327,127 @@ class ChatTemplateStrategy(PromptTokenizingStrategy):
 
         return dict(res)
 
-    def _tokenize_single_prompt(self, prompt: dict) -> Dict[str, List[int]]:
-        # Old simple legacy behavior that works reliably.
-        if (
+    def _flush_prefix_cache_stats(self):
+        if self.prompter.prefix_cache is not None:  # type: ignore
+            self.prompter.prefix_cache.flush_stats()  # type: ignore
+
+    def _tokenize_batch(self, rows: list[dict]) -> list[Dict[str, List[int]]]:
+        """
+        Tokenize a batch of conversations, rendering all of them first and tokenizing
+        the rendered text with a single call to the tokenizer.
+        """
+        threads = [self.get_conversation_thread(row) for row in rows]
+
+        if self._uses_legacy_labels():
+            prompt_ids = self.prompter.tokenize_rendered(  # type: ignore
+                [
+                    self.prompter.render_prompt(  # type: ignore
+                        turns[:-1], add_generation_prompt=True
+                    )
+                    for turns in threads
+                ],
+                [turns[:-1] for turns in threads],
+            )
+            full_ids = self.prompter.tokenize_rendered(  # type: ignore
+                [self.prompter.render_prompt(turns) for turns in threads],  # type: ignore
+                threads,
+            )
+            legacy_results = []
+            for user_ids, ids in zip(prompt_ids, full_ids):
+                input_ids = user_ids + ids[len(user_ids) :]
+                labels = input_ids
+                if not self.train_on_inputs:
+                    labels = [IGNORE_TOKEN_ID] * len(user_ids) + input_ids[
+                        len(user_ids) :
+                    ]
+                legacy_results.append(
+                    {
+                        "input_ids": input_ids,
+                        "attention_mask": [1] * len(input_ids),
+                        "labels": labels,
+                    }
+                )
+            return legacy_results
+
+        results: Dict[int, Dict[str, List[int]]] = {}
+        rendered = {}
+        if self.turn_boundaries == "offsets":
+            for idx, turns in enumerate(threads):
+                found = self._render_with_content_spans(turns)
+                if found is not None:
+                    rendered[idx] = found
+        if rendered:
+            encodings = self.tokenizer(
+                [text for text, _ in rendered.values()],
+                add_special_tokens=False,
+                return_offsets_mapping=True,
+            )
+            for (idx, (_, char_spans)), input_ids, offsets in zip(
+                rendered.items(),
+                encodings["input_ids"],
+                encodings["offset_mapping"],
+            ):
+                turn_spans = self._token_spans(threads[idx], offsets, char_spans)
+                results[idx] = self._label_turns(threads[idx], input_ids, turn_spans)
+
+        remaining = [idx for idx in range(len(threads)) if idx not in results]
+        if remaining:
+            results.update(
+                zip(
+                    remaining,
+                    self._tokenize_by_turn_diffs([threads[idx] for idx in remaining]),
+                )
+            )
+
+        return [results[idx] for idx in range(len(threads))]
+
+    def _tokenize_by_turn_diffs(
+        self, threads: list[list[dict]]
+    ) -> list[Dict[str, List[int]]]:
+        """
+        Tokenize conversations and locate their turns the way `find_turn` does, with
+        every conversation prefix it compares tokenized in a single call.
+        """
+        texts = []
+        conversations = []
+        for turns in threads:
+            texts.append(self.prompter.render_prompt(turns))  # type: ignore
+            conversations.append(turns)
+            for turn_idx in range(len(turns)):
+                if self._is_unrendered_system_turn(turns, turn_idx):
+                    continue
+                for conversation in self._turn_prefixes(turns, turn_idx):
+                    texts.append(self.prompter.render_prompt(conversation))  # type: ignore
+                    conversations.append(conversation)
+
+        tokenized = iter(
+            self.prompter.tokenize_rendered(texts, conversations)  # type: ignore
+        )
+        results = []
+        for turns in threads:
+            input_ids = next(tokenized)
+            turn_spans = []
+            for turn_idx in range(len(turns)):
+                if self._is_unrendered_system_turn(turns, turn_idx):
+                    turn_spans.append((-1, -1))
+                    continue
+                dummy_ids, full_ids = next(tokenized), next(tokenized)
+                turn_spans.append(self._diff_turn_bounds(dummy_ids, full_ids, turn_idx))
+            results.append(self._label_turns(turns, input_ids, turn_spans))
+
+        return results
+
+    def _uses_legacy_labels(self) -> bool:
+        return (
             not self.roles_to_train
             and not self.train_on_eos
             and not self.prompter.message_field_training  # type: ignore
             and not self.prompter.message_field_training_detail  # type: ignore
-        ):
+        )
+
+    def _tokenize_single_prompt(self, prompt: dict) -> Dict[str, List[int]]:
+        # Old simple legacy behavior that works reliably.
+        if self._uses_legacy_labels():
             turns = self.get_conversation_thread(prompt)
             images = self.get_images(prompt)
             prompt_ids = self.prompter.build_prompt(  # type: ignore
@@ -316,7 +476,23 @@ class ChatTemplateStrategy(PromptTokenizingStrategy):
             return tokenized_prompt
 
         turns = self.get_conversation_thread(prompt)
-        input_ids = self.prompter.build_prompt(turns)  # type: ignore
+        turn_spans = None
+        if self.turn_boundaries == "offsets":
+            input_ids, turn_spans = self.find_turns_by_offsets(turns)
+        if turn_spans is None:
+            input_ids = self.prompter.build_prompt(turns)  # type: ignore
+        return self._label_turns(turns, input_ids, turn_spans)
+
+    def _label_turns(
+        self,
+        turns: list[dict],
+        input_ids: List[int],
+        turn_spans: Optional[list[tuple[int, int]]] = None,
+    ) -> Dict[str, List[int]]:
+        """
+        Labels for the trainable turns of a tokenized conversation. Turns are located
+        with `turn_spans` when given, else by re-rendering them with `find_turn`.
+        """
         labels = [IGNORE_TOKEN_ID] * len(input_ids)
 
         last_eos_idx = -1
@@ -340,14 +516,19 @@ class ChatTemplateStrategy(PromptTokenizingStrategy):
 
             LOG.debug(f"Should train: {should_train}")
 
-            turn_start_idx, turn_end_idx = self.find_turn(turns=turns, turn_idx=index)
+            if turn_spans is not None:
+                turn_start_idx, turn_end_idx = turn_spans[index]
+            else:
+                turn_start_idx, turn_end_idx = self.find_turn(
+                    turns=turns, turn_idx=index
+                )
 
             LOG.debug(f"Turn indices: start={turn_start_idx}, end={turn_end_idx}")
 
             if should_train and turn_start_idx != -1 and turn_end_idx != -1:
                 if train_detail:
                     token_offsets = self.prompter.get_offsets_for_train_detail(  # type: ignore
-                        content, train_detail
+                        content, train_detail  # type: ignore[arg-type]
                     )
                     LOG.debug(f"Token offsets: {token_offsets}")
                     for i, offset in enumerate(token_offsets):
@@ -402,31 +583,25 @@ class ChatTemplateStrategy(PromptTokenizingStrategy):
                 return i
         return -1
 
+    def _is_unrendered_system_turn(self, turns: list[dict], turn_idx: int) -> bool:
+        # mistral does not output message if it contains only system message
+        return (
+            turn_idx == 0
+            and turns[0].get("role") == "system"
+            and "mistral" in self.tokenizer.name_or_path.lower()
+        )
+
     def find_turn(self, turns: list[dict], turn_idx: int):
         """
         Locate the starting and ending indices of the specified turn in a conversation.
         """
-        # pylint: disable=too-many-return-statements
-
         if turn_idx >= len(turns):
             raise ValueError(f"Turn index {turn_idx} out of range")
 
-        # mistral does not output message if it contains only system message
-        if (
-            turn_idx == 0
-            and turns[0].get("role") == "system"
-            and "mistral" in self.tokenizer.name_or_path.lower()
-        ):
+        if self._is_unrendered_system_turn(turns, turn_idx):
             return -1, -1
 
-        empty_turn = {
-            "role": turns[turn_idx].get("role"),
-            "content": "[[dummy_message]]",
-        }
-
-        # Create conversation versions
-        turns_with_empty = turns[:turn_idx] + [empty_turn]
-        turns_with_content = turns[: turn_idx + 1]
+        turns_with_empty, turns_with_content = self._turn_prefixes(turns, turn_idx)
 
         # Generate the conversation up to the turn, with final turn replaced with dummy content
         dummy_ids = self.prompter.build_prompt(turns_with_empty)  # type: ignore
@@ -434,6 +609,29 @@ class ChatTemplateStrategy(PromptTokenizingStrategy):
         # Generate the conversation up to the turn, with final turn included
         full_ids = self.prompter.build_prompt(turns_with_content)  # type: ignore
 
+        return self._diff_turn_bounds(dummy_ids, full_ids, turn_idx)
+
+    def _turn_prefixes(
+        self, turns: list[dict], turn_idx: int
+    ) -> tuple[list[dict], list[dict]]:
+        """
+        The conversation up to a turn, with the turn's content replaced by a dummy
+        message and as is
+        """
+        empty_turn = {
+            "role": turns[turn_idx].get("role"),
+            "content": "[[dummy_message]]",
+        }
+        return turns[:turn_idx] + [empty_turn], turns[: turn_idx + 1]
+
+    def _diff_turn_bounds(
+        self, dummy_ids: List[int], full_ids: List[int], turn_idx: int
+    ) -> tuple[int, int]:
+        """
+        The token span where the renders of a turn with and without its content differ
+        """
+        # pylint: disable=too-many-return-statements
+
         if not full_ids or not dummy_ids:
             LOG.warning(f"Empty template generated for turn {turn_idx}")
             return -1, -1
@@ -482,6 +680,107 @@ class ChatTemplateStrategy(PromptTokenizingStrategy):
 
         return start_idx, end_idx
 
+    def find_turns_by_offsets(self, turns: list[dict]):
+        """
+        Locate the content tokens of every turn from a single tokenization of the
+        conversation. The conversation is rendered once as is and once with every
+        content replaced by a placeholder; the template text around the placeholders
+        gives the character span of each content, which the offset mapping turns
+        into token indices. Returns `(input_ids, spans)`, or `(None, None)` when the
+        template output depends on the content and the turns have to be found by
+        re-rendering instead.
+        """
+        rendered = self._render_with_content_spans(turns)
+        if rendered is None:
+            return None, None
+        text, char_spans = rendered
+        encoding = self.tokenizer(
+            text, add_special_tokens=False, return_offsets_mapping=True
+        )
+        return encoding["input_ids"], self._token_spans(
+            turns, encoding["offset_mapping"], char_spans
+        )
+
+    def _render_with_content_spans(self, turns: list[dict]):
+        """
+        The rendered conversation and the character span of every turn's content,
+        or None when they can't be told apart from a single render
+        """
+        if self.prompter.processor or not self.tokenizer.is_fast:
+            return None
+        if not all(isinstance(turn.get("content", ""), str) for turn in turns):
+            return None
+
+        placeholders = [f"[[axolotl_turn_{idx}]]" for idx in range(len(turns))]
+        text = self.prompter.render_prompt(turns)
+        template = self.prompter.render_prompt(
+            [
+                {**turn, "content": placeholder}
+                for turn, placeholder in zip(turns, placeholders)
+            ]
+        )
+
+        # many templates trim the content, e.g. `message['content'] | trim`
+        for contents in (
+            [turn.get("content", "") for turn in turns],
+            [turn.get("content", "").strip() for turn in turns],
+        ):
+            char_spans = self._find_content_spans(
+                text, template, placeholders, contents
+            )
+            if char_spans is not None:
+                return text, char_spans
+        return None
+
+    def _token_spans(
+        self,
+        turns: list[dict],
+        offset_mapping: list[tuple[int, int]],
+        char_spans: list[Optional[tuple[int, int]]],
+    ) -> list[tuple[int, int]]:
+        token_starts = [start for start, _ in offset_mapping]
+        token_ends = [end for _, end in offset_mapping]
+
+        spans = []
+        for idx, char_span in enumerate(char_spans):
+            if char_span is None or self._is_unrendered_system_turn(turns, idx):
+                spans.append((-1, -1))
+                continue
+            # every token overlapping the content
+            start_idx = bisect.bisect_right(token_ends, char_span[0])
+            end_idx = bisect.bisect_left(token_starts, char_span[1])
+            spans.append((start_idx, end_idx) if start_idx < end_idx else (-1, -1))
+        return spans
+
+    @staticmethod
+    def _find_content_spans(
+        text: str, template: str, placeholders: list[str], contents: list[str]
+    ) -> Optional[list[Optional[tuple[int, int]]]]:
+        """
+        Character span of every content in `text`, which has to equal `template`
+        with each placeholder replaced by its content
+        """
+        char_spans: list[Optional[tuple[int, int]]] = []
+        rebuilt = []
+        rebuilt_len = 0
+        cursor = 0
+        for placeholder, content in zip(placeholders, contents):
+            found = template.find(placeholder, cursor)
+            if found == -1:
+                # the template does not render this turn
+                char_spans.append(None)
+                continue
+            rebuilt.append(template[cursor:found])
+            rebuilt_len += found - cursor
+            char_spans.append((rebuilt_len, rebuilt_len + len(content)))
+            rebuilt.append(content)
+            rebuilt_len += len(content)
+            cursor = found + len(placeholder)
+        rebuilt.append(template[cursor:])
+        if "".join(rebuilt) != text:
+            return None
+        return char_spans
+
     def get_conversation_thread(self, prompt):
         turns = []
         for message in prompt[self.prompter.field_messages]:
@@ -551,6 +850,7 @@ class StrategyLoader:
             "sequence_len": cfg.sequence_len,
             "roles_to_train": ds_cfg.get("roles_to_train", ["assistant"]),
             "train_on_eos": ds_cfg.get("train_on_eos", "turn"),
+            "turn_boundaries": ds_cfg.get("turn_boundaries"),
         }
 
     def __call__(
@@ -588,6 +888,7 @@ class StrategyLoader:
             "field_messages": dataset_config.get("field_messages", "messages"),
             "roles": dataset_config.get("roles"),
             "drop_system_message": dataset_config.get("drop_system_message", False),
+            "prefix_cache_size": dataset_config.get("prefix_cache_size"),
             # we need to add one for detecting sequences with exceeding the `sequence_len` limit.
             "max_length": cfg.sequence_len + 1,
             "processor": processor,
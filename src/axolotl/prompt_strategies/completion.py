@@ -19,10 +19,6 @@ class CompletionPromptTokenizingStrategy(InstructionPromptTokenizingStrategy):
         if max_length is not None:
             self.max_length = max_length
 
-    @property
-    def supports_batched(self):
-        return True
-
     @property
     def field(self) -> str:
         return self._field
@@ -39,9 +35,22 @@ class CompletionPromptTokenizingStrategy(InstructionPromptTokenizingStrategy):
         )
 
     def tokenize_prompt(self, prompt):
+        """
+        Tokenize a single row. Only a batched map can split the text into
+        `sequence_len` chunks, since that changes the number of rows.
+        """
+        (
+            instruction,
+            _,
+            _,
+        ) = self.parse_instruction_fields(prompt)
+        return dict(self._tokenize(self._build_full_prompt(instruction, None, None)))
+
+    def tokenize_prompts(self, prompts):
         res = defaultdict(lambda: [])
-        feature_names = list(prompt.keys())
-        for row in zip(*prompt.values()):
+        feature_names = list(prompts.keys())
+        full_prompts = []
+        for row in zip(*prompts.values()):
             prompt_row = dict(zip(feature_names, row))
             (
                 instruction,
@@ -49,9 +58,9 @@ class CompletionPromptTokenizingStrategy(InstructionPromptTokenizingStrategy):
                 _,
             ) = self.parse_instruction_fields(prompt_row)
 
-            full_prompt = self._build_full_prompt(instruction, None, None)
-            tokenized_full_prompt = self._tokenize(full_prompt)
+            full_prompts.append(self._build_full_prompt(instruction, None, None))
 
+        for tokenized_full_prompt in self._tokenize_prompts(full_prompts):
             for key, val in tokenized_full_prompt.items():
                 for i in range(0, len(val), self.sequence_len):
                     res[key].append(val[i : i + self.sequence_len])
@@ -1,7 +1,7 @@
 """Module containing the MetharmenPromptTokenizingStrategy and MetharmePrompter class"""
 
 import logging
-from typing import Tuple
+from typing import List, Tuple
 
 from axolotl.prompt_tokenizers import InstructionPromptTokenizingStrategy
 from axolotl.prompters import AlpacaPrompter
@@ -54,6 +54,19 @@ class MetharmePromptTokenizingStrategy(InstructionPromptTokenizingStrategy):
         result["labels"] = result["input_ids"].copy()
         return result
 
+    def _tokenize_prompts(
+        self,
+        prompts: List[str],
+        add_eos_token: bool = True,
+        strip_bos_token: bool = False,
+    ):
+        return [
+            self._tokenize(
+                prompt, add_eos_token=add_eos_token, strip_bos_token=strip_bos_token
+            )
+            for prompt in prompts
+        ]
+
 
 class MetharmePrompter(AlpacaPrompter):
     """
@@ -2,8 +2,10 @@
 
 import abc
 import logging
+from itertools import chain
 from typing import Callable, Dict, List, Optional, Tuple, Union
 
+import numpy as np
 from transformers import BatchEncoding, PreTrainedTokenizer
 
 from axolotl.prompters import Prompter
@@ -55,6 +57,13 @@ class PromptTokenizingStrategy(abc.ABC):
     def tokenize_prompt(self, prompt):
         pass
 
+    def tokenize_prompts(self, prompts: Dict[str, List]) -> Dict[str, List]:
+        """
+        Tokenize a batch of rows given column-wise, as a `batched=True` map passes
+        them to strategies that `supports_batched`
+        """
+        return self.tokenize_prompt(prompts)
+
     @property
     def supports_batched(self):
         return False
@@ -62,36 +71,64 @@ class PromptTokenizingStrategy(abc.ABC):
     def _tokenize(
         self, prompt: str, add_eos_token: bool = True, strip_bos_token: bool = False
     ) -> BatchEncoding:
-        empty = BatchEncoding(data={"input_ids": [], "attention_mask": []})
-        if not prompt:
+        return BatchEncoding(
+            data=self._tokenize_prompts(
+                [prompt], add_eos_token=add_eos_token, strip_bos_token=strip_bos_token
+            )[0]
+        )
+
+    def _tokenize_prompts(
+        self,
+        prompts: List[str],
+        add_eos_token: bool = True,
+        strip_bos_token: bool = False,
+    ) -> List[Dict[str, List[int]]]:
+        """
+        `_tokenize` every prompt with a single call to the tokenizer, so a fast
+        tokenizer encodes the batch in parallel
+        """
+        results: List[Dict[str, List[int]]] = [
+            {"input_ids": [], "attention_mask": []} for _ in prompts
+        ]
+        non_empty = [idx for idx, prompt in enumerate(prompts) if prompt]
+        if len(non_empty) < len(prompts):
             LOG.warning("Empty text requested for tokenization.")
-            return empty
+        if not non_empty:
+            return results
 
-        result = self.tokenizer(
-            prompt,
+        encoded = self.tokenizer(
+            [prompts[idx] for idx in non_empty],
             truncation=True,
             max_length=self.max_length,
             padding=False,
             return_tensors=None,
         )
-        if len(result["input_ids"]) == 0:
-            LOG.warning("Tokenizer result is empty. You may want to audit your dataset")
-            return empty
+        for pos, idx in enumerate(non_empty):
+            result = {key: value[pos] for key, value in encoded.items()}
+            if len(result["input_ids"]) == 0:
+                LOG.warning(
+                    "Tokenizer result is empty. You may want to audit your dataset"
+                )
+                continue
 
-        if (
-            result["input_ids"][-1] != self.tokenizer.eos_token_id
-            and len(result["input_ids"]) < self.max_length
-            and add_eos_token
-        ):
-            result["input_ids"].append(self.tokenizer.eos_token_id)
-            result["attention_mask"].append(1)
+            if (
+                result["input_ids"][-1] != self.tokenizer.eos_token_id
+                and len(result["input_ids"]) < self.max_length
+                and add_eos_token
+            ):
+                result["input_ids"].append(self.tokenizer.eos_token_id)
+                result["attention_mask"].append(1)
 
-        if result["input_ids"][0] == self.tokenizer.bos_token_id and strip_bos_token:
-            result["input_ids"] = result["input_ids"][1:]
-            result["attention_mask"] = result["attention_mask"][1:]
+            if (
+                result["input_ids"][0] == self.tokenizer.bos_token_id
+                and strip_bos_token
+            ):
+                result["input_ids"] = result["input_ids"][1:]
+                result["attention_mask"] = result["attention_mask"][1:]
 
-        result["labels"] = result["input_ids"].copy()
-        return result
+            result["labels"] = result["input_ids"].copy()
+            results[idx] = result
+        return results
 
 
 class InstructionPromptTokenizingStrategy(PromptTokenizingStrategy):
@@ -104,33 +141,83 @@ class InstructionPromptTokenizingStrategy(PromptTokenizingStrategy):
     ) -> Union[Tuple[str, str, str], Tuple[str, str, str, str]]:
         raise NotImplementedError
 
+    @property
+    def supports_batched(self):
+        return True
+
     def tokenize_prompt(self, prompt):
-        (
-            instruction,
-            input,  # pylint: disable=redefined-builtin
-            response,
-        ) = self.parse_instruction_fields(prompt)
-        user_prompt = next(
-            iter(
-                self.prompter.build_prompt(
-                    instruction,
-                    input,
+        tokenized = self._tokenize_rows([prompt])
+        return {key: value[0] for key, value in tokenized.items()}
+
+    def tokenize_prompts(self, prompts):
+        feature_names = list(prompts.keys())
+        return self._tokenize_rows(
+            [dict(zip(feature_names, row)) for row in zip(*prompts.values())]
+        )
+
+    def _tokenize_rows(self, rows: List[Dict]) -> Dict[str, List[List[int]]]:
+        if not rows:
+            return {"input_ids": [], "attention_mask": [], "labels": []}
+
+        user_prompts, responses = [], []
+        for row in rows:
+            (
+                instruction,
+                input,  # pylint: disable=redefined-builtin
+                response,
+            ) = self.parse_instruction_fields(
+                row
+            )  # type: ignore[misc]
+            user_prompts.append(
+                next(
+                    iter(
+                        self.prompter.build_prompt(  # type: ignore[attr-defined]
+                            instruction,
+                            input,
+                        )
+                    )
                 )
             )
+            responses.append(response)
+
+        tokenized_user_prompts = self._tokenize_prompts(
+            user_prompts, add_eos_token=False
         )
-        tokenized_prompt = self._tokenize(user_prompt, add_eos_token=False)
-        if not self.train_on_inputs:
-            user_prompt_len = len(tokenized_prompt["input_ids"])
-            # TODO this could be sped up using numpy array slicing
-            tokenized_prompt["labels"] = [IGNORE_INDEX] * user_prompt_len
-        tokenized_res_prompt = self._tokenize(
-            response, strip_bos_token=True, add_eos_token=True
+        tokenized_responses = self._tokenize_prompts(
+            responses, strip_bos_token=True, add_eos_token=True
         )
-        tokenized_prompt["input_ids"] += tokenized_res_prompt["input_ids"]
-        tokenized_prompt["attention_mask"] += tokenized_res_prompt["attention_mask"]
-        tokenized_prompt["labels"] += tokenized_res_prompt["input_ids"]
 
-        return tokenized_prompt
+        # every row is its user prompt segment followed by its response segment, so
+        # the user prompts are masked from the segment offsets of the whole batch
+        segments = [
+            tokenized[pos]
+            for pos in range(len(rows))
+            for tokenized in (tokenized_user_prompts, tokenized_responses)
+        ]
+        lengths = np.array([len(segment["input_ids"]) for segment in segments])
+        row_ends = np.cumsum(lengths[0::2] + lengths[1::2])[:-1]
+
+        def flatten(key: str) -> np.ndarray:
+            return np.fromiter(
+                chain.from_iterable(segment[key] for segment in segments),
+                dtype=np.int64,
+                count=int(lengths.sum()),
+            )
+
+        def split_rows(flat: np.ndarray) -> List[List[int]]:
+            return [row.tolist() for row in np.split(flat, row_ends)]
+
+        input_ids = flatten("input_ids")
+        labels = input_ids.copy()
+        if not self.train_on_inputs:
+            is_user_prompt = np.arange(len(segments)) % 2 == 0
+            labels[np.repeat(is_user_prompt, lengths)] = IGNORE_INDEX
+
+        return {
+            "input_ids": split_rows(input_ids),
+            "attention_mask": split_rows(flatten("attention_mask")),
+            "labels": split_rows(labels),
+        }
 
     def _build_full_prompt(
         self, instruction, input, response  # pylint: disable=redefined-builtin
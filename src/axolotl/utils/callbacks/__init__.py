@@ -16,7 +16,6 @@ import pandas as pd
 import torch
 import torch.distributed as dist
 import wandb
-from datasets import load_dataset
 from optimum.bettertransformer import BetterTransformer
 from tqdm import tqdm
 from transformers import (
@@ -160,6 +159,9 @@ class LossWatchDogCallback(TrainerCallback):
 
 
 def bench_eval_callback_factory(trainer, tokenizer):
+    # axolotl.utils.data imports the trainer builder, which imports this module
+    from axolotl.utils.data.shared import load_bench_dataset
+
     accuracy = evaluate.load("accuracy")
     abcd_idx = [
         tokenizer("A", add_special_tokens=False).input_ids[0],
@@ -172,53 +174,7 @@ def bench_eval_callback_factory(trainer, tokenizer):
     ]
     bench_split = "eval"
 
-    def transform_bench_subject(example):
-        # Split on ':' and trim whitespace
-        parts = example["subject"].split(":")
-        first_part = (
-            parts[0].strip().lower().replace("-", "_")
-        )  # Lowercase the first part
-        second_part = (
-            parts[1].strip().replace("-", "_") if len(parts) > 1 else "all"
-        )  # Replace hyphens with underscores
-
-        # Return the transformed values
-        return {"name": first_part, "subject": second_part}
-
-    if trainer.args.bench_dataset == "mmlu-zs":
-        bench_dataset = load_dataset(
-            "openaccess-ai-collective/mmlu-evals",
-            data_files={
-                "eval": "zero_shot_mmlu_val.json",
-                "test": "zero_shot_mmlu_test.json",
-            },
-        )
-        # bench_dataset = bench_dataset.remove_columns("subject")
-    # MMLU Five-shot (Eval/Test only)
-    elif trainer.args.bench_dataset in ["mmlu", "mmlu-fs"]:
-        bench_dataset = load_dataset(
-            "openaccess-ai-collective/mmlu-evals",
-            data_files={
-                "eval": "five_shot_mmlu_val.json",
-                "test": "five_shot_mmlu_test.json",
-            },
-        )
-        # bench_dataset = bench_dataset.remove_columns('subject')
-    elif "/" in trainer.args.bench_dataset:
-        bench_ds = trainer.args.bench_dataset
-        bench_ds_name = "/".join(bench_ds.split("/", 2)[:2])
-        bench_ds_data_file = "/".join(bench_ds.split("/", 2)[2:])
-        bench_dataset = load_dataset(
-            bench_ds_name,
-            data_files={
-                "eval": bench_ds_data_file,
-            },
-        )
-        bench_dataset["eval"] = bench_dataset["eval"].map(transform_bench_subject)
-    else:
-        raise ValueError(
-            f"unhandled value `{trainer.args.bench_dataset}` for bench_dataset training args"
-        )
+    bench_dataset = load_bench_dataset(trainer.args.bench_dataset)
     bench_dataset = bench_dataset[trainer.args.bench_split]
     if trainer.args.max_bench_samples is not None:
         bench_dataset = bench_dataset.select(range(trainer.args.max_bench_samples))
@@ -138,14 +138,16 @@ class BatchSamplerDataCollatorForSeq2Seq(DataCollatorForSeq2Seq):
                     continue
                 if feature == "attention_mask":
                     arrays = [
-                        (1) * np.array(item[feature])
+                        (1) * np.asarray(item[feature])
                         for i, item in enumerate(features_)
                         if feature in item
                     ]
                     out_features[i][feature] = np.concatenate(arrays)
                 else:
                     arrays = [
-                        np.array(item[feature]) for item in features_ if feature in item
+                        np.asarray(item[feature])
+                        for item in features_
+                        if feature in item
                     ]
                     out_features[i][feature] = np.concatenate(arrays)
         return super().__call__(out_features, return_tensors=return_tensors)
@@ -167,14 +169,16 @@ class V2BatchSamplerDataCollatorForSeq2Seq(DataCollatorForSeq2Seq):
                     continue
                 if feature == "attention_mask":
                     arrays = [
-                        (i + 1) * np.array(item[feature])
+                        (i + 1) * np.asarray(item[feature])
                         for i, item in enumerate(features_)
                         if feature in item
                     ]
                     out_features[i][feature] = np.concatenate(arrays)
                 else:
                     arrays = [
-                        np.array(item[feature]) for item in features_ if feature in item
+                        np.asarray(item[feature])
+                        for item in features_
+                        if feature in item
                     ]
                     out_features[i][feature] = np.concatenate(arrays)
         return super().__call__(out_features, return_tensors=return_tensors)
@@ -0,0 +1,202 @@
+"""
+compact Arrow schema of prepared datasets: token ids as uint16/uint32 lists, and the
+labels, attention mask and position ids replaced by one bit-packed column that is
+expanded back into the full rows when collating
+"""
+
+import logging
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import pyarrow as pa
+from datasets import Dataset
+
+from axolotl.prompters import IGNORE_TOKEN_ID
+
+LOG = logging.getLogger("axolotl")
+
+# per row: one byte of flags, then the bits of the tokens trained on, packed
+LABEL_MASK = "label_mask"
+HAS_LABELS = 1
+HAS_ATTENTION_MASK = 2
+HAS_POSITION_IDS = 4
+_FLAG_COLUMNS = (
+    ("labels", HAS_LABELS),
+    ("attention_mask", HAS_ATTENTION_MASK),
+    ("position_ids", HAS_POSITION_IDS),
+)
+_POPCOUNT = np.array([bin(byte).count("1") for byte in range(256)], dtype=np.int64)
+
+
+def is_compact(dataset) -> bool:
+    return dataset is not None and LABEL_MASK in (
+        getattr(dataset, "column_names", None) or []
+    )
+
+
+def _flat_values(column: pa.Array) -> Tuple[np.ndarray, np.ndarray]:
+    """the values of a list column and its offsets, both starting at 0"""
+    offsets = column.offsets.to_numpy().astype(np.int64)
+    start, end = int(offsets[0]), int(offsets[-1])
+    values = column.values.slice(start, end - start).to_numpy(zero_copy_only=False)
+    return values, offsets - start
+
+
+def _compact_batch(batch: pa.Table, dtype: str) -> pa.Table:
+    columns = {name: batch.column(name).combine_chunks() for name in batch.column_names}
+    input_ids, offsets = _flat_values(columns["input_ids"])
+    if input_ids.size and (
+        input_ids.min() < 0 or input_ids.max() > np.iinfo(dtype).max
+    ):
+        raise ValueError(f"token ids don't fit in {dtype}")
+    lengths = np.diff(offsets)
+    row_starts = np.repeat(offsets[:-1], lengths)
+
+    label_mask = np.zeros(len(input_ids), dtype=bool)
+    if "labels" in columns:
+        labels, _ = _flat_values(columns["labels"])
+        label_mask = labels != IGNORE_TOKEN_ID
+        if not np.array_equal(labels[label_mask], input_ids[label_mask]):
+            raise ValueError("labels must be the input ids or -100")
+    if "attention_mask" in columns:
+        if not _flat_values(columns["attention_mask"])[0].all():
+            raise ValueError("attention_mask must be all ones")
+    if "position_ids" in columns:
+        position_ids, _ = _flat_values(columns["position_ids"])
+        if not np.array_equal(position_ids, np.arange(len(input_ids)) - row_starts):
+            raise ValueError("position_ids must count up from 0 per row")
+
+    # every row is padded to whole bytes, so packing the flat bits packs each row
+    mask_bytes = (lengths + 7) // 8
+    byte_offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(mask_bytes + 1, out=byte_offsets[1:])
+    bits = np.zeros(int(mask_bytes.sum()) * 8, dtype=bool)
+    bit_starts = (byte_offsets[:-1] - np.arange(len(lengths))) * 8
+    bits[
+        np.repeat(bit_starts, lengths) + np.arange(len(input_ids)) - row_starts
+    ] = label_mask
+
+    flags = sum(flag for name, flag in _FLAG_COLUMNS if name in columns)
+    data = np.empty(int(byte_offsets[-1]), dtype=np.uint8)
+    data[byte_offsets[:-1]] = flags
+    payload = np.ones(len(data), dtype=bool)
+    payload[byte_offsets[:-1]] = False
+    data[payload] = np.packbits(bits)
+
+    compacted = {
+        name: column
+        for name, column in columns.items()
+        if name not in dict(_FLAG_COLUMNS)
+    }
+    compacted.update(
+        {
+            "input_ids": pa.ListArray.from_arrays(
+                pa.array(offsets, pa.int32()), pa.array(input_ids.astype(dtype))
+            ),
+            LABEL_MASK: pa.BinaryArray.from_buffers(
+                pa.binary(),
+                len(lengths),
+                [
+                    None,
+                    pa.py_buffer(byte_offsets.astype(np.int32)),
+                    pa.py_buffer(data),
+                ],
+            ),
+        }
+    )
+    return pa.table(compacted)
+
+
+def compact_dataset(
+    dataset: Dataset, vocab_size: int, num_proc: Optional[int] = None
+) -> Dataset:
+    """
+    Store the token ids of `dataset` in the narrowest unsigned type fitting the
+    vocabulary, and its labels, attention mask and position ids as a bit-packed
+    mask of the tokens trained on. Raises a ValueError when the labels aren't
+    either the input id or -100, the attention mask isn't all ones or the position
+    ids don't count up from 0.
+    """
+    dtype = "uint16" if vocab_size <= np.iinfo(np.uint16).max + 1 else "uint32"
+    return (
+        dataset.with_format("arrow")
+        .map(
+            _compact_batch,
+            batched=True,
+            fn_kwargs={"dtype": dtype},
+            remove_columns=[
+                name for name, _ in _FLAG_COLUMNS if name in dataset.column_names
+            ],
+            num_proc=num_proc,
+            desc="Compacting prepared dataset",
+        )
+        .with_format(None)
+    )
+
+
+def label_mask_stats(
+    column: pa.ChunkedArray, lengths: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    """the length of the labels of every row of a compact dataset and how many are trained on"""
+    has_labels, supervised = [], []
+    for chunk in column.chunks:
+        # the offsets of a sliced binary array index into its unsliced data
+        offsets = np.frombuffer(chunk.buffers()[1], dtype=np.int32)[
+            chunk.offset : chunk.offset + len(chunk) + 1
+        ].astype(np.int64)
+        data = np.frombuffer(chunk.buffers()[2], dtype=np.uint8)
+        popcount = np.zeros(len(data) + 1, dtype=np.int64)
+        np.cumsum(_POPCOUNT[data], out=popcount[1:])
+        flags = data[offsets[:-1]]
+        has_labels.append((flags & HAS_LABELS).astype(bool))
+        supervised.append(
+            popcount[offsets[1:]] - popcount[offsets[:-1]] - _POPCOUNT[flags]
+        )
+    if not has_labels:
+        return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32)
+    has_labels_mask = np.concatenate(has_labels)
+    label_lengths = np.where(has_labels_mask, lengths, 0).astype(np.int32)
+    return label_lengths, np.concatenate(supervised).astype(np.int32)
+
+
+def expand_compact_row(row: Dict[str, Any]) -> Dict[str, Any]:
+    """the columns of a row of a compact dataset as they were before compacting"""
+    if LABEL_MASK not in row:
+        return row
+    row = dict(row)
+    mask = np.frombuffer(row.pop(LABEL_MASK), dtype=np.uint8)
+    input_ids = np.asarray(row["input_ids"], dtype=np.int64)
+    row["input_ids"] = input_ids
+    if mask[0] & HAS_LABELS:
+        trained = np.unpackbits(mask[1:], count=len(input_ids)).astype(bool)
+        row["labels"] = np.where(trained, input_ids, IGNORE_TOKEN_ID)
+    if mask[0] & HAS_ATTENTION_MASK:
+        row["attention_mask"] = np.ones(len(input_ids), dtype=np.int64)
+    if mask[0] & HAS_POSITION_IDS:
+        row["position_ids"] = np.arange(len(input_ids))
+    return row
+
+
+def expand_compact_features(features: List[Any]) -> List[Any]:
+    """expand the rows of a batch, or of the packs of a batch sampler batch"""
+    return [
+        (
+            expand_compact_features(feature)
+            if isinstance(feature, list)
+            else expand_compact_row(feature)
+        )
+        for feature in features
+    ]
+
+
+@dataclass
+class CompactSchemaCollator:
+    """
+    Expands the rows of a compact dataset before handing them to `collator`
+    """
+
+    collator: Callable
+
+    def __call__(self, features, *args, **kwargs):
+        return self.collator(expand_compact_features(features), *args, **kwargs)
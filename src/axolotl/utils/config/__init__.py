@@ -21,6 +21,7 @@ from axolotl.utils.config.models.input.v0_4_1 import (
 from axolotl.utils.config.models.input.v0_4_1 import DPODataset, KTODataset, SFTDataset
 from axolotl.utils.dict import DictDefault
 from axolotl.utils.models import load_model_config
+from axolotl.utils.samplers import PackingCostModel
 
 LOG = logging.getLogger("axolotl")
 
@@ -174,6 +175,15 @@ def normalize_config(cfg):
 
     cfg.model_config_type = model_config.model_type
 
+    if (
+        cfg.sample_packing_balance_cost
+        and cfg.sample_packing_cost_quadratic is None
+        and getattr(model_config, "hidden_size", None)
+    ):
+        cfg.sample_packing_cost_quadratic = PackingCostModel.for_hidden_size(
+            model_config.hidden_size
+        ).quadratic
+
     # figure out if the model is llama
     cfg.is_llama_derived_model = (
         (
@@ -6,7 +6,7 @@ import os
 from enum import Enum
 from typing import Annotated, Any, Dict, List, Literal, Optional, Tuple, Union
 
-from annotated_types import MinLen
+from annotated_types import Gt, MinLen
 from packaging import version
 from pydantic import (
     BaseModel,
@@ -212,6 +212,9 @@ class SFTDataset(BaseModel):
     temperature: Optional[float] = None
     roles_to_train: Optional[List[str]] = None
     train_on_eos: Optional[str] = None
+    turn_boundaries: Optional[Literal["diff", "offsets"]] = None
+    prefix_cache_size: Optional[int] = None
+    sample_ratio: Optional[Annotated[float, Gt(0)]] = None
     roles: Optional[Dict[str, List[str]]] = None
     drop_system_message: Optional[bool] = None
     trust_remote_code: Optional[bool] = False
@@ -718,6 +721,14 @@ class AxolotlInputConfig(
     ] = None
     shuffle_merged_datasets: Optional[bool] = True
     dataset_prepared_path: Optional[str] = None
+    dataset_prepared_format: Optional[
+        Literal["arrow", "compact", "token_store"]
+    ] = Field(
+        default=None,
+        json_schema_extra={
+            "description": "on-disk format of the prepared dataset, compact narrows the token ids and bit-packs the labels, token_store saves the final splits as memory-mapped flat token arrays"
+        },
+    )
     dataset_shard_num: Optional[int] = None
     dataset_shard_idx: Optional[int] = None
     skip_prepare_dataset: Optional[bool] = False
@@ -729,7 +740,49 @@ class AxolotlInputConfig(
         json_schema_extra={"description": "streaming dataset to use for pretraining"},
     )
     dataset_processes: Optional[int] = Field(default=os.cpu_count())
+    dataset_tokenize_on_local_ranks: Optional[bool] = Field(
+        default=None,
+        json_schema_extra={
+            "description": "tokenize a slice of every dataset on each local rank instead of only on rank 0"
+        },
+    )
     dataset_exact_deduplication: Optional[bool] = None
+    dataset_near_dedup: Optional[bool] = Field(
+        default=None,
+        json_schema_extra={
+            "description": "drop near duplicate rows found with MinHash over token n-grams"
+        },
+    )
+    dataset_near_dedup_threshold: Optional[float] = Field(
+        default=None,
+        json_schema_extra={
+            "description": "estimated Jaccard similarity above which rows are near duplicates, defaults to 0.8"
+        },
+    )
+    dataset_near_dedup_ngram_size: Optional[int] = Field(
+        default=None,
+        json_schema_extra={
+            "description": "number of tokens per shingle for near deduplication, defaults to 5"
+        },
+    )
+    decontamination_datasets: Optional[List[str]] = Field(
+        default=None,
+        json_schema_extra={
+            "description": "benchmarks, named like `bench_dataset`, whose token n-grams are removed from the train data"
+        },
+    )
+    decontamination_ngram_size: Optional[int] = Field(
+        default=None,
+        json_schema_extra={
+            "description": "number of tokens per n-gram for decontamination, defaults to 13"
+        },
+    )
+    decontamination_action: Optional[Literal["drop", "tag"]] = Field(
+        default=None,
+        json_schema_extra={
+            "description": "drop contaminated rows, or only save their indices with `tag`"
+        },
+    )
     dataset_keep_in_memory: Optional[bool] = None
     dataloader_pin_memory: Optional[bool] = None
     dataloader_num_workers: Optional[int] = None
@@ -795,6 +848,50 @@ class AxolotlInputConfig(
     sample_packing: Optional[bool] = None
     sample_packing_group_size: Optional[int] = 100_000
     sample_packing_bin_size: Optional[int] = 200
+    sample_packing_algorithm: Optional[Literal["ffd", "bfd", "multifit"]] = Field(
+        default=None,
+        json_schema_extra={
+            "description": "packing algorithm: grouped first-fit-decreasing (ffd, default), grouped best-fit-decreasing (bfd), or the serial multifit allocator",
+        },
+    )
+    sample_packing_balance_cost: Optional[bool] = Field(
+        default=None,
+        json_schema_extra={
+            "description": "order packed bins so the estimated attention cost is balanced within each step and across ranks",
+        },
+    )
+    sample_packing_balance_ranks: Optional[bool] = Field(
+        default=None,
+        json_schema_extra={
+            "description": "lay out packed bins for all ranks so every step's per-rank token and compute load is balanced and no bins are dropped at epoch end",
+        },
+    )
+    sample_packing_cost_linear: Optional[float] = Field(
+        default=None,
+        json_schema_extra={
+            "description": "per-token term of the packing cost model, defaults to 1.0",
+        },
+    )
+    sample_packing_cost_quadratic: Optional[float] = Field(
+        default=None,
+        json_schema_extra={
+            "description": "per-squared-document-length term of the packing cost model, defaults to 1 / (12 * hidden_size)",
+        },
+    )
+    sample_packing_plan_cache: Optional[bool] = Field(
+        default=None,
+        json_schema_extra={
+            "description": "seed the packing plan per epoch and cache it next to the prepared dataset",
+        },
+    )
+    sample_packing_mp_start_method: Optional[
+        Literal["fork", "spawn", "forkserver"]
+    ] = Field(
+        default=None,
+        json_schema_extra={
+            "description": "multiprocessing start method for the parallel packing planner, defaults to the platform default",
+        },
+    )
     eval_sample_packing: Optional[bool] = None
     pad_to_sequence_len: Optional[bool] = None
     curriculum_sampling: Optional[bool] = None
@@ -968,6 +1065,25 @@ class AxolotlInputConfig(
             raise ValueError(f"At least two of {', '.join(fields)} must be set")
         return data
 
+    @model_validator(mode="before")
+    @classmethod
+    def check_tokenize_on_local_ranks(cls, data):
+        if data.get("dataset_tokenize_on_local_ranks") and not data.get(
+            "dataset_prepared_path"
+        ):
+            raise ValueError(
+                "dataset_tokenize_on_local_ranks requires dataset_prepared_path to be set"
+            )
+        return data
+
+    @model_validator(mode="before")
+    @classmethod
+    def check_near_dedup_threshold(cls, data):
+        threshold = data.get("dataset_near_dedup_threshold")
+        if threshold is not None and not 0 < threshold <= 1:
+            raise ValueError("dataset_near_dedup_threshold must be in (0, 1]")
+        return data
+
     @model_validator(mode="before")
     @classmethod
     def check_pretraining_w_max_steps(cls, data):
@@ -1325,6 +1441,18 @@ class AxolotlInputConfig(
 
         return data
 
+    @model_validator(mode="before")
+    @classmethod
+    def check_compact_prepared_format(cls, data):
+        if (
+            data.get("dataset_prepared_format") == "compact"
+            and data.get("remove_unused_columns") is True
+        ):
+            raise ValueError(
+                "`remove_unused_columns` would drop the label mask of the compact prepared format"
+            )
+        return data
+
     @model_validator(mode="before")
     @classmethod
     def check_warmup(cls, data):
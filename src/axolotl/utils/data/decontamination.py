@@ -0,0 +1,91 @@
+"""
+benchmark decontamination of tokenized datasets with a hashed n-gram index
+"""
+
+import functools
+import logging
+from typing import List, Optional
+
+import numpy as np
+import pyarrow as pa
+from datasets import Dataset
+from transformers import PreTrainedTokenizerBase
+
+from axolotl.utils.data.dedup import ngram_hashes
+
+LOG = logging.getLogger(__name__)
+
+
+def _tokenize_texts(batch, tokenizer: PreTrainedTokenizerBase, columns: List[str]):
+    texts = [text for column in columns for text in batch[column] if text]
+    return {"input_ids": tokenizer(texts, add_special_tokens=False)["input_ids"]}
+
+
+def tokenize_benchmark(
+    dataset: Dataset,
+    tokenizer: PreTrainedTokenizerBase,
+    num_proc: Optional[int] = None,
+) -> Dataset:
+    """tokenize every string column of a benchmark, one row per text"""
+    columns = [
+        name
+        for name, feature in dataset.features.items()
+        if getattr(feature, "dtype", None) in ("string", "large_string")
+    ]
+    return dataset.map(
+        functools.partial(_tokenize_texts, tokenizer=tokenizer, columns=columns),
+        batched=True,
+        num_proc=num_proc if num_proc and len(dataset) > num_proc else None,
+        remove_columns=dataset.column_names,
+        desc="Tokenizing benchmark",
+    )
+
+
+def build_ngram_index(datasets: List[Dataset], ngram_size: int) -> np.ndarray:
+    """
+    Sorted array of the unique hashes of every `ngram_size` token window of the
+    `input_ids` of `datasets`
+    """
+    hashes = [
+        ngram_hashes(
+            dataset.with_format("arrow")[:].column("input_ids"),
+            ngram_size,
+            short_rows=False,
+        )[0]
+        for dataset in datasets
+    ]
+    return np.unique(np.concatenate(hashes or [np.zeros(0, dtype=np.uint64)]))
+
+
+def _contaminated_batch(table: pa.Table, index: np.ndarray, ngram_size: int):
+    contaminated = np.zeros(table.num_rows, dtype=bool)
+    hashes, rows = ngram_hashes(table.column("input_ids"), ngram_size, short_rows=False)
+    if len(index) and len(hashes):
+        found = index[np.minimum(np.searchsorted(index, hashes), len(index) - 1)]
+        contaminated[rows[found == hashes]] = True
+    return pa.table({"contaminated": contaminated})
+
+
+def find_contaminated_rows(
+    dataset: Dataset,
+    index: np.ndarray,
+    ngram_size: int,
+    num_proc: Optional[int] = None,
+) -> np.ndarray:
+    """
+    Boolean mask of the rows of `dataset` sharing at least one `ngram_size`
+    token window with the n-gram `index`
+    """
+    contaminated = (
+        dataset.select_columns(["input_ids"])
+        .with_format("arrow")
+        .map(
+            functools.partial(_contaminated_batch, index=index, ngram_size=ngram_size),
+            batched=True,
+            batch_size=1_000,
+            num_proc=num_proc if num_proc and len(dataset) > num_proc else None,
+            remove_columns=["input_ids"],
+            desc="Scanning for benchmark contamination",
+        )
+    )
+    return contaminated.data.column("contaminated").to_numpy(zero_copy_only=False)
@@ -0,0 +1,439 @@
+"""
+vectorized exact and near deduplication of Arrow backed datasets
+"""
+
+import functools
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, List, Optional, Tuple
+
+import numpy as np
+import pyarrow as pa
+from datasets import Dataset
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+from axolotl.utils.dataset_stats import SOURCE_COLUMN, select_rows
+
+LOG = logging.getLogger(__name__)
+
+ROWS_PER_CHUNK = 100_000
+_GOLDEN = np.uint64(0x9E3779B97F4A7C15)
+
+
+def _mix(values: np.ndarray) -> np.ndarray:
+    """splitmix64 finalizer, vectorized over a uint64 array"""
+    values = values ^ (values >> np.uint64(30))
+    values = values * np.uint64(0xBF58476D1CE4E5B9)
+    values = values ^ (values >> np.uint64(27))
+    values = values * np.uint64(0x94D049BB133111EB)
+    return values ^ (values >> np.uint64(31))
+
+
+def _is_primitive(arrow_type: pa.DataType) -> bool:
+    return (
+        pa.types.is_integer(arrow_type)
+        or pa.types.is_floating(arrow_type)
+        or pa.types.is_boolean(arrow_type)
+    )
+
+
+def _primitive_to_uint64(array: pa.Array) -> np.ndarray:
+    if array.null_count:
+        array = array.fill_null(0)
+    values = array.to_numpy(zero_copy_only=False)
+    if values.dtype.kind == "f":
+        return values.astype(np.float64).view(np.uint64)
+    return values.astype(np.int64).view(np.uint64)
+
+
+def _flatten_column(
+    column: pa.Array,
+) -> Iterator[Tuple[np.ndarray, np.ndarray, bool]]:
+    """
+    Yields `(values, offsets, exact)` triples describing a column, where row `i`
+    is `values[offsets[i]:offsets[i + 1]]` as uint64. Strings are split into
+    bytes and lists of primitives into their elements. Any other type is reduced
+    to a per row digest of its python value, in which case `exact` is False.
+    """
+    if isinstance(column, pa.ChunkedArray):
+        column = column.combine_chunks()
+    arrow_type = column.type
+    num_rows = len(column)
+    row_offsets = np.arange(num_rows + 1, dtype=np.int64)
+
+    validity = column.is_valid().to_numpy(zero_copy_only=False)
+    yield validity.astype(np.uint64), row_offsets, True
+
+    if _is_primitive(arrow_type):
+        yield _primitive_to_uint64(column), row_offsets, True
+    elif pa.types.is_string(arrow_type) or pa.types.is_binary(arrow_type):
+        yield from _flatten_binary(column, np.int32)
+    elif pa.types.is_large_string(arrow_type) or pa.types.is_large_binary(arrow_type):
+        yield from _flatten_binary(column, np.int64)
+    elif (
+        pa.types.is_list(arrow_type) or pa.types.is_large_list(arrow_type)
+    ) and _is_primitive(arrow_type.value_type):
+        offsets = column.offsets.to_numpy().astype(np.int64)
+        start, end = int(offsets[0]), int(offsets[-1])
+        values = _primitive_to_uint64(column.values.slice(start, end - start))
+        yield values, offsets - start, True
+    else:
+        digests = [
+            int.from_bytes(hashlib.sha256(str(value).encode()).digest()[:8], "little")
+            for value in column.to_pylist()
+        ]
+        yield np.array(digests, dtype=np.uint64), row_offsets, False
+
+
+def _flatten_binary(column: pa.Array, offset_type):
+    num_rows = len(column)
+    offsets = np.frombuffer(column.buffers()[1], dtype=offset_type)[
+        column.offset : column.offset + num_rows + 1
+    ].astype(np.int64)
+    data = column.buffers()[2]
+    start, end = int(offsets[0]), int(offsets[-1])
+    if data is None or end == start:
+        values = np.zeros(0, dtype=np.uint64)
+    else:
+        values = np.frombuffer(data, dtype=np.uint8)[start:end].astype(np.uint64)
+    yield values, offsets - start, True
+
+
+def _hash_chunk(table: pa.Table) -> np.ndarray:
+    row_hashes = np.zeros(table.num_rows, dtype=np.uint64)
+    with np.errstate(over="ignore"):
+        for column_idx, column in enumerate(table.columns):
+            for values, offsets, _ in _flatten_column(column):
+                lengths = np.diff(offsets)
+                positions = np.arange(len(values), dtype=np.int64) - np.repeat(
+                    offsets[:-1], lengths
+                )
+                element_hashes = _mix(values + positions.astype(np.uint64) * _GOLDEN)
+                cumulative = np.zeros(len(values) + 1, dtype=np.uint64)
+                np.cumsum(element_hashes, out=cumulative[1:])
+                column_hashes = _mix(
+                    cumulative[offsets[1:]]
+                    - cumulative[offsets[:-1]]
+                    + lengths.astype(np.uint64) * _GOLDEN
+                )
+                row_hashes = _mix(
+                    row_hashes * np.uint64(31) + column_hashes + np.uint64(column_idx)
+                )
+    return row_hashes
+
+
+def hash_rows(table: pa.Table, num_proc: Optional[int] = None) -> np.ndarray:
+    """
+    64 bit hash of every row of `table` over all of its columns. Chunks of rows
+    are hashed on a thread pool, numpy releases the GIL for the bulk of the work.
+    """
+    chunks = [
+        table.slice(start, ROWS_PER_CHUNK)
+        for start in range(0, table.num_rows, ROWS_PER_CHUNK)
+    ]
+    if not chunks:
+        return np.zeros(0, dtype=np.uint64)
+    with ThreadPoolExecutor(max_workers=num_proc) as pool:
+        return np.concatenate(list(pool.map(_hash_chunk, chunks)))
+
+
+def rows_equal(table: pa.Table, left: np.ndarray, right: np.ndarray) -> np.ndarray:
+    """
+    Elementwise comparison of rows `left[i]` and `right[i]` of `table`
+    """
+    equal = np.ones(len(left), dtype=bool)
+    if left.size == 0:
+        return equal
+    for column in table.columns:
+        left_column, right_column = column.take(left), column.take(right)
+        left_reps = _flatten_column(left_column)
+        right_reps = _flatten_column(right_column)
+        for (left_values, left_offsets, exact), (right_values, right_offsets, _) in zip(
+            left_reps, right_reps
+        ):
+            if not exact:
+                left_rows = left_column.to_pylist()
+                right_rows = right_column.to_pylist()
+                equal &= np.array(
+                    [lrow == rrow for lrow, rrow in zip(left_rows, right_rows)]
+                )
+                continue
+            lengths = np.diff(left_offsets)
+            equal &= lengths == np.diff(right_offsets)
+            rows = np.nonzero(equal)[0]
+            counts = lengths[rows]
+            within = np.arange(counts.sum()) - np.repeat(
+                np.cumsum(counts) - counts, counts
+            )
+            mismatch = (
+                left_values[np.repeat(left_offsets[rows], counts) + within]
+                != right_values[np.repeat(right_offsets[rows], counts) + within]
+            )
+            mismatched_rows = np.repeat(rows, counts)[mismatch]
+            equal[mismatched_rows] = False
+    return equal
+
+
+def find_unique_rows(table: pa.Table, num_proc: Optional[int] = None) -> np.ndarray:
+    """
+    Boolean mask of the rows of `table` that don't repeat an earlier row. Rows are
+    grouped by hash and only rows that share a hash are compared.
+    """
+    num_rows = table.num_rows
+    keep = np.ones(num_rows, dtype=bool)
+    if not num_rows:
+        return keep
+
+    hashes = hash_rows(table, num_proc=num_proc)
+    order = np.argsort(hashes, kind="stable")
+    sorted_hashes = hashes[order]
+    group_start = np.ones(num_rows, dtype=bool)
+    group_start[1:] = sorted_hashes[1:] != sorted_hashes[:-1]
+    first_in_group = np.maximum.accumulate(
+        np.where(group_start, np.arange(num_rows), 0)
+    )
+    representative = np.empty(num_rows, dtype=np.int64)
+    representative[order] = order[first_in_group]
+
+    candidates = np.nonzero(representative != np.arange(num_rows))[0]
+    equal = rows_equal(table, candidates, representative[candidates])
+    keep[candidates[equal]] = False
+
+    # true hash collisions, compare against every kept row sharing the hash
+    collisions = candidates[~equal]
+    if len(collisions):
+        LOG.debug(f"resolving {len(collisions)} hash collisions")
+    for row in collisions:
+        earlier: List[int] = [
+            idx
+            for idx in np.nonzero(hashes == hashes[row])[0]
+            if idx < row and keep[idx]
+        ]
+        if not earlier:
+            continue
+        duplicate = rows_equal(
+            table, np.full(len(earlier), row, dtype=np.int64), np.array(earlier)
+        )
+        if duplicate.any():
+            keep[row] = False
+    return keep
+
+
+def _without_source(table: pa.Table) -> pa.Table:
+    if SOURCE_COLUMN in table.column_names:
+        return table.drop_columns([SOURCE_COLUMN])
+    return table
+
+
+def deduplicate_dataset(
+    dataset: Dataset,
+    other_dataset: Optional[Dataset] = None,
+    num_proc: Optional[int] = None,
+) -> Dataset:
+    """
+    Drop the rows of `dataset` that repeat an earlier row, or any row of
+    `other_dataset` when given.
+    """
+    # rows from different datasets are still duplicates
+    table = _without_source(dataset.with_format("arrow")[:])
+    num_other = 0
+    if other_dataset is not None and [
+        name for name in other_dataset.column_names if name != SOURCE_COLUMN
+    ] == list(table.column_names):
+        other_table = _without_source(other_dataset.with_format("arrow")[:])
+        try:
+            table = pa.concat_tables([other_table.cast(table.schema), table])
+            num_other = other_table.num_rows
+        except (pa.ArrowInvalid, pa.ArrowNotImplementedError, ValueError):
+            LOG.debug("datasets have different schemas, skipping cross deduplication")
+    keep = find_unique_rows(table, num_proc=num_proc)[num_other:]
+    return select_rows(dataset, keep)
+
+
+MINHASH_NUM_PERM = 128
+# rows of an LSH bucket are compared with the rows up to this many places before
+# them in the bucket, so buckets up to this size are compared pairwise
+MAX_BUCKET_WINDOW = 64
+
+
+def ngram_hashes(
+    column: pa.Array, ngram_size: int, short_rows: bool = True
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    64 bit hashes of every window of `ngram_size` tokens of a list column, with
+    the row of each window. Rows shorter than a window are hashed whole when
+    `short_rows` is set and skipped otherwise.
+    """
+    if isinstance(column, pa.ChunkedArray):
+        column = column.combine_chunks()
+    offsets = column.offsets.to_numpy().astype(np.int64)
+    start, end = int(offsets[0]), int(offsets[-1])
+    values = _primitive_to_uint64(column.values.slice(start, end - start))
+    offsets = offsets - start
+    lengths = np.diff(offsets)
+    row_ids = np.repeat(np.arange(len(column)), lengths)
+    positions = np.arange(len(values)) - offsets[row_ids]
+    remaining = lengths[row_ids] - positions
+
+    hashes = np.zeros(len(values), dtype=np.uint64)
+    with np.errstate(over="ignore"):
+        for step in range(ngram_size):
+            tokens = values[np.minimum(np.arange(len(values)) + step, len(values) - 1)]
+            tokens = np.where(remaining > step, tokens, np.uint64(0xFFFFFFFFFFFFFFFF))
+            hashes = _mix(hashes * np.uint64(31) + tokens)
+
+    is_window = remaining >= ngram_size
+    if short_rows:
+        is_window |= (positions == 0) & (remaining > 0)
+    return hashes[is_window], row_ids[is_window]
+
+
+def _minhash_batch(
+    table: pa.Table, ngram_size: int, num_perm: int, seed: int
+) -> pa.Table:
+    """
+    One permutation MinHash signatures over the token shingles of a batch of
+    `input_ids`, densified so rows with fewer shingles than bins still compare
+    """
+    num_rows = table.num_rows
+    shingles, shingle_rows = ngram_hashes(table.column("input_ids"), ngram_size)
+    with np.errstate(over="ignore"):
+        # one permutation hashing: every shingle is hashed once into one of
+        # `num_perm` bins, each bin keeping its minimum
+        hashed = _mix(shingles ^ (np.uint64(seed) * _GOLDEN))
+        bins = (hashed % np.uint64(num_perm)).astype(np.int64)
+        empty = np.uint64(2**32)
+        signatures = np.full(num_rows * num_perm, empty, dtype=np.uint64)
+        np.minimum.at(
+            signatures, shingle_rows * num_perm + bins, hashed >> np.uint64(32)
+        )
+        signatures = signatures.reshape(num_rows, num_perm)
+
+        # densify: an empty bin takes the next filled bin to its right, wrapping
+        # around, offset by the distance so rows borrowing alike still agree
+        filled = signatures != empty
+        columns = np.arange(2 * num_perm)
+        next_filled = np.where(np.tile(filled, 2), columns, 2 * num_perm - 1)
+        next_filled = np.minimum.accumulate(next_filled[:, ::-1], axis=1)[:, ::-1]
+        next_filled = next_filled[:, :num_perm]
+        borrowed = np.take_along_axis(np.tile(signatures, 2), next_filled, axis=1)
+        distance = (next_filled - columns[:num_perm]).astype(np.uint64)
+        borrowed = (borrowed + distance * _GOLDEN) & np.uint64(0xFFFFFFFF)
+        signatures = np.where(filled, signatures, borrowed)
+        signatures[~filled.any(axis=1)] = 0xFFFFFFFF
+        signatures = signatures.astype(np.uint32)
+
+    return pa.table(
+        {
+            "minhash": pa.FixedSizeListArray.from_arrays(
+                pa.array(signatures.reshape(-1)), num_perm
+            )
+        }
+    )
+
+
+def minhash_signatures(
+    dataset: Dataset,
+    ngram_size: int = 5,
+    num_perm: int = MINHASH_NUM_PERM,
+    seed: int = 42,
+    num_proc: Optional[int] = None,
+) -> np.ndarray:
+    """
+    `(len(dataset), num_perm)` MinHash signatures over the token n-grams of
+    `input_ids`, computed in batches on `num_proc` processes
+    """
+    signatures = (
+        dataset.select_columns(["input_ids"])
+        .with_format("arrow")
+        .map(
+            functools.partial(
+                _minhash_batch, ngram_size=ngram_size, num_perm=num_perm, seed=seed
+            ),
+            batched=True,
+            batch_size=1_000,
+            num_proc=num_proc if num_proc and len(dataset) > num_proc else None,
+            remove_columns=["input_ids"],
+            desc="Computing MinHash signatures",
+        )
+    )
+    minhash = signatures.data.column("minhash").combine_chunks()
+    return minhash.flatten().to_numpy().reshape(-1, num_perm)
+
+
+def lsh_params(threshold: float, num_perm: int) -> Tuple[int, int]:
+    """
+    Number of bands and rows per band whose candidate threshold
+    `(1 / bands) ** (1 / rows)` is the closest one at or below `threshold`
+    """
+    best = (num_perm, 1)
+    best_threshold = -1.0
+    for bands in range(1, num_perm + 1):
+        rows = num_perm // bands
+        band_threshold = (1 / bands) ** (1 / rows)
+        if best_threshold < band_threshold <= threshold:
+            best, best_threshold = (bands, rows), band_threshold
+    return best
+
+
+def find_near_duplicate_clusters(
+    signatures: np.ndarray, threshold: float
+) -> np.ndarray:
+    """
+    Cluster label of every row, the smallest row index of its cluster. Rows that
+    share an LSH band become candidates and are linked when their estimated
+    Jaccard similarity reaches `threshold`. Candidates are compared pairwise in
+    buckets of up to `MAX_BUCKET_WINDOW + 1` rows; in larger buckets, only rows
+    within `MAX_BUCKET_WINDOW` places of each other are, which still links any
+    chain of similar rows in such a bucket but may miss a pair far apart.
+    """
+    num_rows, num_perm = signatures.shape
+    if not num_rows:
+        return np.zeros(0, dtype=np.int64)
+    bands, rows = lsh_params(threshold, num_perm)
+    sources, targets = [], []
+    with np.errstate(over="ignore"):
+        for band in range(bands):
+            band_hashes = np.zeros(num_rows, dtype=np.uint64)
+            for col in range(band * rows, (band + 1) * rows):
+                band_hashes = _mix(
+                    band_hashes * np.uint64(31) + signatures[:, col].astype(np.uint64)
+                )
+            order = np.argsort(band_hashes, kind="stable")
+            sorted_hashes = band_hashes[order]
+            group_start = np.ones(num_rows, dtype=bool)
+            group_start[1:] = sorted_hashes[1:] != sorted_hashes[:-1]
+            group_ids = np.cumsum(group_start)
+            window = min(int(np.bincount(group_ids).max()) - 1, MAX_BUCKET_WINDOW)
+            for offset in range(1, window + 1):
+                same_bucket = group_ids[offset:] == group_ids[:-offset]
+                source = order[offset:][same_bucket]
+                target = order[:-offset][same_bucket]
+                similarity = (signatures[source] == signatures[target]).mean(axis=1)
+                linked = similarity >= threshold
+                sources.append(source[linked])
+                targets.append(target[linked])
+
+    if not sources:
+        # no band has a bucket of two or more rows
+        return np.arange(num_rows, dtype=np.int64)
+    sources, targets = np.concatenate(sources), np.concatenate(targets)
+    graph = coo_matrix(
+        (np.ones(len(sources), dtype=np.int8), (sources, targets)),
+        shape=(num_rows, num_rows),
+    )
+    _, components = connected_components(graph, directed=False)
+    representative = np.full(components.max() + 1, num_rows, dtype=np.int64)
+    np.minimum.at(representative, components, np.arange(num_rows))
+    return representative[components]
+
+
+def near_deduplicate_dataset(
+    dataset: Dataset, signatures: np.ndarray, threshold: float
+) -> Dataset:
+    """Keep the first row of every cluster of near duplicate rows"""
+    clusters = find_near_duplicate_clusters(signatures, threshold)
+    keep = clusters == np.arange(len(clusters))
+    return select_rows(dataset, keep)
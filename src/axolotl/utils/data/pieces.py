@@ -0,0 +1,213 @@
+"""
+tokenized copies of single entries of `cfg.datasets` ("pieces"), and of
+contiguous slices of them tokenized separately, e.g. on several nodes or local
+ranks, then merged in order
+"""
+
+import json
+import logging
+import os
+import re
+import shutil
+import socket
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from datasets import Dataset, load_from_disk
+from transformers import PreTrainedTokenizerBase
+
+from axolotl.common.const import DEFAULT_DATASET_PREPARED_PATH
+from axolotl.utils.data.shared import datasets_w_name_generator
+from axolotl.utils.data.utils import get_tokenizer_fingerprint, md5
+from axolotl.utils.dict import DictDefault
+from axolotl.utils.distributed import barrier
+
+LOG = logging.getLogger(__name__)
+
+# top level config options that change how a single dataset is tokenized
+DATASET_PIECE_CFG_KEYS = (
+    "sequence_len",
+    "train_on_inputs",
+    "chat_template",
+    "chat_template_jinja",
+    "default_system_message",
+    "kd_temperature",
+    "processor_type",
+)
+
+
+# dataset config options that leave its tokenized rows unchanged: the mixture is
+# drawn at train time and the others only change how fast it is tokenized
+DATASET_PIECE_IGNORED_KEYS = (
+    "sample_ratio",
+    "prefix_cache_size",
+    "turn_boundaries",
+)
+
+
+def get_dataset_piece_path(
+    prepared_path: Path,
+    config_dataset: DictDefault,
+    dataset: Dataset,
+    cfg: DictDefault,
+    tokenizer_hash: str,
+) -> Path:
+    """
+    Path of the tokenized copy of a single entry of `cfg.datasets`, keyed on the
+    fingerprint of the raw (split and sharded) data, the dataset's prompt
+    strategy config and the tokenizer, so changing the mix of datasets only
+    re-tokenizes the entries that changed.
+    """
+    piece_hash = md5(
+        json.dumps(
+            {
+                "data": dataset._fingerprint,  # pylint: disable=protected-access
+                "config": {
+                    key: value
+                    for key, value in config_dataset.items()
+                    if key not in DATASET_PIECE_IGNORED_KEYS
+                },
+                "cfg": {key: cfg[key] for key in DATASET_PIECE_CFG_KEYS},
+                "tokenizer": tokenizer_hash,
+            },
+            sort_keys=True,
+            default=str,
+        )
+    )
+    return prepared_path / "datasets" / piece_hash
+
+
+def get_dataset_slice_path(piece_path: Path, index: int, num_slices: int) -> Path:
+    return piece_path.with_name(f"{piece_path.name}-{index:05d}-of-{num_slices:05d}")
+
+
+def load_dataset_slices(piece_path: Path) -> Optional[List[Dataset]]:
+    """
+    Load a complete set of contiguous slices of a tokenized dataset, written by
+    `tokenize_dataset_slices`, in order
+    """
+    slice_paths: Dict[int, Dict[int, Path]] = defaultdict(dict)
+    for slice_path in piece_path.parent.glob(f"{piece_path.name}-*-of-*"):
+        if match := re.fullmatch(rf"{piece_path.name}-(\d+)-of-(\d+)", slice_path.name):
+            index, num_slices = int(match.group(1)), int(match.group(2))
+            slice_paths[num_slices][index] = slice_path
+
+    for num_slices, paths in sorted(slice_paths.items()):
+        if len(paths) == num_slices:
+            return [load_from_disk(str(paths[idx])) for idx in range(num_slices)]
+    return None
+
+
+def save_to_disk_atomic(dataset: Dataset, path: Path, overwrite: bool = False):
+    """
+    save to a temporary sibling and rename it into place, so concurrent writers
+    of the same dataset never leave a partially written copy behind. With
+    `overwrite`, a copy already at `path` is replaced.
+    """
+    suffix = f"{socket.gethostname()}-{os.getpid()}"
+    tmp_path = path.with_name(f"{path.name}.tmp-{suffix}")
+    dataset.save_to_disk(str(tmp_path))
+    if overwrite and path.exists():
+        stale_path = path.with_name(f"{path.name}.stale-{suffix}")
+        try:
+            os.rename(path, stale_path)
+        except OSError:
+            # another process already replaced it
+            pass
+        else:
+            shutil.rmtree(stale_path, ignore_errors=True)
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # another process already saved it
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def tokenize_dataset_slices(
+    tokenizer: PreTrainedTokenizerBase,
+    cfg: DictDefault,
+    index: int,
+    num_slices: int,
+    processor=None,
+):
+    """
+    Tokenize contiguous slice `index` of `num_slices` of every configured train and
+    test dataset into `cfg.dataset_prepared_path`. Once every slice is written,
+    `load_tokenized_prepared_datasets` merges them in order, producing the same
+    prepared dataset as tokenizing each dataset in one go.
+    """
+    # pylint: disable=import-outside-toplevel
+    # sft builds on the pieces, so load its dataset helpers on first use
+    from axolotl.utils.data.sft import (
+        get_dataset_type,
+        get_dataset_wrapper,
+        load_split_dataset,
+    )
+
+    prepared_path = Path(cfg.dataset_prepared_path)
+    seed = cfg.seed or 42
+    tokenizer_hash = get_tokenizer_fingerprint(tokenizer)
+
+    for split, cfg_datasets in (("train", cfg.datasets), ("test", cfg.test_datasets)):
+        for config_dataset in datasets_w_name_generator(cfg_datasets or []):
+            ds = load_split_dataset(config_dataset, split, seed, cfg.hf_use_auth_token)
+            piece_path = get_dataset_piece_path(
+                prepared_path, config_dataset, ds, cfg, tokenizer_hash
+            )
+            slice_path = get_dataset_slice_path(piece_path, index, num_slices)
+            if not cfg.is_preprocess and (
+                any(piece_path.glob("*")) or slice_path.exists()
+            ):
+                LOG.info(f"Tokenized {config_dataset.path} already prepared, skipping")
+                continue
+
+            d_base_type, d_prompt_style = get_dataset_type(config_dataset)
+            dataset_wrapper, _ = get_dataset_wrapper(
+                config_dataset=config_dataset,
+                tokenizer=tokenizer,
+                cfg=cfg,
+                d_base_type=d_base_type,
+                dataset=ds.shard(num_shards=num_slices, index=index, contiguous=True),
+                d_prompt_style=d_prompt_style,
+                processor=processor,
+            )
+            LOG.info(
+                f"Saving slice {index} of {num_slices} of tokenized {config_dataset.path} to disk... {slice_path}"
+            )
+            save_to_disk_atomic(
+                dataset_wrapper, slice_path, overwrite=bool(cfg.is_preprocess)
+            )
+
+
+def tokenize_on_local_ranks(tokenizer, cfg, processor=None):
+    """
+    tokenize one slice of every dataset per local rank, leaving rank 0 only the
+    merge of the slices
+    """
+    # pylint: disable=import-outside-toplevel
+    from axolotl.utils.data.sft import prepared_datasets_exist
+
+    local_world_size = int(os.environ.get("LOCAL_WORLD_SIZE", "1"))
+    # on a warm start there is nothing to tokenize, so don't load and fingerprint
+    # every raw dataset to find that out
+    if local_world_size > 1 and not prepared_datasets_exist(
+        cfg, DEFAULT_DATASET_PREPARED_PATH
+    ):
+        # split the cpus between the ranks tokenizing concurrently
+        slice_cfg = DictDefault(
+            {
+                **cfg,
+                "dataset_processes": max(
+                    1, (cfg.dataset_processes or os.cpu_count()) // local_world_size
+                ),
+            }
+        )
+        tokenize_dataset_slices(
+            tokenizer,
+            slice_cfg,
+            cfg.local_rank,
+            local_world_size,
+            processor=processor,
+        )
+    barrier()
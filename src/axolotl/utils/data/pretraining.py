@@ -1,18 +1,16 @@
 """data handling specific to pretraining"""
 
+import bisect
 import functools
+import itertools
 import logging
-from collections import defaultdict
-from typing import Callable, Dict, List, Optional
+from typing import Callable, Dict, List, Optional, Tuple
 
-import torch
-from datasets import Dataset
-from torch.utils.data import RandomSampler
+import numpy as np
+from datasets import IterableDataset
 from transformers import PreTrainedTokenizerBase
 
 from axolotl.utils.collators import PretrainingBatchSamplerDataCollatorForSeq2Seq
-from axolotl.utils.samplers import MultipackBatchSampler, get_dataset_lengths
-from axolotl.utils.trainer import process_pretraining_datasets_for_packing
 
 LOG = logging.getLogger("axolotl")
 
@@ -30,146 +28,62 @@ def encode_pretraining(
         max_length=max_tokens - 2,
         add_special_tokens=True,
     )
-    # Convert to PyTorch tensors
-    input_ids = [torch.tensor(seq) for seq in res["input_ids"]]
-    targets = [torch.tensor(seq) for seq in res["input_ids"]]
-    attention_mask = [torch.tensor(seq) for seq in res["attention_mask"]]
     if not concatenate:
         return {
-            "input_ids": [seq.tolist() for seq in input_ids],
-            "labels": [seq.tolist() for seq in targets],
-            "attention_mask": [seq.tolist() for seq in attention_mask],
+            "input_ids": res["input_ids"],
+            "labels": [list(seq) for seq in res["input_ids"]],
+            "attention_mask": res["attention_mask"],
         }
 
-    new_input_ids = []
-    new_labels = []
-    new_attention_mask = []
-    # Append EOS and PAD tokens to input_ids, and correct attention_mask
-    for i, _ in enumerate(input_ids):
-        input_ids[i] = torch.cat(
-            (
-                input_ids[i],
-                torch.tensor([tokenizer.eos_token_id, tokenizer.pad_token_id]),
-            ),
-            dim=0,
-        )
-        targets[i] = torch.cat(
-            (
-                targets[i],
-                torch.tensor([tokenizer.eos_token_id, -100]),
-            ),
-            dim=0,
+    # every example is followed by an EOS and a PAD token
+    seq_lengths = np.array([len(seq) for seq in res["input_ids"]], dtype=np.int64)
+    lengths = seq_lengths + 2
+    cu_lengths = np.concatenate(([0], np.cumsum(lengths)))
+
+    # rows are filled greedily in order, each one starting at the first example
+    # that didn't fit in the previous row
+    row_starts = [0]
+    while row_starts[-1] < len(lengths):
+        row_end = np.searchsorted(
+            cu_lengths, cu_lengths[row_starts[-1]] + max_tokens, side="right"
         )
-        attention_mask[i] = torch.cat((attention_mask[i], torch.tensor([1, 0])), dim=0)
-
-    # Concatenate tokens so that their lengths are less than max_tokens
-    buffer_input_ids = torch.tensor([], dtype=torch.long)
-    buffer_labels = torch.tensor([], dtype=torch.long)
-    buffer_attention_mask = torch.tensor([], dtype=torch.long)
-
-    for ids, labels, mask in zip(input_ids, targets, attention_mask):
-        if buffer_input_ids.numel() == max_tokens:
-            new_input_ids.append(buffer_input_ids)
-            new_labels.append(buffer_labels)
-            new_attention_mask.append(buffer_attention_mask)
-            buffer_input_ids = torch.tensor([], dtype=torch.long)
-            buffer_labels = torch.tensor([], dtype=torch.long)
-            buffer_attention_mask = torch.tensor([], dtype=torch.long)
-            buffer_input_ids = torch.cat((buffer_input_ids, ids), dim=0)
-            buffer_labels = torch.cat((buffer_labels, labels), dim=0)
-            buffer_attention_mask = torch.cat((buffer_attention_mask, mask), dim=0)
-        elif buffer_input_ids.numel() + ids.numel() <= max_tokens:
-            buffer_input_ids = torch.cat((buffer_input_ids, ids), dim=0)
-            buffer_labels = torch.cat((buffer_labels, labels), dim=0)
-            buffer_attention_mask = torch.cat((buffer_attention_mask, mask), dim=0)
-        else:
-            buffer_input_ids = torch.cat(
-                (
-                    buffer_input_ids,
-                    torch.full(
-                        (max_tokens - buffer_input_ids.numel(),),
-                        tokenizer.pad_token_id,
-                        dtype=torch.long,
-                    ),
-                ),
-                dim=0,
-            )
-            buffer_labels = torch.cat(
-                (
-                    buffer_labels,
-                    torch.full(
-                        (max_tokens - buffer_labels.numel(),),
-                        -100,
-                        dtype=torch.long,
-                    ),
-                ),
-                dim=0,
-            )
-            buffer_attention_mask = torch.cat(
-                (
-                    buffer_attention_mask,
-                    torch.full(
-                        (max_tokens - buffer_attention_mask.numel(),),
-                        0,
-                        dtype=torch.long,
-                    ),
-                ),
-                dim=0,
-            )
-            new_input_ids.append(buffer_input_ids)
-            new_labels.append(buffer_labels)
-            new_attention_mask.append(buffer_attention_mask)
-            buffer_input_ids = torch.tensor([], dtype=torch.long)
-            buffer_labels = torch.tensor([], dtype=torch.long)
-            buffer_attention_mask = torch.tensor([], dtype=torch.long)
-
-            buffer_input_ids = torch.cat((buffer_input_ids, ids), dim=0)
-            buffer_labels = torch.cat((buffer_labels, labels), dim=0)
-            buffer_attention_mask = torch.cat((buffer_attention_mask, mask), dim=0)
-
-    if buffer_input_ids.numel() > 0:  # for any leftover tokens
-        while buffer_input_ids.numel() < max_tokens:  # make all sequences equal in size
-            buffer_input_ids = torch.cat(
-                (
-                    buffer_input_ids,
-                    torch.full(
-                        (max_tokens - buffer_input_ids.numel(),),
-                        tokenizer.pad_token_id,
-                        dtype=torch.long,
-                    ),
-                ),
-                dim=0,
-            )
-            buffer_labels = torch.cat(
-                (
-                    buffer_labels,
-                    torch.full(
-                        (max_tokens - buffer_labels.numel(),),
-                        -100,
-                        dtype=torch.long,
-                    ),
-                ),
-                dim=0,
-            )
-            buffer_attention_mask = torch.cat(
-                (
-                    buffer_attention_mask,
-                    torch.full(
-                        (max_tokens - buffer_attention_mask.numel(),),
-                        0,
-                        dtype=torch.long,
-                    ),
-                ),
-                dim=0,
-            )
-        new_input_ids.append(buffer_input_ids)
-        new_labels.append(buffer_labels)
-        new_attention_mask.append(buffer_attention_mask)
+        row_starts.append(int(row_end) - 1)
+    num_rows = len(row_starts) - 1
+    example_rows = np.repeat(np.arange(num_rows), np.diff(row_starts))
+
+    # offset of every example, and of each of its tokens, in the flat output
+    example_offsets = (
+        example_rows * max_tokens
+        + cu_lengths[:-1]
+        - cu_lengths[np.array(row_starts[:-1], dtype=np.int64)][example_rows]
+    )
+    cu_seq_lengths = cu_lengths[:-1] - 2 * np.arange(len(lengths))
+    token_offsets = np.repeat(
+        example_offsets - cu_seq_lengths, seq_lengths
+    ) + np.arange(seq_lengths.sum())
+    eos_offsets = example_offsets + seq_lengths
+
+    flat_input_ids = np.fromiter(
+        itertools.chain.from_iterable(res["input_ids"]), dtype=np.int64
+    )
+    flat_attention_mask = np.fromiter(
+        itertools.chain.from_iterable(res["attention_mask"]), dtype=np.int64
+    )
+
+    new_input_ids = np.full(num_rows * max_tokens, tokenizer.pad_token_id, np.int64)
+    new_input_ids[token_offsets] = flat_input_ids
+    new_input_ids[eos_offsets] = tokenizer.eos_token_id
+    new_labels = np.full(num_rows * max_tokens, -100, np.int64)
+    new_labels[token_offsets] = flat_input_ids
+    new_labels[eos_offsets] = tokenizer.eos_token_id
+    new_attention_mask = np.zeros(num_rows * max_tokens, np.int64)
+    new_attention_mask[token_offsets] = flat_attention_mask
+    new_attention_mask[eos_offsets] = 1
 
     ret = {
-        "input_ids": [seq.tolist() for seq in new_input_ids],
-        "labels": [seq.tolist() for seq in new_labels],
-        "attention_mask": [seq.tolist() for seq in new_attention_mask],
+        "input_ids": new_input_ids.reshape(num_rows, max_tokens).tolist(),
+        "labels": new_labels.reshape(num_rows, max_tokens).tolist(),
+        "attention_mask": new_attention_mask.reshape(num_rows, max_tokens).tolist(),
     }
 
     LOG.debug(len(ret["input_ids"]))
@@ -194,24 +108,29 @@ def wrap_pretraining_dataset(
             pad_to_multiple_of=max_tokens,
             multipack_attn=cfg.pretrain_multipack_attn,
         )
-        encode = functools.partial(
-            encode_packed_pretraining,
-            collate_fn,
+        # set this to 1 so downstream data_loader doesn't try to increase the batch again
+        cfg.micro_batch_size = 1
+        if cfg.shuffle_merged_datasets:
+            dataset = dataset.shuffle(seed=seed, buffer_size=buffer_size)
+        else:
+            LOG.debug("NOT shuffling merged pretraining datasets")
+        return pack_pretraining_stream(
+            dataset,
             ds_wrapper_fn,
+            collate_fn,
             max_seq_length=max_tokens,
             batch_size=batch_size,
+            buffer_size=buffer_size,
             multipack_attn=cfg.pretrain_multipack_attn,
         )
-        # set this to 1 so downstream data_loader doesn't try to increase the batch again
-        cfg.micro_batch_size = 1
-    else:
-        encode = functools.partial(
-            encode_pretraining,
-            tokenizer,
-            max_tokens,
-            text_column=cfg.pretraining_dataset[0].text_column or "text",
-            concatenate=cfg.pretraining_sample_concatenation is True,
-        )
+
+    encode = functools.partial(
+        encode_pretraining,
+        tokenizer,
+        max_tokens,
+        text_column=cfg.pretraining_dataset[0].text_column or "text",
+        concatenate=cfg.pretraining_sample_concatenation is True,
+    )
 
     if cfg.shuffle_merged_datasets:
         dataset = dataset.shuffle(seed=seed, buffer_size=buffer_size)
@@ -239,54 +158,139 @@ def wrap_pretraining_dataset(
     return dataset
 
 
-def encode_packed_pretraining(
-    collate_fn,
-    ds_wrapper: Callable,
-    examples: Dict[str, List],
-    max_seq_length: int = 2048,
-    batch_size: int = 4,
-    multipack_attn: Optional[bool] = True,
-) -> Dict[str, List]:
-    # pylint: disable=duplicate-code
-    # tokenize all the examples
-    # rows get split with stride (overlap)
-    train_dataset = ds_wrapper(Dataset.from_dict(examples))[0]
-
-    train_dataset = process_pretraining_datasets_for_packing(
-        train_dataset,
-        max_seq_length,
-        skip_position_ids=not multipack_attn,
+class OnlineBinPacker:
+    """
+    Bounded-buffer online best-fit packer. Each row goes into the open bin with the
+    least remaining space that still fits it. A bin is emitted as soon as it is at
+    least `fill_target` full, and once more than `buffer_size` rows are buffered the
+    fullest open bin is emitted, so memory is bounded by the buffer.
+    """
+
+    def __init__(self, capacity: int, buffer_size: int = 10_000, fill_target=0.99):
+        self.capacity = capacity
+        self.buffer_size = buffer_size
+        self.max_remaining = capacity - int(capacity * fill_target)
+        # open bins sorted by remaining space
+        self._open: List[Tuple[int, int]] = []
+        self._bins: Dict[int, List[Dict]] = {}
+        self._next_bin_id = 0
+        self._buffered = 0
+
+    def _emit(self, bin_id: int) -> List[Dict]:
+        rows = self._bins.pop(bin_id)
+        self._buffered -= len(rows)
+        return rows
+
+    def add(self, row: Dict, length: int) -> List[List[Dict]]:
+        """add a row of `length` tokens, returning the bins that were completed"""
+        pos = bisect.bisect_left(self._open, (length, -1))
+        if pos < len(self._open):
+            remaining, bin_id = self._open.pop(pos)
+        else:
+            remaining, bin_id = self.capacity, self._next_bin_id
+            self._next_bin_id += 1
+            self._bins[bin_id] = []
+
+        self._bins[bin_id].append(row)
+        self._buffered += 1
+        remaining -= length
+
+        completed = []
+        if remaining <= self.max_remaining:
+            completed.append(self._emit(bin_id))
+        else:
+            bisect.insort(self._open, (remaining, bin_id))
+
+        while self._buffered > self.buffer_size and self._open:
+            _, bin_id = self._open.pop(0)
+            completed.append(self._emit(bin_id))
+
+        return completed
+
+    def flush(self) -> List[List[Dict]]:
+        """emit every open bin, fullest first"""
+        completed = [self._emit(bin_id) for _, bin_id in self._open]
+        self._open = []
+        return completed
+
+
+def _prepare_pretraining_row(row: Dict, multipack_attn: Optional[bool]) -> Dict:
+    row = {
+        key: value
+        for key, value in row.items()
+        if key not in ("num_truncated_tokens", "overflow_to_sample_mapping")
+    }
+    if "labels" not in row:
+        row["labels"] = list(row["input_ids"])
+    if multipack_attn:
         # FIXME using attention mask unpad/pad with trainer and packed pretraining is broken atm
         # workaround by using the position id logic for now in trainer
-        drop_attention_mask=multipack_attn,
-    )
+        row["position_ids"] = list(range(len(row["input_ids"])))
+        row.pop("attention_mask", None)
+    return row
 
-    sampler = MultipackBatchSampler(
-        sampler=RandomSampler(train_dataset),
-        lengths=get_dataset_lengths(train_dataset),
-        batch_size=1,
-        batch_max_len=batch_size * max_seq_length,
-        drop_last=True,
-    )
 
-    chunked_data = defaultdict(list)
-
-    for batch in sampler:
-        for data in batch:
-            features = train_dataset[data]
-            if "num_truncated_tokens" in features:
-                del features["num_truncated_tokens"]
-            if "num_truncated_tokens" in features:
-                del features["num_truncated_tokens"]
-            if "overflow_to_sample_mapping" in features:
-                del features["overflow_to_sample_mapping"]
-            if "labels" not in features:
-                features["labels"] = features["input_ids"].copy()
-            collated_features = collate_fn(features)
-
-            for feature in features.keys():
-                if feature == "length":
+def _collate_bin(collate_fn, rows: List[Dict]) -> Dict:
+    features = {key: [row[key] for row in rows] for key in rows[0].keys()}
+    collated_features = collate_fn(features)
+    return {key: collated_features[key].squeeze(0) for key in features}
+
+
+def _generate_packed_pretraining(
+    shards: List[int],
+    dataset: IterableDataset,
+    collate_fn: Callable,
+    max_seq_length: int,
+    batch_size: int,
+    buffer_size: int,
+    multipack_attn: Optional[bool],
+):
+    packer = OnlineBinPacker(batch_size * max_seq_length, buffer_size=buffer_size)
+    for shard_idx in shards:
+        shard = dataset.shard(num_shards=dataset.n_shards, index=shard_idx)
+        # `.iter` rather than `__iter__`, which would split the shard again
+        # between dataloader workers
+        for batch in shard.iter(batch_size=1_000):
+            for row in (dict(zip(batch, values)) for values in zip(*batch.values())):
+                length = len(row["input_ids"])
+                if not 2 <= length <= max_seq_length:
                     continue
-                chunked_data[feature].append(collated_features[feature].squeeze(0))
+                row = _prepare_pretraining_row(row, multipack_attn)
+                for rows in packer.add(row, length):
+                    yield _collate_bin(collate_fn, rows)
 
-    return chunked_data
+    for rows in packer.flush():
+        yield _collate_bin(collate_fn, rows)
+
+
+def pack_pretraining_stream(
+    dataset: IterableDataset,
+    ds_wrapper: Callable,
+    collate_fn: Callable,
+    max_seq_length: int = 2048,
+    batch_size: int = 4,
+    buffer_size: int = 10_000,
+    multipack_attn: Optional[bool] = True,
+) -> IterableDataset:
+    """
+    Lazily tokenize a streaming dataset and pack it with an `OnlineBinPacker`,
+    yielding collated packed sequences as bins fill instead of materializing
+    each buffer as an Arrow dataset first.
+    """
+    if dataset.features is None:
+        dataset = dataset._resolve_features()  # pylint: disable=protected-access
+    tokenized = ds_wrapper(dataset)[0]
+
+    return IterableDataset.from_generator(
+        _generate_packed_pretraining,
+        gen_kwargs={
+            # lists in gen_kwargs are split across dataloader workers
+            "shards": list(range(tokenized.n_shards)),
+            "dataset": tokenized,
+            "collate_fn": collate_fn,
+            "max_seq_length": max_seq_length,
+            "batch_size": batch_size,
+            "buffer_size": buffer_size,
+            "multipack_attn": multipack_attn,
+        },
+    )
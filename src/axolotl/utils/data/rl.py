@@ -213,7 +213,9 @@ def load_prepare_preference_datasets(cfg):
 
     if cfg.dataset_exact_deduplication:
         train_dataset, eval_dataset, _ = deduplicate_and_log_datasets(
-            train_dataset=train_dataset, eval_dataset=eval_dataset
+            train_dataset=train_dataset,
+            eval_dataset=eval_dataset,
+            num_proc=cfg.dataset_processes,
         )
 
     return train_dataset, eval_dataset
@@ -3,8 +3,9 @@
 import functools
 import logging
 from pathlib import Path
-from typing import List, Optional, Tuple, Union
+from typing import Dict, List, Optional, Tuple, Union
 
+import numpy as np
 from datasets import (
     Dataset,
     DatasetDict,
@@ -18,7 +19,11 @@ from datasets import (
 from transformers import PreTrainedTokenizerBase
 
 from axolotl.common.const import DEFAULT_DATASET_PREPARED_PATH
-from axolotl.datasets import TokenizedPromptDataset, wrap_dataset_for_tokenized_prompt
+from axolotl.datasets import (
+    TokenizedPromptDataset,
+    TokenStore,
+    wrap_dataset_for_tokenized_prompt,
+)
 from axolotl.prompt_strategies import load
 from axolotl.prompt_strategies.bradley_terry import load as bradley_terry_load
 from axolotl.prompt_tokenizers import (
@@ -29,6 +34,7 @@ from axolotl.prompt_tokenizers import (
     GPTeacherPromptTokenizingStrategy,
     JeopardyPromptTokenizingStrategy,
     OpenAssistantPromptTokenizingStrategy,
+    PromptTokenizingStrategy,
     SummarizeTLDRPromptTokenizingStrategy,
 )
 from axolotl.prompters import (
@@ -42,14 +48,32 @@ from axolotl.prompters import (
     SummarizeTLDRPrompter,
     UnsupportedPrompter,
 )
+from axolotl.utils.compact_schema import compact_dataset
+from axolotl.utils.data.pieces import (
+    get_dataset_piece_path,
+    load_dataset_slices,
+    save_to_disk_atomic,
+    tokenize_on_local_ranks,
+)
 from axolotl.utils.data.pretraining import wrap_pretraining_dataset
 from axolotl.utils.data.shared import datasets_w_name_generator, load_dataset_w_config
 from axolotl.utils.data.utils import (
+    decontaminate_and_log_dataset,
     deduplicate_and_log_datasets,
     drop_long_seq_in_dataset,
+    get_tokenizer_fingerprint,
     md5,
+    near_deduplicate_and_log_dataset,
     retry_on_request_exceptions,
 )
+from axolotl.utils.dataset_stats import (
+    add_dataset_sources,
+    carry_dataset_stats,
+    load_dataset_stats,
+    remap_dataset_sources,
+    save_dataset_stats,
+    shuffle_dataset,
+)
 from axolotl.utils.dict import DictDefault
 from axolotl.utils.distributed import is_local_main_process, zero_first
 from axolotl.utils.trainer import (
@@ -64,8 +88,33 @@ LOG = logging.getLogger(__name__)
 def prepare_dataset(cfg, tokenizer, processor=None, preprocess_iterable=None):
     prompters = []
     if not cfg.pretraining_dataset:
+        if cfg.dataset_tokenize_on_local_ranks and not preprocess_iterable:
+            tokenize_on_local_ranks(tokenizer, cfg, processor=processor)
         with zero_first(is_local_main_process()):
-            if cfg.test_datasets:
+            token_store_path = None
+            if (
+                cfg.dataset_prepared_format == "token_store"
+                and not cfg.skip_prepare_dataset
+                and not preprocess_iterable
+            ):
+                token_store_path = get_token_store_path(
+                    cfg, DEFAULT_DATASET_PREPARED_PATH
+                )
+
+            if (
+                token_store_path
+                and cfg.dataset_prepared_path
+                and (token_store_path / "train").exists()
+                and not cfg.is_preprocess
+            ):
+                LOG.info(
+                    f"Loading prepared token store from disk at {token_store_path}..."
+                )
+                train_dataset = TokenStore(token_store_path / "train")
+                eval_dataset = None
+                if (token_store_path / "test").exists():
+                    eval_dataset = TokenStore(token_store_path / "test")
+            elif cfg.test_datasets:
                 train_dataset, _, prompters = load_prepare_datasets(
                     tokenizer,
                     cfg,
@@ -90,6 +139,20 @@ def prepare_dataset(cfg, tokenizer, processor=None, preprocess_iterable=None):
                     processor=processor,
                     preprocess_iterable=preprocess_iterable,
                 )
+
+            if (
+                token_store_path
+                and cfg.local_rank == 0
+                and not isinstance(train_dataset, TokenStore)
+            ):
+                LOG.info(f"Saving prepared token store to disk... {token_store_path}")
+                train_dataset = TokenStore.write(
+                    train_dataset, token_store_path / "train", len(tokenizer)
+                )
+                if eval_dataset:
+                    eval_dataset = TokenStore.write(
+                        eval_dataset, token_store_path / "test", len(tokenizer)
+                    )
     else:
         # Load streaming dataset if pretraining_dataset is given
         path = cfg.pretraining_dataset
@@ -147,7 +210,7 @@ def prepare_dataset(cfg, tokenizer, processor=None, preprocess_iterable=None):
                 preprocess_iterable=preprocess_iterable,
             )
 
-        if cfg.dataset_exact_deduplication:
+        if cfg.dataset_exact_deduplication or cfg.dataset_near_dedup:
             LOG.info("Deduplication not available for pretrained datasets")
 
         return train_dataset, eval_dataset, cfg.max_steps, prompters
@@ -170,18 +233,8 @@ def prepare_dataset(cfg, tokenizer, processor=None, preprocess_iterable=None):
     return train_dataset, eval_dataset, total_num_steps, prompters
 
 
-def load_tokenized_prepared_datasets(
-    tokenizer,
-    cfg,
-    default_dataset_prepared_path,
-    split="train",
-    processor=None,
-    preprocess_iterable: Optional[bool] = None,
-) -> Tuple[DatasetDict, List[Prompter]]:
-    cfg_datasets = cfg.test_datasets if split == "test" else cfg.datasets
-    tokenizer_name = cfg.tokenizer_config
-
-    ds_hash = str(
+def get_prepared_dataset_hash(cfg, cfg_datasets) -> str:
+    return str(
         md5(
             (
                 str(cfg.sequence_len)
@@ -202,17 +255,94 @@ def load_tokenized_prepared_datasets(
                     )
                 )
                 + "|"
-                + tokenizer_name
+                + cfg.tokenizer_config
             )
         )
     )
-    prepared_ds_path = (
-        Path(cfg.dataset_prepared_path) / ds_hash
-        if cfg.dataset_prepared_path
-        else Path(default_dataset_prepared_path) / ds_hash
+
+
+def get_dataset_source(config_dataset) -> Dict[str, Optional[str]]:
+    """
+    identity of a configured dataset among the sources of a merged prepared
+    dataset: the fields `get_prepared_dataset_hash` is made of, and its name
+    """
+    return {
+        key: None if config_dataset[key] is None else str(config_dataset[key])
+        for key in ("path", "name", "type", "shards", "conversation", "split")
+    }
+
+
+def get_prepared_dataset_path(cfg, cfg_datasets, default_dataset_prepared_path) -> Path:
+    """path of the merged prepared dataset of `cfg_datasets`"""
+    return Path(cfg.dataset_prepared_path or default_dataset_prepared_path) / (
+        get_prepared_dataset_hash(cfg, cfg_datasets)
+    )
+
+
+def prepared_datasets_exist(cfg, default_dataset_prepared_path) -> bool:
+    """whether the final prepared datasets of `cfg` are already saved to disk"""
+    if not cfg.dataset_prepared_path or cfg.is_preprocess or cfg.skip_prepare_dataset:
+        return False
+    if cfg.dataset_prepared_format == "token_store":
+        token_store_path = get_token_store_path(cfg, default_dataset_prepared_path)
+        return (token_store_path / "train").exists()
+    return all(
+        any(
+            get_prepared_dataset_path(
+                cfg, cfg_datasets, default_dataset_prepared_path
+            ).glob("*")
+        )
+        for cfg_datasets in (cfg.datasets, cfg.test_datasets)
+        if cfg_datasets
+    )
+
+
+def get_token_store_path(cfg, default_dataset_prepared_path) -> Path:
+    """path of the token stores holding the final train and eval splits"""
+    store_hash = md5(
+        "|".join(
+            [
+                get_prepared_dataset_hash(cfg, cfg.datasets),
+                (
+                    get_prepared_dataset_hash(cfg, cfg.test_datasets)
+                    if cfg.test_datasets
+                    else ""
+                ),
+                str(cfg.val_set_size),
+                str(cfg.seed or 42),
+                str(cfg.dataset_shard_num),
+                str(cfg.dataset_shard_idx),
+                str(cfg.dataset_exact_deduplication),
+                str(cfg.dataset_near_dedup),
+                str(cfg.dataset_near_dedup_threshold),
+                str(cfg.dataset_near_dedup_ngram_size),
+                str(cfg.decontamination_datasets),
+                str(cfg.decontamination_ngram_size),
+                str(cfg.decontamination_action),
+            ]
+        )
+    )
+    return (
+        Path(cfg.dataset_prepared_path or default_dataset_prepared_path)
+        / f"{store_hash}-token-store"
+    )
+
+
+def load_tokenized_prepared_datasets(
+    tokenizer,
+    cfg,
+    default_dataset_prepared_path,
+    split="train",
+    processor=None,
+    preprocess_iterable: Optional[bool] = None,
+) -> Tuple[DatasetDict, List[Optional[Prompter]]]:
+    cfg_datasets = cfg.test_datasets if split == "test" else cfg.datasets
+    ds_hash = get_prepared_dataset_hash(cfg, cfg_datasets)
+    prepared_ds_path = get_prepared_dataset_path(
+        cfg, cfg_datasets, default_dataset_prepared_path
     )
     dataset = None
-    prompters = []
+    prompters: List[Optional[Prompter]] = []
     use_auth_token = cfg.hf_use_auth_token
     try:
         if cfg.push_dataset_to_hub:
@@ -240,6 +370,12 @@ def load_tokenized_prepared_datasets(
     ):
         LOG.info(f"Loading prepared dataset from disk at {prepared_ds_path}...")
         dataset = load_from_disk(str(prepared_ds_path))
+        load_dataset_stats(prepared_ds_path, dataset)
+        dataset = remap_dataset_sources(
+            prepared_ds_path,
+            dataset,
+            [get_dataset_source(d) for d in datasets_w_name_generator(cfg_datasets)],
+        )
         LOG.info("Prepared dataset loaded from disk...")
     else:
         if cfg.push_dataset_to_hub:
@@ -263,39 +399,77 @@ def load_tokenized_prepared_datasets(
             seed = 42
 
         datasets = []
+        source_datasets = []
+        tokenizer_hash = None
 
         streaming_ds = False
         if preprocess_iterable:
             streaming_ds = True
         # pylint: disable=invalid-name
         for config_dataset in datasets_w_name_generator(cfg_datasets):
-            ds: Union[Dataset, DatasetDict] = load_dataset_w_config(
-                config_dataset, use_auth_token, streaming=streaming_ds
+            ds = load_split_dataset(
+                config_dataset, split, seed, use_auth_token, streaming=streaming_ds
             )
+            d_base_type, d_prompt_style = get_dataset_type(config_dataset)
+            source_datasets.append(get_dataset_source(config_dataset))
+
+            piece_path = None
+            if (
+                cfg.dataset_prepared_path
+                and not cfg.skip_prepare_dataset
+                and isinstance(ds, Dataset)
+            ):
+                tokenizer_hash = tokenizer_hash or get_tokenizer_fingerprint(tokenizer)
+                piece_path = get_dataset_piece_path(
+                    Path(cfg.dataset_prepared_path),
+                    config_dataset,
+                    ds,
+                    cfg,
+                    tokenizer_hash,
+                )
 
-            d_base_type = d_prompt_style = None
-            d_type = config_dataset.type
-            if isinstance(d_type, str):
-                d_type_split = d_type.split(":")
-                d_base_type = d_type_split[0]
-                d_prompt_style = d_type_split[1] if len(d_type_split) > 1 else None
-
-            if isinstance(ds, DatasetDict):
-                if config_dataset.split and config_dataset.split in ds:
-                    ds = ds[config_dataset.split]
-                elif split in ds:
-                    ds = ds[split]
-                else:
-                    raise ValueError(
-                        f"no {split} split found for dataset {config_dataset.path}, you may specify a split with 'split: `"
+            # `axolotl preprocess` re-tokenizes, e.g. after a prompt strategy changed
+            if piece_path and not cfg.is_preprocess and any(piece_path.glob("*")):
+                LOG.info(
+                    f"Loading tokenized {config_dataset.path} from disk at {piece_path}..."
+                )
+                datasets.append(load_from_disk(str(piece_path)))
+                prompters.append(
+                    get_dataset_strategy(
+                        config_dataset,
+                        tokenizer,
+                        cfg,
+                        d_base_type,
+                        d_prompt_style,
+                        processor=processor,
+                    )[1]
+                )
+                continue
+            if piece_path and (ds_slices := load_dataset_slices(piece_path)):
+                LOG.info(
+                    f"Merging {len(ds_slices)} tokenized slices of {config_dataset.path}..."
+                )
+                merged = concatenate_datasets(ds_slices)
+                if cfg.local_rank == 0:
+                    # so a different number of slices next time still hits
+                    LOG.info(
+                        f"Saving tokenized {config_dataset.path} to disk... {piece_path}"
                     )
-
-            # support for using a subset of the data
-            if config_dataset.shards:
-                shards_idx = config_dataset.get("shards_idx", 0)
-                ds = ds.shuffle(seed=seed).shard(
-                    num_shards=config_dataset.shards, index=shards_idx
+                    save_to_disk_atomic(
+                        merged, piece_path, overwrite=bool(cfg.is_preprocess)
+                    )
+                datasets.append(merged)
+                prompters.append(
+                    get_dataset_strategy(
+                        config_dataset,
+                        tokenizer,
+                        cfg,
+                        d_base_type,
+                        d_prompt_style,
+                        processor=processor,
+                    )[1]
                 )
+                continue
 
             dataset_wrapper, dataset_prompter = get_dataset_wrapper(
                 config_dataset=config_dataset,
@@ -306,6 +480,13 @@ def load_tokenized_prepared_datasets(
                 d_prompt_style=d_prompt_style,
                 processor=processor,
             )
+            if piece_path and dataset_wrapper is not ds and cfg.local_rank == 0:
+                LOG.info(
+                    f"Saving tokenized {config_dataset.path} to disk... {piece_path}"
+                )
+                save_to_disk_atomic(
+                    dataset_wrapper, piece_path, overwrite=bool(cfg.is_preprocess)
+                )
             datasets.append(dataset_wrapper)
             prompters.append(dataset_prompter)
 
@@ -315,10 +496,26 @@ def load_tokenized_prepared_datasets(
             LOG.info("merging datasets")
             dataset = concatenate_datasets(datasets)
 
+        track_stats = (
+            not cfg.skip_prepare_dataset
+            and isinstance(dataset, Dataset)
+            and "input_ids" in dataset.column_names
+        )
+        if track_stats:
+            # which source every row comes from, for the mixture sampler and the
+            # saved stats
+            dataset = add_dataset_sources(
+                dataset,
+                np.repeat(
+                    np.arange(len(datasets), dtype=np.int32),
+                    [len(ds) for ds in datasets],
+                ),
+            )
+
         if len(datasets) > 1:
             if cfg.shuffle_merged_datasets:
                 LOG.debug("shuffle merged datasets")
-                dataset = dataset.shuffle(seed=seed)
+                dataset = shuffle_dataset(dataset, seed=seed)
             else:
                 LOG.debug("NOT shuffling merged datasets")
 
@@ -328,7 +525,24 @@ def load_tokenized_prepared_datasets(
             if cfg.sample_packing:
                 dataset, _ = process_datasets_for_packing(cfg, dataset, None)
 
-        if cfg.local_rank == 0 and not cfg.skip_prepare_dataset:
+        if cfg.dataset_prepared_format == "compact" and track_stats:
+            try:
+                compacted = compact_dataset(
+                    dataset, len(tokenizer), num_proc=cfg.dataset_processes
+                )
+                carry_dataset_stats(compacted, dataset)
+                dataset = compacted
+            except ValueError as err:
+                LOG.warning(
+                    f"Saving the full prepared dataset, can't compact it: {err}"
+                )
+
+        if (
+            cfg.local_rank == 0
+            and not cfg.skip_prepare_dataset
+            # the final splits are saved as token stores instead
+            and cfg.dataset_prepared_format != "token_store"
+        ):
             LOG.info(f"Saving merged prepared dataset to disk... {prepared_ds_path}")
             if isinstance(dataset, IterableDataset):
 
@@ -345,6 +559,8 @@ def load_tokenized_prepared_datasets(
                 ds_from_iter.save_to_disk(str(prepared_ds_path))
             else:
                 dataset.save_to_disk(str(prepared_ds_path))
+                if track_stats:
+                    save_dataset_stats(prepared_ds_path, dataset, source_datasets)
             if cfg.push_dataset_to_hub:
                 LOG.info(
                     f"Pushing merged prepared dataset to Huggingface hub at {cfg.push_dataset_to_hub} (version {ds_hash})..."
@@ -358,6 +574,51 @@ def load_tokenized_prepared_datasets(
     return dataset, prompters
 
 
+def get_dataset_type(
+    config_dataset: DictDefault,
+) -> Tuple[Optional[str], Optional[str]]:
+    """split a dataset `type` of the form `base_type:prompt_style`"""
+    d_base_type = d_prompt_style = None
+    d_type = config_dataset.type
+    if isinstance(d_type, str):
+        d_type_split = d_type.split(":")
+        d_base_type = d_type_split[0]
+        d_prompt_style = d_type_split[1] if len(d_type_split) > 1 else None
+    return d_base_type, d_prompt_style
+
+
+def load_split_dataset(
+    config_dataset: DictDefault,
+    split: str,
+    seed: int,
+    use_auth_token,
+    streaming: bool = False,
+) -> Union[Dataset, IterableDataset]:
+    """load the raw data of a dataset config, narrowed down to its split and shard"""
+    ds: Union[Dataset, DatasetDict] = load_dataset_w_config(
+        config_dataset, use_auth_token, streaming=streaming
+    )
+
+    if isinstance(ds, DatasetDict):
+        if config_dataset.split and config_dataset.split in ds:
+            ds = ds[config_dataset.split]
+        elif split in ds:
+            ds = ds[split]
+        else:
+            raise ValueError(
+                f"no {split} split found for dataset {config_dataset.path}, you may specify a split with 'split: `"
+            )
+
+    # support for using a subset of the data
+    if config_dataset.shards:
+        shards_idx = config_dataset.get("shards_idx", 0)
+        ds = ds.shuffle(seed=seed).shard(
+            num_shards=config_dataset.shards, index=shards_idx
+        )
+
+    return ds
+
+
 def load_prepare_datasets(
     tokenizer: PreTrainedTokenizerBase,
     cfg,
@@ -365,7 +626,7 @@ def load_prepare_datasets(
     split="train",
     processor=None,
     preprocess_iterable: Optional[bool] = False,
-) -> Tuple[Dataset, Dataset, List[Prompter]]:
+) -> Tuple[Dataset, Dataset, List[Optional[Prompter]]]:
     dataset, prompters = load_tokenized_prepared_datasets(
         tokenizer,
         cfg,
@@ -411,8 +672,14 @@ def load_prepare_datasets(
         train_fingerprint = md5(to_hash_train)
         test_fingerprint = md5(to_hash_test)
         if cfg.dataset_exact_deduplication:
-            _, _, dataset = deduplicate_and_log_datasets(dataset=dataset)
-        dataset = dataset.train_test_split(
+            _, _, dataset = deduplicate_and_log_datasets(
+                dataset=dataset, num_proc=cfg.dataset_processes
+            )
+        if cfg.dataset_near_dedup:
+            dataset = near_deduplicate_and_log_dataset(
+                dataset, cfg, default_dataset_prepared_path
+            )
+        split_datasets = dataset.train_test_split(
             test_size=val_set_size,
             shuffle=False,
             seed=cfg.seed or 42,
@@ -420,23 +687,123 @@ def load_prepare_datasets(
             test_new_fingerprint=test_fingerprint,
         )
 
-        train_dataset = dataset["train"]
-        eval_dataset = dataset["test"]
+        train_dataset = split_datasets["train"]
+        eval_dataset = split_datasets["test"]
+        # without shuffling, the train rows come first and the test rows after them
+        carry_dataset_stats(train_dataset, dataset, np.arange(len(train_dataset)))
+        carry_dataset_stats(
+            eval_dataset, dataset, np.arange(len(train_dataset), len(dataset))
+        )
+        if cfg.decontamination_datasets:
+            train_dataset = decontaminate_and_log_dataset(
+                train_dataset, tokenizer, cfg, default_dataset_prepared_path
+            )
     elif split == "test":
         if cfg.dataset_exact_deduplication:
-            _, eval_dataset, _ = deduplicate_and_log_datasets(eval_dataset=dataset)
+            _, eval_dataset, _ = deduplicate_and_log_datasets(
+                eval_dataset=dataset, num_proc=cfg.dataset_processes
+            )
         else:
             eval_dataset = dataset
+        if cfg.dataset_near_dedup:
+            eval_dataset = near_deduplicate_and_log_dataset(
+                eval_dataset, cfg, default_dataset_prepared_path
+            )
         train_dataset = None
     else:
         if cfg.dataset_exact_deduplication:
-            train_dataset, _, _ = deduplicate_and_log_datasets(train_dataset=dataset)
+            train_dataset, _, _ = deduplicate_and_log_datasets(
+                train_dataset=dataset, num_proc=cfg.dataset_processes
+            )
         else:
             train_dataset = dataset
+        if cfg.dataset_near_dedup:
+            train_dataset = near_deduplicate_and_log_dataset(
+                train_dataset, cfg, default_dataset_prepared_path
+            )
+        if cfg.decontamination_datasets:
+            train_dataset = decontaminate_and_log_dataset(
+                train_dataset, tokenizer, cfg, default_dataset_prepared_path
+            )
         eval_dataset = None
     return train_dataset, eval_dataset, prompters
 
 
+# prompter and prompt tokenizing strategy of the builtin dataset types
+PROMPT_STRATEGIES_BY_BASE_TYPE = {
+    "alpaca": (AlpacaPrompter, AlpacaPromptTokenizingStrategy),
+    "explainchoice": (
+        MultipleChoiceExplainPrompter,
+        AlpacaMultipleChoicePromptTokenizingStrategy,
+    ),
+    "concisechoice": (
+        MultipleChoiceConcisePrompter,
+        AlpacaMultipleChoicePromptTokenizingStrategy,
+    ),
+    "summarizetldr": (SummarizeTLDRPrompter, SummarizeTLDRPromptTokenizingStrategy),
+    "jeopardy": (JeopardyPrompter, JeopardyPromptTokenizingStrategy),
+    "oasst": (AlpacaPrompter, OpenAssistantPromptTokenizingStrategy),
+    "gpteacher": (GPTeacherPrompter, GPTeacherPromptTokenizingStrategy),
+    "reflection": (ReflectAlpacaPrompter, AlpacaReflectionPTStrategy),
+}
+
+
+def get_dataset_strategy(
+    config_dataset,
+    tokenizer,
+    cfg,
+    d_base_type,
+    d_prompt_style=None,
+    processor=None,
+) -> Tuple[
+    Union[PromptTokenizingStrategy, DatasetWrappingStrategy], Optional[Prompter]
+]:
+    """
+    The strategy a dataset is tokenized with and the prompter reported for it, also
+    used on its own for the datasets loaded already tokenized from disk
+    """
+    if isinstance(config_dataset.type, DictDefault):
+        ds_strategy = load(
+            "user_defined", tokenizer, cfg, config_dataset.type.to_dict()
+        )
+        return ds_strategy, UnsupportedPrompter()
+    if ds_strategy := config_dataset.type.startswith(
+        "bradley_terry"
+    ) and bradley_terry_load(
+        config_dataset.type.split(".", 1)[1], tokenizer, cfg, config_dataset
+    ):
+        return ds_strategy, UnsupportedPrompter()
+    if config_dataset.type.startswith("stepwise_supervised"):
+        ds_strategy = load(config_dataset.type, tokenizer, cfg, config_dataset)
+        return ds_strategy, UnsupportedPrompter()
+    if ds_strategy := load(
+        config_dataset.type, tokenizer, cfg, config_dataset, processor=processor
+    ):
+        if isinstance(ds_strategy, DatasetWrappingStrategy):
+            return ds_strategy, None
+        return ds_strategy, UnsupportedPrompter()
+    if d_base_type in PROMPT_STRATEGIES_BY_BASE_TYPE:
+        prompter_cls, strategy_cls = PROMPT_STRATEGIES_BY_BASE_TYPE[d_base_type]
+        dataset_prompter = prompter_cls(d_prompt_style)
+        ds_strategy = strategy_cls(
+            dataset_prompter,
+            tokenizer,
+            cfg.train_on_inputs,
+            cfg.sequence_len,
+        )
+        return ds_strategy, dataset_prompter
+
+    suffix = ""
+    if ":load_" in config_dataset.type:
+        suffix = f" Did you mean {config_dataset.type.replace(':load_', '.load_')}?"
+    LOG.error(
+        f"unhandled prompt tokenization strategy: {config_dataset.type}. {suffix}"
+    )
+    raise ValueError(
+        f"unhandled prompt tokenization strategy: {config_dataset.type} {suffix}"
+    )
+
+
 def get_dataset_wrapper(
     config_dataset,
     tokenizer,
@@ -467,173 +834,35 @@ def get_dataset_wrapper(
         # dataset is already tokenized, just drop it straight in
         dataset_prompter = UnsupportedPrompter()
         dataset_wrapper = dataset
-    elif isinstance(config_dataset.type, DictDefault):
-        ds_strategy = load(
-            "user_defined", tokenizer, cfg, config_dataset.type.to_dict()
-        )
-        dataset_prompter = UnsupportedPrompter()
-        dataset_wrapper = wrap_dataset_for_tokenized_prompt(
-            ds_strategy,
-            dataset,
-            **ds_kwargs,
-        )
-    elif cfg.skip_prepare_dataset:
+    elif cfg.skip_prepare_dataset and not isinstance(config_dataset.type, DictDefault):
         dataset_wrapper = dataset
-    elif ds_strategy := config_dataset.type.startswith(
-        "bradley_terry"
-    ) and bradley_terry_load(
-        config_dataset.type.split(".", 1)[1], tokenizer, cfg, config_dataset
-    ):
-        dataset_prompter = UnsupportedPrompter()
-        dataset_wrapper = wrap_dataset_for_tokenized_prompt(
-            ds_strategy,
-            dataset,
-            **ds_kwargs,
-        )
-    elif config_dataset.type.startswith("stepwise_supervised"):
-        dataset_prompter = UnsupportedPrompter()
-        ds_strategy = load(config_dataset.type, tokenizer, cfg, config_dataset)
-        # we need to explicitly cast boolean labels to int
-        # for compatibility with how trl's PRMTrainer works
-        dataset = dataset.cast_column("labels", Sequence(Value("int64")))
-        dataset_wrapper = TokenizedPromptDataset(
-            ds_strategy,
-            dataset,
-            **ds_kwargs,
+    else:
+        ds_strategy, dataset_prompter = get_dataset_strategy(
+            config_dataset,
+            tokenizer,
+            cfg,
+            d_base_type,
+            d_prompt_style,
+            processor=processor,
         )
-    elif ds_strategy := load(
-        config_dataset.type, tokenizer, cfg, config_dataset, processor=processor
-    ):
         if isinstance(ds_strategy, DatasetWrappingStrategy):
             dataset_wrapper = ds_strategy.wrap_dataset(dataset, **ds_kwargs)
+        elif isinstance(config_dataset.type, str) and config_dataset.type.startswith(
+            "stepwise_supervised"
+        ):
+            # we need to explicitly cast boolean labels to int
+            # for compatibility with how trl's PRMTrainer works
+            dataset = dataset.cast_column("labels", Sequence(Value("int64")))
+            dataset_wrapper = TokenizedPromptDataset(
+                ds_strategy,
+                dataset,
+                **ds_kwargs,
+            )
         else:
-            dataset_prompter = UnsupportedPrompter()
             dataset_wrapper = wrap_dataset_for_tokenized_prompt(
                 ds_strategy,
                 dataset,
                 **ds_kwargs,
             )
-    elif d_base_type == "alpaca":
-        dataset_prompter = AlpacaPrompter(d_prompt_style)
-        ds_strategy = AlpacaPromptTokenizingStrategy(
-            dataset_prompter,
-            tokenizer,
-            cfg.train_on_inputs,
-            cfg.sequence_len,
-        )
-        ds_wrapper = wrap_dataset_for_tokenized_prompt(
-            ds_strategy,
-            dataset,
-            **ds_kwargs,
-        )
-        dataset_wrapper = ds_wrapper
-    elif d_base_type == "explainchoice":
-        dataset_prompter = MultipleChoiceExplainPrompter(d_prompt_style)
-        ds_strategy = AlpacaMultipleChoicePromptTokenizingStrategy(
-            dataset_prompter,
-            tokenizer,
-            cfg.train_on_inputs,
-            cfg.sequence_len,
-        )
-        ds_wrapper = wrap_dataset_for_tokenized_prompt(
-            ds_strategy,
-            dataset,
-            **ds_kwargs,
-        )
-        dataset_wrapper = ds_wrapper
-    elif d_base_type == "concisechoice":
-        dataset_prompter = MultipleChoiceConcisePrompter(d_prompt_style)
-        ds_strategy = AlpacaMultipleChoicePromptTokenizingStrategy(
-            dataset_prompter,
-            tokenizer,
-            cfg.train_on_inputs,
-            cfg.sequence_len,
-        )
-        ds_wrapper = wrap_dataset_for_tokenized_prompt(
-            ds_strategy,
-            dataset,
-            **ds_kwargs,
-        )
-        dataset_wrapper = ds_wrapper
-    elif d_base_type == "summarizetldr":
-        dataset_prompter = SummarizeTLDRPrompter(d_prompt_style)
-        ds_strategy = SummarizeTLDRPromptTokenizingStrategy(
-            dataset_prompter,
-            tokenizer,
-            cfg.train_on_inputs,
-            cfg.sequence_len,
-        )
-        ds_wrapper = wrap_dataset_for_tokenized_prompt(
-            ds_strategy,
-            dataset,
-            **ds_kwargs,
-        )
-        dataset_wrapper = ds_wrapper
-    elif d_base_type == "jeopardy":
-        dataset_prompter = JeopardyPrompter(d_prompt_style)
-        ds_strategy = JeopardyPromptTokenizingStrategy(
-            dataset_prompter,
-            tokenizer,
-            cfg.train_on_inputs,
-            cfg.sequence_len,
-        )
-        ds_wrapper = wrap_dataset_for_tokenized_prompt(
-            ds_strategy,
-            dataset,
-            **ds_kwargs,
-        )
-        dataset_wrapper = ds_wrapper
-    elif d_base_type == "oasst":
-        dataset_prompter = AlpacaPrompter(d_prompt_style)
-        ds_strategy = OpenAssistantPromptTokenizingStrategy(
-            dataset_prompter,
-            tokenizer,
-            cfg.train_on_inputs,
-            cfg.sequence_len,
-        )
-        ds_wrapper = wrap_dataset_for_tokenized_prompt(
-            ds_strategy,
-            dataset,
-            **ds_kwargs,
-        )
-        dataset_wrapper = ds_wrapper
-    elif d_base_type == "gpteacher":
-        dataset_prompter = GPTeacherPrompter(d_prompt_style)
-        ds_strategy = GPTeacherPromptTokenizingStrategy(
-            dataset_prompter,
-            tokenizer,
-            cfg.train_on_inputs,
-            cfg.sequence_len,
-        )
-        ds_wrapper = wrap_dataset_for_tokenized_prompt(
-            ds_strategy,
-            dataset,
-            **ds_kwargs,
-        )
-        dataset_wrapper = ds_wrapper
-    elif d_base_type == "reflection":
-        dataset_prompter = ReflectAlpacaPrompter(d_prompt_style)
-        ds_strategy = AlpacaReflectionPTStrategy(
-            dataset_prompter,
-            tokenizer,
-            cfg.train_on_inputs,
-            cfg.sequence_len,
-        )
-        ds_wrapper = wrap_dataset_for_tokenized_prompt(
-            ds_strategy,
-            dataset,
-            **ds_kwargs,
-        )
-        dataset_wrapper = ds_wrapper
-    else:
-        suffix = ""
-        if ":load_" in config_dataset.type:
-            suffix = f" Did you mean {config_dataset.type.replace(':load_', '.load_')}?"
-        LOG.error(
-            f"unhandled prompt tokenization strategy: {config_dataset.type}. {suffix}"
-        )
-        raise ValueError(
-            f"unhandled prompt tokenization strategy: {config_dataset.type} {suffix}"
-        )
 
     return dataset_wrapper, dataset_prompter
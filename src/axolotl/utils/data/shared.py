@@ -261,3 +261,51 @@ def load_dataset_w_config(
         raise ValueError("unhandled dataset load")
 
     return ds
+
+
+def transform_bench_subject(example):
+    # Split on ':' and trim whitespace
+    parts = example["subject"].split(":")
+    first_part = parts[0].strip().lower().replace("-", "_")  # Lowercase the first part
+    second_part = (
+        parts[1].strip().replace("-", "_") if len(parts) > 1 else "all"
+    )  # Replace hyphens with underscores
+
+    # Return the transformed values
+    return {"name": first_part, "subject": second_part}
+
+
+def load_bench_dataset(bench_dataset: str) -> DatasetDict:
+    """
+    Load a benchmark by its `bench_dataset` name, `mmlu`, `mmlu-zs` or
+    `<org>/<repo>/<data file>`
+    """
+    if bench_dataset == "mmlu-zs":
+        return load_dataset(
+            "openaccess-ai-collective/mmlu-evals",
+            data_files={
+                "eval": "zero_shot_mmlu_val.json",
+                "test": "zero_shot_mmlu_test.json",
+            },
+        )
+    # MMLU Five-shot (Eval/Test only)
+    if bench_dataset in ["mmlu", "mmlu-fs"]:
+        return load_dataset(
+            "openaccess-ai-collective/mmlu-evals",
+            data_files={
+                "eval": "five_shot_mmlu_val.json",
+                "test": "five_shot_mmlu_test.json",
+            },
+        )
+    if "/" in bench_dataset:
+        bench_ds_name = "/".join(bench_dataset.split("/", 2)[:2])
+        bench_ds_data_file = "/".join(bench_dataset.split("/", 2)[2:])
+        dataset = load_dataset(
+            bench_ds_name,
+            data_files={
+                "eval": bench_ds_data_file,
+            },
+        )
+        dataset["eval"] = dataset["eval"].map(transform_bench_subject)
+        return dataset
+    raise ValueError(f"unhandled value `{bench_dataset}` for bench_dataset")
@@ -2,17 +2,34 @@
 
 import functools
 import hashlib
+import json
 import logging
+import os
 import time
 from enum import Enum
+from pathlib import Path
+from typing import Optional
 
 import huggingface_hub
 import numpy as np
 import requests
 from datasets import Dataset, IterableDataset
-
+from transformers import PreTrainedTokenizerBase
+
+from axolotl.utils.data.decontamination import (
+    build_ngram_index,
+    find_contaminated_rows,
+    tokenize_benchmark,
+)
+from axolotl.utils.data.dedup import (
+    MINHASH_NUM_PERM,
+    deduplicate_dataset,
+    minhash_signatures,
+    near_deduplicate_dataset,
+)
+from axolotl.utils.data.shared import load_bench_dataset
+from axolotl.utils.dataset_stats import get_dataset_stats, select_rows
 from axolotl.utils.dict import DictDefault
-from axolotl.utils.samplers.utils import get_dataset_lengths
 from axolotl.utils.trainer import drop_long_seq
 
 LOG = logging.getLogger(__name__)
@@ -69,40 +86,31 @@ def sha256(to_hash: str, encoding: str = "utf-8") -> str:
     return hashlib.sha256(to_hash.encode(encoding)).hexdigest()
 
 
-def deduplicate_dataset(
-    dataset: Dataset, seen_hashes: dict[str, list[int]], other_dataset: Dataset = None
-) -> Dataset:
-    unique_indices = []
-
-    for idx, row in enumerate(dataset):
-        row_hash = sha256(str(row))  # Using SHA256 for collision resistance.
-        if row_hash not in seen_hashes:
-            seen_hashes[row_hash] = [idx]
-            unique_indices.append(idx)
-        else:
-            # Check for collision by looking up the original dataset indices
-            original_indices = seen_hashes[row_hash]
-            is_duplicate = False
-            for original_idx in original_indices:
-                if (
-                    not idx == original_idx
-                    and original_idx < len(dataset)
-                    and str(dataset[original_idx]) == str(row)
-                ):
-                    is_duplicate = True
-                    break
-                # Check in the other dataset if provided
-                if other_dataset is not None:
-                    if original_idx < len(other_dataset) and str(
-                        other_dataset[original_idx]
-                    ) == str(row):
-                        is_duplicate = True
-                        break
-            if not is_duplicate:
-                seen_hashes[row_hash].append(idx)
-                unique_indices.append(idx)
-                continue
-    return dataset.select(unique_indices)
+def get_tokenizer_fingerprint(tokenizer: PreTrainedTokenizerBase) -> str:
+    """
+    Hash of everything about a tokenizer that affects tokenization. Unlike
+    hashing the tokenizer object, this doesn't change once the tokenizer's
+    truncation or padding state has been set by a call.
+    """
+    if tokenizer.is_fast:
+        backend = json.loads(tokenizer.backend_tokenizer.to_str())
+        backend.pop("truncation", None)
+        backend.pop("padding", None)
+    else:
+        backend = sorted(tokenizer.get_vocab().items())
+    return md5(
+        json.dumps(
+            [
+                type(tokenizer).__name__,
+                backend,
+                tokenizer.special_tokens_map,
+                tokenizer.chat_template,
+                tokenizer.padding_side,
+            ],
+            sort_keys=True,
+            default=str,
+        )
+    )
 
 
 def deduplicate_and_log_datasets(
@@ -110,23 +118,22 @@ def deduplicate_and_log_datasets(
     train_dataset: Dataset = None,
     eval_dataset: Dataset = None,
     dataset: Dataset = None,
+    num_proc: Optional[int] = None,
 ) -> tuple[Dataset, Dataset, Dataset]:
     """
     Deduplicates train, eval, and an optional dataset if provided, logging original and new sizes.
+    Eval rows that also appear in the train dataset are dropped.
 
     Returns:
         tuple: Deduplicated train, eval, and additional datasets.
     """
-    seen_hashes: dict[str, list[int]] = {}
 
     # Handle cases where datasets are None
     if train_dataset is not None:
         LOG.info(
             f"Starting deduplication for train dataset. Original size: {len(train_dataset)}"
         )
-        train_dataset = deduplicate_dataset(
-            dataset=train_dataset, seen_hashes=seen_hashes
-        )
+        train_dataset = deduplicate_dataset(train_dataset, num_proc=num_proc)
         LOG.info(
             f"Deduplication complete for train dataset. New size: {len(train_dataset)}"
         )
@@ -138,7 +145,7 @@ def deduplicate_and_log_datasets(
             f"Starting deduplication for eval dataset. Original size: {len(eval_dataset)}"
         )
         eval_dataset = deduplicate_dataset(
-            dataset=eval_dataset, seen_hashes=seen_hashes, other_dataset=train_dataset
+            eval_dataset, other_dataset=train_dataset, num_proc=num_proc
         )
         LOG.info(
             f"Deduplication complete for eval dataset. New size: {len(eval_dataset)}"
@@ -150,7 +157,7 @@ def deduplicate_and_log_datasets(
         LOG.info(
             f"Starting deduplication for combined dataset. Original size: {len(dataset)}"
         )
-        dataset = deduplicate_dataset(dataset=dataset, seen_hashes=seen_hashes)
+        dataset = deduplicate_dataset(dataset, num_proc=num_proc)
         LOG.info(
             f"Deduplication complete for combined dataset. New size: {len(dataset)}"
         )
@@ -158,52 +165,150 @@ def deduplicate_and_log_datasets(
     return train_dataset, eval_dataset, dataset
 
 
-def drop_long_seq_in_dataset(dataset: Dataset, cfg: DictDefault):
+def near_deduplicate_and_log_dataset(
+    dataset: Dataset, cfg: DictDefault, default_dataset_prepared_path
+) -> Dataset:
+    """
+    Keeps one row of every cluster of near duplicate rows. The MinHash signatures
+    are cached next to the prepared datasets and reused by later runs.
+    """
     if "input_ids" not in dataset.column_names:
         LOG.warning(
-            "Dataset does not contain 'input_ids' column. Skip drop long seq. This is expected for RewardModeling."
+            "Dataset does not contain 'input_ids' column. Skip near deduplication."
         )
         return dataset
 
-    drop_long = functools.partial(
-        drop_long_seq,
-        sequence_len=cfg.sequence_len,
-        min_sequence_len=cfg.min_sample_len,
+    ngram_size = cfg.dataset_near_dedup_ngram_size or 5
+    threshold = cfg.dataset_near_dedup_threshold or 0.8
+    fingerprint = dataset._fingerprint  # pylint: disable=protected-access
+    signatures_hash = md5(f"{fingerprint}|{ngram_size}|{MINHASH_NUM_PERM}")
+    signatures_path = (
+        Path(cfg.dataset_prepared_path or default_dataset_prepared_path)
+        / "minhash"
+        / f"{signatures_hash}.npy"
     )
+    if signatures_path.exists():
+        LOG.info(f"Loading MinHash signatures from disk at {signatures_path}...")
+        signatures = np.load(signatures_path)
+    else:
+        signatures = minhash_signatures(
+            dataset, ngram_size=ngram_size, num_proc=cfg.dataset_processes
+        )
+        if cfg.local_rank == 0 and not cfg.skip_prepare_dataset:
+            LOG.info(f"Saving MinHash signatures to disk... {signatures_path}")
+            signatures_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = signatures_path.with_suffix(f".tmp-{os.getpid()}.npy")
+            np.save(tmp_path, signatures)
+            os.replace(tmp_path, signatures_path)
+
+    LOG.info(
+        f"Starting near deduplication at threshold {threshold}. Original size: {len(dataset)}"
+    )
+    dataset = near_deduplicate_dataset(dataset, signatures, threshold)
+    LOG.info(f"Near deduplication complete. New size: {len(dataset)}")
+    return dataset
 
-    try:
-        ds_lengths = get_dataset_lengths(dataset, from_arrow=True)
-        min_input_len = np.min(ds_lengths)
-        LOG.info(f"min_input_len: {min_input_len}")
-        max_input_len = np.max(ds_lengths)
-        LOG.info(f"max_input_len: {max_input_len}")
-    except AttributeError:
-        pass
 
-    try:
-        prior_len = len(dataset)
-    except TypeError:
-        # handle iterable datasets case
-        prior_len = None
+def get_decontamination_index(
+    tokenizer, cfg, default_dataset_prepared_path
+) -> np.ndarray:
+    """
+    n-gram index of the `decontamination_datasets` benchmarks, built once and
+    saved next to the prepared datasets
+    """
+    ngram_size = cfg.decontamination_ngram_size or 13
+    index_hash = md5(
+        "|".join(
+            sorted(cfg.decontamination_datasets)
+            + [str(ngram_size), get_tokenizer_fingerprint(tokenizer)]
+        )
+    )
+    index_path = (
+        Path(cfg.dataset_prepared_path or default_dataset_prepared_path)
+        / "decontamination"
+        / f"{index_hash}.npy"
+    )
+    if index_path.exists():
+        LOG.info(f"Loading decontamination index from disk at {index_path}...")
+        return np.load(index_path)
+
+    benchmarks = []
+    for bench_dataset in cfg.decontamination_datasets:
+        for split in load_bench_dataset(bench_dataset).values():
+            benchmarks.append(
+                tokenize_benchmark(split, tokenizer, num_proc=cfg.dataset_processes)
+            )
+    index = build_ngram_index(benchmarks, ngram_size)
+    LOG.info(f"Built decontamination index of {len(index)} {ngram_size}-grams")
+    if cfg.local_rank == 0 and not cfg.skip_prepare_dataset:
+        LOG.info(f"Saving decontamination index to disk... {index_path}")
+        index_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = index_path.with_suffix(f".tmp-{os.getpid()}.npy")
+        np.save(tmp_path, index)
+        os.replace(tmp_path, index_path)
+    return index
+
+
+def decontaminate_and_log_dataset(
+    dataset: Dataset, tokenizer, cfg, default_dataset_prepared_path
+) -> Dataset:
+    """
+    Drop, or only report with `decontamination_action: tag`, the rows sharing a
+    token n-gram with the `decontamination_datasets` benchmarks
+    """
+    if "input_ids" not in dataset.column_names:
+        LOG.warning(
+            "Dataset does not contain 'input_ids' column. Skip decontamination."
+        )
+        return dataset
 
-    filter_map_kwargs = {}
-    if not isinstance(dataset, IterableDataset):
-        filter_map_kwargs["num_proc"] = cfg.dataset_processes
-        filter_map_kwargs["load_from_cache_file"] = not cfg.is_preprocess
-
-    drop_long_kwargs = {}
-    if filter_map_kwargs:
-        drop_long_kwargs["desc"] = "Dropping Long Sequences"
-
-    dataset = dataset.filter(
-        drop_long,
-        batched=True,
-        **filter_map_kwargs,
-        **drop_long_kwargs,
+    ngram_size = cfg.decontamination_ngram_size or 13
+    index = get_decontamination_index(tokenizer, cfg, default_dataset_prepared_path)
+    contaminated = find_contaminated_rows(
+        dataset, index, ngram_size, num_proc=cfg.dataset_processes
     )
-    if prior_len:
-        dropped = prior_len - len(dataset)
+    LOG.info(
+        f"Found {contaminated.sum()} of {len(dataset)} rows overlapping "
+        f"{', '.join(cfg.decontamination_datasets)}"
+    )
+    if cfg.decontamination_action == "tag":
+        if cfg.local_rank == 0 and contaminated.any():
+            fingerprint = dataset._fingerprint  # pylint: disable=protected-access
+            tags_path = (
+                Path(cfg.dataset_prepared_path or default_dataset_prepared_path)
+                / "decontamination"
+                / f"{fingerprint}-contaminated.npy"
+            )
+            tags_path.parent.mkdir(parents=True, exist_ok=True)
+            np.save(tags_path, np.nonzero(contaminated)[0])
+            LOG.info(f"Saved indices of the contaminated rows to {tags_path}")
+        return dataset
+    return select_rows(dataset, ~contaminated)
+
+
+def drop_long_seq_in_dataset(dataset: Dataset, cfg: DictDefault):
+    if "input_ids" not in dataset.column_names:
+        LOG.warning(
+            "Dataset does not contain 'input_ids' column. Skip drop long seq. This is expected for RewardModeling."
+        )
+        return dataset
+
+    if not isinstance(dataset, IterableDataset):
+        stats = get_dataset_stats(dataset)
+        if len(stats.lengths):
+            LOG.info(f"min_input_len: {np.min(stats.lengths)}")
+            LOG.info(f"max_input_len: {np.max(stats.lengths)}")
+        min_sequence_len = cfg.min_sample_len or 2
+        keep = (stats.lengths >= min_sequence_len) & (stats.lengths <= cfg.sequence_len)
+        dropped = int((~keep).sum())
         if dropped:
             LOG.warning(f"Dropped {dropped} long samples from dataset")
+        return select_rows(dataset, keep)
 
-    return dataset
+    # streaming datasets are filtered as they are iterated
+    drop_long = functools.partial(
+        drop_long_seq,
+        sequence_len=cfg.sequence_len,
+        min_sequence_len=cfg.min_sample_len,
+    )
+    return dataset.filter(drop_long, batched=True)
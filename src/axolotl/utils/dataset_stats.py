@@ -0,0 +1,403 @@
+"""
+per row token statistics of tokenized datasets, computed with pyarrow.compute in a
+single vectorized sweep over the list columns
+"""
+
+import json
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass, fields, replace
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Union
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+from datasets import Dataset
+
+from axolotl.datasets import SOURCE_COLUMN, TokenStore
+from axolotl.prompters import IGNORE_TOKEN_ID
+from axolotl.utils.compact_schema import LABEL_MASK, label_mask_stats
+
+LOG = logging.getLogger("axolotl")
+
+# stats of the most recently used datasets, by fingerprint
+STATS_CACHE_SIZE = 8
+# sidecar directory of the stats of a prepared dataset saved to disk
+STATS_DIR = "axolotl_stats"
+STATS_ARRAYS = (
+    "lengths",
+    "label_lengths",
+    "supervised_tokens",
+    "position_lengths",
+)
+_STATS_CACHE: "OrderedDict[str, DatasetStats]" = OrderedDict()
+
+
+@dataclass
+class DatasetStats:
+    """
+    Per row statistics of a tokenized dataset: the length of `input_ids`, and the
+    length of `labels` and how many of them are trained on when it has labels.
+    `position_lengths` (last position id + 1) are filled in on first use, and
+    `sources` holds the index of the configured dataset each row came from, read
+    from its `SOURCE_COLUMN` when it has one.
+    """
+
+    lengths: np.ndarray
+    label_lengths: Optional[np.ndarray] = None
+    supervised_tokens: Optional[np.ndarray] = None
+    position_lengths: Optional[np.ndarray] = None
+    sources: Optional[np.ndarray] = None
+
+    @property
+    def num_tokens(self) -> int:
+        return int(self.lengths.sum(dtype=np.int64))
+
+    @property
+    def num_supervised_tokens(self) -> int:
+        if self.supervised_tokens is None:
+            return 0
+        return int(self.supervised_tokens.sum(dtype=np.int64))
+
+    @property
+    def trainable_mask(self) -> np.ndarray:
+        """rows with at least one token trained on, rows without labels are kept"""
+        if self.supervised_tokens is None or self.label_lengths is None:
+            return np.ones(len(self.lengths), dtype=bool)
+        return (self.supervised_tokens > 0) | (self.label_lengths == 0)
+
+    def select(self, indices: np.ndarray) -> "DatasetStats":
+        return replace(
+            self,
+            **{
+                field.name: (
+                    None
+                    if getattr(self, field.name) is None
+                    else getattr(self, field.name)[indices]
+                )
+                for field in fields(self)
+            },
+        )
+
+
+def _list_lengths(column: pa.ChunkedArray) -> np.ndarray:
+    return (
+        pc.list_value_length(column)
+        .fill_null(0)
+        .to_numpy()
+        .astype(np.int32, copy=False)
+    )
+
+
+def _count_not_equal(column: pa.ChunkedArray, value: int) -> np.ndarray:
+    """number of items of every list of `column` different from `value`"""
+    counts = []
+    for chunk in column.chunks:
+        # the offsets of a sliced list array index into its unsliced values
+        offsets = chunk.offsets.to_numpy()
+        not_equal = (
+            pc.not_equal(chunk.values, value)
+            .fill_null(False)
+            .to_numpy(zero_copy_only=False)
+        )
+        cumsum = np.zeros(len(not_equal) + 1, dtype=np.int64)
+        np.cumsum(not_equal, out=cumsum[1:])
+        chunk_counts = cumsum[offsets[1:]] - cumsum[offsets[:-1]]
+        if chunk.null_count:
+            chunk_counts[chunk.is_null().to_numpy(zero_copy_only=False)] = 0
+        counts.append(chunk_counts.astype(np.int32))
+    if not counts:
+        return np.zeros(0, dtype=np.int32)
+    return np.concatenate(counts)
+
+
+def _row_indices(dataset: Dataset) -> Optional[np.ndarray]:
+    # rows of the underlying table selected by a filter, shuffle or split
+    if dataset._indices is None:  # pylint: disable=protected-access
+        return None
+    return dataset._indices.column(0).to_numpy()  # pylint: disable=protected-access
+
+
+def _dataset_sources(dataset: Union[Dataset, TokenStore]) -> Optional[np.ndarray]:
+    if isinstance(dataset, TokenStore):
+        return dataset.sources
+    if SOURCE_COLUMN not in dataset.column_names:
+        return None
+    sources = dataset.data.column(SOURCE_COLUMN).to_numpy().astype(np.int32)
+    indices = _row_indices(dataset)
+    return sources if indices is None else sources[indices]
+
+
+def compute_dataset_stats(dataset: Union[Dataset, TokenStore]) -> DatasetStats:
+    if isinstance(dataset, TokenStore):
+        lengths = dataset.lengths
+        return DatasetStats(
+            lengths=lengths,
+            label_lengths=lengths if "labels" in dataset.column_names else None,
+            supervised_tokens=(
+                dataset.supervised_counts if "labels" in dataset.column_names else None
+            ),
+            sources=dataset.sources,
+        )
+
+    table = dataset.data
+    stats = DatasetStats(lengths=_list_lengths(table.column("input_ids")))
+    if "labels" in dataset.column_names:
+        labels = table.column("labels")
+        stats.label_lengths = _list_lengths(labels)
+        stats.supervised_tokens = _count_not_equal(labels, IGNORE_TOKEN_ID)
+    elif LABEL_MASK in dataset.column_names:
+        stats.label_lengths, stats.supervised_tokens = label_mask_stats(
+            table.column(LABEL_MASK), stats.lengths
+        )
+
+    indices = _row_indices(dataset)
+    if indices is not None:
+        stats = stats.select(indices)
+    stats.sources = _dataset_sources(dataset)
+    return stats
+
+
+def cache_dataset_stats(dataset: Union[Dataset, TokenStore], stats: DatasetStats):
+    fingerprint = getattr(dataset, "_fingerprint", None)
+    if fingerprint is None:
+        return
+    _STATS_CACHE[fingerprint] = stats
+    _STATS_CACHE.move_to_end(fingerprint)
+    while len(_STATS_CACHE) > STATS_CACHE_SIZE:
+        _STATS_CACHE.popitem(last=False)
+
+
+def get_dataset_stats(dataset: Union[Dataset, TokenStore]) -> DatasetStats:
+    """per row statistics of `dataset`, computed once per dataset fingerprint"""
+    fingerprint = getattr(dataset, "_fingerprint", None)
+    if fingerprint is not None and fingerprint in _STATS_CACHE:
+        _STATS_CACHE.move_to_end(fingerprint)
+        return _STATS_CACHE[fingerprint]
+
+    stats = compute_dataset_stats(dataset)
+    cache_dataset_stats(dataset, stats)
+    return stats
+
+
+def carry_dataset_stats(
+    dataset: Union[Dataset, TokenStore],
+    from_dataset: Union[Dataset, TokenStore],
+    indices: Optional[np.ndarray] = None,
+):
+    """
+    Cache the known stats of `from_dataset` for `dataset`, made of its rows at
+    `indices`, or of all of its rows in order, e.g. after adding a column
+    """
+    fingerprint = getattr(from_dataset, "_fingerprint", None)
+    stats = None if fingerprint is None else _STATS_CACHE.get(fingerprint)
+    if stats is not None:
+        cache_dataset_stats(
+            dataset, replace(stats) if indices is None else stats.select(indices)
+        )
+
+
+def select_rows(dataset: Union[Dataset, TokenStore], keep: np.ndarray):
+    """the rows of `dataset` where `keep` is set, carrying over their stats"""
+    if keep.all():
+        return dataset
+    indices = np.flatnonzero(keep)
+    selected = dataset.select(indices)
+    carry_dataset_stats(selected, dataset, indices)
+    return selected
+
+
+def list_last_values(dataset: Dataset, column: str) -> np.ndarray:
+    """the last item of every list of `column`, -1 for empty lists"""
+    last_values = []
+    for chunk in dataset.data.column(column).chunks:
+        offsets = chunk.offsets.to_numpy()
+        values = chunk.values.to_numpy(zero_copy_only=False)
+        chunk_last = np.full(len(chunk), -1, dtype=np.int32)
+        non_empty = offsets[1:] > offsets[:-1]
+        chunk_last[non_empty] = values[offsets[1:][non_empty] - 1]
+        last_values.append(chunk_last)
+    last = np.concatenate(last_values) if last_values else np.zeros(0, np.int32)
+
+    indices = _row_indices(dataset)
+    return last if indices is None else last[indices]
+
+
+def shuffle_dataset(dataset: Dataset, seed: int) -> Dataset:
+    """`dataset.shuffle`, carrying over the stats of the rows"""
+    shuffled = dataset.shuffle(seed=seed)
+    indices = _row_indices(shuffled)
+    if _row_indices(dataset) is None and indices is not None:
+        carry_dataset_stats(shuffled, dataset, indices)
+    return shuffled
+
+
+def get_position_lengths(dataset: Dataset) -> np.ndarray:
+    """the last position id + 1 of every row, computed once per fingerprint"""
+    stats = get_dataset_stats(dataset)
+    if stats.position_lengths is None:
+        stats.position_lengths = list_last_values(dataset, "position_ids") + 1
+    return stats.position_lengths
+
+
+def save_dataset_stats(
+    path: Union[str, Path],
+    dataset: Dataset,
+    source_datasets: Optional[List[Dict[str, Any]]] = None,
+):
+    """
+    Write the stats of a prepared dataset next to it: int32 arrays of the per row
+    counts, and a summary with a length histogram and the rows of every source,
+    given by `source_datasets` in the order of `stats.sources`
+    """
+    stats = get_dataset_stats(dataset)
+    if "position_ids" in dataset.column_names:
+        get_position_lengths(dataset)
+
+    stats_dir = Path(path) / STATS_DIR
+    stats_dir.mkdir(parents=True, exist_ok=True)
+    for name in STATS_ARRAYS:
+        values = getattr(stats, name)
+        if values is not None:
+            np.save(stats_dir / f"{name}.npy", values.astype(np.int32, copy=False))
+
+    summary = {
+        # of the dataset saved at `path`, as in its state.json
+        "fingerprint": dataset._fingerprint,  # pylint: disable=protected-access
+        "num_rows": len(stats.lengths),
+        "num_tokens": stats.num_tokens,
+        "num_supervised_tokens": stats.num_supervised_tokens,
+    }
+    if len(stats.lengths):
+        counts, bin_edges = np.histogram(stats.lengths, bins=32)
+        summary.update(
+            min_length=int(stats.lengths.min()),
+            max_length=int(stats.lengths.max()),
+            length_histogram={
+                "bin_edges": bin_edges.tolist(),
+                "counts": counts.tolist(),
+            },
+        )
+    if stats.sources is not None and source_datasets:
+        rows = np.bincount(stats.sources, minlength=len(source_datasets))
+        summary["sources"] = [
+            {**source, "num_rows": int(num_rows)}
+            for source, num_rows in zip(source_datasets, rows)
+        ]
+    with open(stats_dir / "stats.json", "w", encoding="utf-8") as fout:
+        json.dump(summary, fout, indent=2)
+
+
+def _saved_fingerprint(path: Path) -> Optional[str]:
+    """fingerprint of the dataset `save_to_disk` wrote to `path`"""
+    try:
+        with open(path / "state.json", encoding="utf-8") as fin:
+            return json.load(fin).get("_fingerprint")
+    except (OSError, ValueError):
+        return None
+
+
+def _remap_sources(
+    sources: np.ndarray,
+    saved_sources: List[Dict[str, Any]],
+    source_datasets: List[Dict[str, Any]],
+) -> Optional[np.ndarray]:
+    """
+    `sources` as indices into `source_datasets` instead of the sources the dataset
+    was saved with, or None when one of them is not configured anymore
+    """
+    if len(saved_sources) <= sources.max(initial=-1):
+        return None
+    unmatched = list(range(len(source_datasets)))
+    mapping = np.zeros(len(saved_sources), dtype=np.int32)
+    for saved_idx, saved in enumerate(saved_sources):
+        saved = {key: value for key, value in saved.items() if key != "num_rows"}
+        # identical sources are matched in order
+        idx = next((i for i in unmatched if source_datasets[i] == saved), None)
+        if idx is None:
+            return None
+        unmatched.remove(idx)
+        mapping[saved_idx] = idx
+    return mapping[sources]
+
+
+def load_dataset_stats(path: Union[str, Path], dataset: Dataset) -> bool:
+    """
+    Cache the stats saved next to a prepared dataset loaded from `path`, if they
+    were saved for it. Returns whether they were loaded.
+    """
+    stats_dir = Path(path) / STATS_DIR
+    if (
+        not (stats_dir / "lengths.npy").exists()
+        or not (stats_dir / "stats.json").exists()
+    ):
+        return False
+    with open(stats_dir / "stats.json", encoding="utf-8") as fin:
+        summary = json.load(fin)
+    # `load_from_disk` gives the dataset a new fingerprint, so compare with the
+    # one it was saved with
+    if summary.get("fingerprint") != _saved_fingerprint(Path(path)):
+        LOG.warning(f"Ignoring stats in {stats_dir} of another dataset")
+        return False
+    arrays = {
+        name: np.load(stats_dir / f"{name}.npy")
+        for name in STATS_ARRAYS
+        if (stats_dir / f"{name}.npy").exists()
+    }
+    stats = DatasetStats(**arrays, sources=_dataset_sources(dataset))
+    if len(stats.lengths) != len(dataset):
+        LOG.warning(f"Ignoring stats in {stats_dir} of another dataset")
+        return False
+    cache_dataset_stats(dataset, stats)
+    LOG.info(
+        f"Loaded stats of the prepared dataset: {stats.num_tokens:_} tokens, "
+        f"{stats.num_supervised_tokens:_} supervised"
+    )
+    return True
+
+
+def add_dataset_sources(dataset: Dataset, sources: np.ndarray) -> Dataset:
+    """`dataset` with its `SOURCE_COLUMN` set to `sources`"""
+    if SOURCE_COLUMN in dataset.column_names:
+        with_sources = dataset.remove_columns(SOURCE_COLUMN)
+    else:
+        with_sources = dataset
+    with_sources = with_sources.add_column(
+        SOURCE_COLUMN, np.asarray(sources, dtype=np.int32)
+    )
+    carry_dataset_stats(with_sources, dataset)
+    get_dataset_stats(with_sources).sources = _dataset_sources(with_sources)
+    return with_sources
+
+
+def remap_dataset_sources(
+    path: Union[str, Path],
+    dataset: Dataset,
+    source_datasets: List[Dict[str, Any]],
+) -> Dataset:
+    """
+    A prepared dataset loaded from `path` may be shared by configs listing its
+    datasets in another order, so its `SOURCE_COLUMN` is remapped to index the
+    `source_datasets` of the current config, or dropped when they don't match.
+    """
+    sources = _dataset_sources(dataset)
+    if sources is None:
+        return dataset
+    saved_sources = []
+    if (Path(path) / STATS_DIR / "stats.json").exists():
+        with open(Path(path) / STATS_DIR / "stats.json", encoding="utf-8") as fin:
+            saved_sources = json.load(fin).get("sources", [])
+    remapped = _remap_sources(sources, saved_sources, source_datasets)
+    if remapped is None:
+        LOG.warning(
+            f"Ignoring the sources of the rows of {path}, "
+            "they do not match the configured datasets"
+        )
+        without_sources = dataset.remove_columns(SOURCE_COLUMN)
+        carry_dataset_stats(without_sources, dataset)
+        get_dataset_stats(without_sources).sources = None
+        return without_sources
+    if np.array_equal(remapped, sources):
+        return dataset
+    return add_dataset_sources(dataset, remapped)
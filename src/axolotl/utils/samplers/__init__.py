@@ -1,5 +1,11 @@
 """
 axolotl samplers module
 """
+from .cost import PackingCostModel  # noqa: F401
+from .mixture import (  # noqa: F401
+    MixtureSampler,
+    get_mixture_sampler,
+    get_sample_ratios,
+)
 from .multipack import MultipackBatchSampler  # noqa: F401
-from .utils import get_dataset_lengths  # noqa: F401
+from .utils import get_dataset_cache_dir, get_dataset_lengths  # noqa: F401
@@ -0,0 +1,104 @@
+"""
+attention cost model and cost balancing for packed bins
+"""
+import logging
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
+
+LOG = logging.getLogger("axolotl.utils.samplers.cost")
+
+
+@dataclass(frozen=True)
+class PackingCostModel:
+    """
+    Estimated compute of a packed sequence. With varlen flash attention every
+    document only attends to itself, so a document of `n` tokens costs roughly
+    `linear * n + quadratic * n**2`.
+    """
+
+    linear: float = 1.0
+    quadratic: float = 0.0
+
+    @classmethod
+    def from_terms(
+        cls, linear: Optional[float] = None, quadratic: Optional[float] = None
+    ) -> "PackingCostModel":
+        # unset terms keep their defaults, an explicit 0 is kept as is
+        terms = {"linear": linear, "quadratic": quadratic}
+        return cls(
+            **{name: value for name, value in terms.items() if value is not None}
+        )
+
+    @classmethod
+    def for_hidden_size(cls, hidden_size: int) -> "PackingCostModel":
+        # per layer, the projections + MLP are ~24 * n * d^2 flops and causal
+        # attention ~2 * n^2 * d, normalized to one unit per token
+        return cls(linear=1.0, quadratic=1.0 / (12 * hidden_size))
+
+    def __call__(self, lengths: np.ndarray) -> np.ndarray:
+        lengths = np.asarray(lengths, dtype=np.float64)
+        return self.linear * lengths + self.quadratic * lengths * lengths
+
+
+def rank_imbalance(bin_costs: np.ndarray, bins_per_rank: int, num_ranks: int):
+    """
+    Mean over full steps of the slowest rank's cost relative to the average rank,
+    assuming consecutive batches of `bins_per_rank` bins go round robin to ranks
+    """
+    step_size = bins_per_rank * num_ranks
+    num_steps = len(bin_costs) // step_size
+    if not num_steps:
+        return 0.0
+    rank_costs = (
+        bin_costs[: num_steps * step_size]
+        .reshape(num_steps, num_ranks, bins_per_rank)
+        .sum(axis=-1)
+    )
+    return float(np.mean(rank_costs.max(axis=1) / rank_costs.mean(axis=1)) - 1.0)
+
+
+def balance_bins(
+    bin_costs: np.ndarray,
+    bins_per_rank: int,
+    num_ranks: int = 1,
+    rng: Optional[np.random.Generator] = None,
+    bin_tokens: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """
+    Order bins so every step (`num_ranks` consecutive batches of `bins_per_rank`
+    bins) holds bins of similar cost, split across ranks in a snake order so the
+    per-rank totals match. Steps are then shuffled so expensive steps are spread
+    over the epoch. Returns the new order of the bins.
+    """
+    rng = rng or np.random.default_rng()
+    step_size = bins_per_rank * num_ranks
+    by_cost = np.argsort(-bin_costs, kind="stable")
+    num_steps = len(bin_costs) // step_size
+
+    # bin j of a cost sorted step goes to rank j % num_ranks on even rounds and
+    # num_ranks - 1 - j % num_ranks on odd rounds, then each rank's bins are laid
+    # out contiguously as that rank's batch
+    slot = np.arange(step_size)
+    rounds, pos = slot // num_ranks, slot % num_ranks
+    ranks = np.where(rounds % 2 == 0, pos, num_ranks - 1 - pos)
+    step_layout = np.argsort(ranks * bins_per_rank + rounds, kind="stable")
+
+    steps = by_cost[: num_steps * step_size].reshape(num_steps, step_size)
+    steps = steps[:, step_layout][rng.permutation(num_steps)]
+
+    order = np.concatenate([steps.reshape(-1), by_cost[num_steps * step_size :]])
+
+    LOG.info(
+        "predicted per-rank cost imbalance: "
+        f"{rank_imbalance(bin_costs, bins_per_rank, num_ranks):.2%} -> "
+        f"{rank_imbalance(bin_costs[order], bins_per_rank, num_ranks):.2%}"
+    )
+    if bin_tokens is not None:
+        LOG.info(
+            "predicted per-rank token imbalance: "
+            f"{rank_imbalance(bin_tokens, bins_per_rank, num_ranks):.2%} -> "
+            f"{rank_imbalance(bin_tokens[order], bins_per_rank, num_ranks):.2%}"
+        )
+    return order
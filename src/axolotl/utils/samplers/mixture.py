@@ -0,0 +1,129 @@
+"""
+Weighted mixture of the datasets a prepared dataset was merged from, drawn as an
+index array every epoch instead of copying rows
+"""
+
+import json
+import logging
+from typing import List, Optional, Sequence
+
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+
+from axolotl.utils.dataset_stats import get_dataset_stats
+
+LOG = logging.getLogger("axolotl.utils.samplers.mixture")
+
+
+class MixtureSampler(Sampler[int]):
+    """
+    Sampler drawing `sample_ratios[i]` times the rows of the `i`th dataset every
+    epoch, given the dataset each row comes from. Whole multiples of a dataset
+    repeat all of its rows, the fraction left is sampled without replacement. The
+    draw depends only on `generator`, so seeding it (like the multipack sampler
+    does with `seed + epoch`) gives a reproducible mixture per epoch.
+    """
+
+    def __init__(
+        self,
+        sources: np.ndarray,
+        sample_ratios: Sequence[float],
+        shuffle: bool = True,
+        generator: Optional[torch.Generator] = None,
+    ):
+        super().__init__()
+        if sources.size and sources.max() >= len(sample_ratios):
+            raise ValueError(
+                f"rows come from {sources.max() + 1} datasets, "
+                f"but only {len(sample_ratios)} sample ratios are set"
+            )
+        self.sample_ratios = [float(ratio) for ratio in sample_ratios]
+        self.shuffle = shuffle
+        self.generator = generator
+
+        order = np.argsort(sources, kind="stable")
+        counts = np.bincount(sources, minlength=len(sample_ratios))
+        self._rows = np.split(order, np.cumsum(counts)[:-1])
+        self._num_samples = [
+            int(round(ratio * len(rows)))
+            for ratio, rows in zip(self.sample_ratios, self._rows)
+        ]
+
+    @property
+    def cache_key(self) -> str:
+        return json.dumps(
+            {"sample_ratios": self.sample_ratios, "shuffle": self.shuffle}
+        )
+
+    def draw(self, rng: np.random.Generator) -> np.ndarray:
+        indices = []
+        for rows, num_samples in zip(self._rows, self._num_samples):
+            if not rows.size:
+                continue
+            num_repeats, num_left = divmod(num_samples, len(rows))
+            indices.append(np.tile(rows, num_repeats))
+            indices.append(rng.choice(rows, num_left, replace=False))
+        if not indices:
+            return np.zeros(0, dtype=np.int64)
+        mixture = np.concatenate(indices).astype(np.int64)
+        return rng.permutation(mixture) if self.shuffle else np.sort(mixture)
+
+    def __iter__(self):
+        if self.generator is None:
+            seed = int(torch.empty((), dtype=torch.int64).random_().item())
+        else:
+            seed = int(
+                torch.empty((), dtype=torch.int64)
+                .random_(generator=self.generator)
+                .item()
+            )
+        yield from self.draw(np.random.default_rng(seed)).tolist()
+
+    def __len__(self):
+        return sum(self._num_samples)
+
+    def num_tokens(self, lengths: np.ndarray) -> int:
+        """expected number of tokens of an epoch"""
+        return int(
+            sum(
+                lengths[rows].sum(dtype=np.int64) * num_samples / len(rows)
+                for rows, num_samples in zip(self._rows, self._num_samples)
+                if rows.size
+            )
+        )
+
+
+def get_sample_ratios(cfg_datasets) -> Optional[List[float]]:
+    """
+    the `sample_ratio` of every dataset merged into the prepared dataset, in the
+    order they are merged, or None when none is set
+    """
+    # the data loading utils depend on the samplers
+    from axolotl.utils.data.shared import datasets_w_name_generator
+
+    if not cfg_datasets or all(
+        dataset.sample_ratio is None for dataset in cfg_datasets
+    ):
+        return None
+    return [
+        1.0 if dataset.sample_ratio is None else dataset.sample_ratio
+        for dataset in datasets_w_name_generator(cfg_datasets)
+    ]
+
+
+def get_mixture_sampler(
+    dataset,
+    sample_ratios: Optional[Sequence[float]],
+    shuffle: bool = True,
+    generator: Optional[torch.Generator] = None,
+) -> Optional[MixtureSampler]:
+    if not sample_ratios:
+        return None
+    sources = get_dataset_stats(dataset).sources
+    if sources is None:
+        raise ValueError(
+            "`sample_ratio` is set but the dataset each row comes from isn't known, "
+            "prepare the datasets again to record it"
+        )
+    return MixtureSampler(sources, sample_ratios, shuffle=shuffle, generator=generator)
@@ -2,15 +2,24 @@
 """
 Multipack Batch Sampler
 """
+import hashlib
+import json
 import logging
 import math
-from typing import Any, Iterable, List, Union
+import multiprocessing
+import multiprocessing.pool
+import os
+import weakref
+from typing import Any, Iterable, List, Optional, Tuple, Union
 
 import numba
 import numpy as np
-from torch.utils.data import BatchSampler, Sampler
+import torch
+from torch.utils.data import BatchSampler, RandomSampler, Sampler
 
 from axolotl.utils.distributed import reduce_and_broadcast
+from axolotl.utils.samplers.cost import PackingCostModel, balance_bins
+from axolotl.utils.samplers.mixture import MixtureSampler
 
 LOG = logging.getLogger("axolotl.utils.samplers.multipack")
 
@@ -103,6 +112,254 @@ def allocate(
     return result, s, len(result) * c * n
 
 
+@numba.njit
+def pack_group(lengths: np.ndarray, c: int, bin_size: int):
+    # First-fit-decreasing over a single group, bounded at bin_size items per bin
+    # returns the bin id of every item (in input order) and the number of bins used
+
+    n = lengths.shape[0]
+    order = np.argsort(lengths)[::-1]
+    bins_remaining = np.empty(n, dtype=np.int64)
+    bins_count = np.empty(n, dtype=np.int64)
+    bin_ids = np.empty(n, dtype=np.int64)
+    num_bins = 0
+
+    for item in order:
+        size = lengths[item]
+        target = -1
+        for idx in range(num_bins):
+            if bins_remaining[idx] >= size and bins_count[idx] < bin_size:
+                target = idx
+                break
+
+        if target < 0:
+            target = num_bins
+            bins_remaining[target] = c
+            bins_count[target] = 0
+            num_bins += 1
+
+        bins_remaining[target] -= size
+        bins_count[target] += 1
+        bin_ids[item] = target
+
+    return bin_ids, num_bins
+
+
+@numba.njit
+def _counting_argsort_desc(lengths: np.ndarray, c: int):
+    # O(n + c) stable descending argsort, anything longer than c shares one bucket
+    counts = np.zeros(c + 2, dtype=np.int64)
+    for size in lengths:
+        counts[min(size, c + 1)] += 1
+
+    starts = np.empty(c + 2, dtype=np.int64)
+    pos = 0
+    for size in range(c + 1, -1, -1):
+        starts[size] = pos
+        pos += counts[size]
+
+    order = np.empty(lengths.shape[0], dtype=np.int64)
+    for item in range(lengths.shape[0]):
+        bucket = min(lengths[item], c + 1)
+        order[starts[bucket]] = item
+        starts[bucket] += 1
+
+    return order
+
+
+@numba.njit
+def pack_group_bfd(lengths: np.ndarray, c: int, bin_size: int):
+    # Best-fit-decreasing in O(n log c), bounded at bin_size items per bin
+    # https://en.wikipedia.org/wiki/Best-fit_bin_packing
+    # open bins are bucketed by remaining capacity (linked lists threaded through
+    # bins_next) and a segment tree counting the non-empty buckets over capacities
+    # 0..c finds the tightest bucket that fits each item. returns the same
+    # (bin_ids, num_bins) as pack_group
+
+    n = lengths.shape[0]
+    order = _counting_argsort_desc(lengths, c)
+
+    size_pow2 = 1
+    while size_pow2 < c + 1:
+        size_pow2 *= 2
+    tree = np.zeros(2 * size_pow2, dtype=np.int64)
+    bucket_head = np.full(c + 1, -1, dtype=np.int64)
+    bins_next = np.empty(n, dtype=np.int64)
+    bins_count = np.empty(n, dtype=np.int64)
+    bin_ids = np.empty(n, dtype=np.int64)
+    num_bins = 0
+
+    for item in order:
+        size = lengths[item]
+
+        # leftmost non-empty capacity bucket >= size
+        capacity = -1
+        if size <= c:
+            node = size + size_pow2
+            if tree[node] > 0:
+                capacity = size
+            else:
+                while node > 1:
+                    if node % 2 == 0 and tree[node + 1] > 0:
+                        node += 1
+                        while node < size_pow2:
+                            node = 2 * node if tree[2 * node] > 0 else 2 * node + 1
+                        capacity = node - size_pow2
+                        break
+                    node //= 2
+
+        if capacity >= 0:
+            target = bucket_head[capacity]
+            bucket_head[capacity] = bins_next[target]
+            if bucket_head[capacity] < 0:
+                node = capacity + size_pow2
+                while node >= 1:
+                    tree[node] -= 1
+                    node //= 2
+        else:
+            target = num_bins
+            bins_count[target] = 0
+            capacity = c
+            num_bins += 1
+
+        remaining = capacity - size
+        bins_count[target] += 1
+        bin_ids[item] = target
+
+        if remaining > 0 and bins_count[target] < bin_size:
+            if bucket_head[remaining] < 0:
+                node = remaining + size_pow2
+                while node >= 1:
+                    tree[node] += 1
+                    node //= 2
+            bins_next[target] = bucket_head[remaining]
+            bucket_head[remaining] = target
+
+    return bin_ids, num_bins
+
+
+PACKING_ALGORITHMS = {
+    "ffd": pack_group,
+    "bfd": pack_group_bfd,
+}
+
+
+def _pack_group_worker(args):
+    lengths, c, bin_size, algorithm = args
+    return PACKING_ALGORITHMS[algorithm](lengths, c, bin_size)
+
+
+def _num_pack_processes(
+    num_items: int, group_size: Optional[int], num_processes: Optional[int]
+) -> int:
+    num_groups = math.ceil(num_items / (group_size or max(num_items, 1)))
+    if num_processes is None:
+        num_processes = os.cpu_count() or 1
+    return max(1, min(num_processes, num_groups))
+
+
+def _create_pack_pool(
+    num_processes: int, c: int, bin_size: int, algorithm: str, mp_start_method=None
+) -> multiprocessing.pool.Pool:
+    # compile in the parent so forked workers don't each pay the jit cost
+    PACKING_ALGORITHMS[algorithm](np.ones(1, dtype=np.int64), c, bin_size)
+    return multiprocessing.get_context(mp_start_method).Pool(num_processes)
+
+
+def pack_parallel(
+    lengths: np.ndarray,
+    c: int,
+    group_size: int,
+    bin_size: int,
+    num_processes: Optional[int] = None,
+    mp_start_method: Optional[str] = None,
+    algorithm: str = "ffd",
+    pool: Optional[multiprocessing.pool.Pool] = None,
+):
+    """
+    Split `lengths` into contiguous groups of `group_size` items, pack each group
+    independently (across a process pool when there is more than one group) and
+    merge the results in group order so the plan is deterministic. When `pool` is
+    given it is used instead of starting a new one.
+
+    Returns the global bin id of every item and the total number of bins.
+    """
+    lengths = np.ascontiguousarray(lengths, dtype=np.int64)
+    num_processes = _num_pack_processes(len(lengths), group_size, num_processes)
+    group_size = group_size or max(len(lengths), 1)
+    tasks = [
+        (lengths[start : start + group_size], c, bin_size, algorithm)
+        for start in range(0, len(lengths), group_size)
+    ]
+
+    if num_processes == 1:
+        results = [_pack_group_worker(task) for task in tasks]
+    elif pool is not None:
+        results = pool.map(_pack_group_worker, tasks)
+    else:
+        with _create_pack_pool(
+            num_processes, c, bin_size, algorithm, mp_start_method
+        ) as new_pool:
+            results = new_pool.map(_pack_group_worker, tasks)
+
+    bin_ids = np.empty(len(lengths), dtype=np.int64)
+    bin_offset = 0
+    for task_idx, (group_bin_ids, num_bins) in enumerate(results):
+        start = task_idx * group_size
+        bin_ids[start : start + len(group_bin_ids)] = group_bin_ids + bin_offset
+        bin_offset += num_bins
+
+    return bin_ids, bin_offset
+
+
+def _reorder_bins(flat_indices: np.ndarray, bin_ends: np.ndarray, order: np.ndarray):
+    bin_starts = np.concatenate([[0], bin_ends[:-1]])
+    new_sizes = (bin_ends - bin_starts)[order]
+    new_ends = np.cumsum(new_sizes)
+    gather = np.repeat(bin_starts[order] - (new_ends - new_sizes), new_sizes)
+    return flat_indices[gather + np.arange(len(gather))], new_ends
+
+
+def _split_bins_to_multiple(
+    flat_indices: np.ndarray, bin_ends: np.ndarray, lengths: np.ndarray, multiple: int
+):
+    # split the bins holding the most samples in two until the number of bins is a
+    # multiple of `multiple`, so every rank gets a full last step instead of the
+    # remainder being dropped
+    num_bins = len(bin_ends)
+    short = -num_bins % multiple
+    if not short:
+        return flat_indices, bin_ends
+
+    bin_starts = np.concatenate([[0], bin_ends[:-1]])
+    bin_sizes = bin_ends - bin_starts
+    splittable = np.flatnonzero(bin_sizes > 1)
+    if len(splittable) < short:
+        keep = num_bins - num_bins % multiple
+        LOG.warning(
+            f"unable to split {num_bins} bins evenly across ranks, dropping {num_bins - keep}"
+        )
+        return flat_indices[: bin_ends[keep - 1] if keep else 0], bin_ends[:keep]
+
+    to_split = np.sort(
+        splittable[np.argsort(-bin_sizes[splittable], kind="stable")[:short]]
+    )
+    moved = np.zeros(len(flat_indices), dtype=bool)
+    for bin_idx in to_split:
+        positions = np.arange(bin_starts[bin_idx], bin_ends[bin_idx])
+        by_length = positions[
+            np.argsort(-lengths[flat_indices[positions]], kind="stable")
+        ]
+        moved[by_length[1::2]] = True
+
+    moved_per_bin = np.add.reduceat(moved.astype(np.int64), bin_starts)
+    new_sizes = np.concatenate([bin_sizes - moved_per_bin, moved_per_bin[to_split]])
+    return (
+        np.concatenate([flat_indices[~moved], flat_indices[moved]]),
+        np.cumsum(new_sizes),
+    )
+
+
 class MultipackBatchSampler(BatchSampler):
     """
     Batch Sampler class for multipack
@@ -117,18 +374,68 @@ class MultipackBatchSampler(BatchSampler):
         packing_efficiency_estimate: float = 1.0,
         drop_last: bool = False,
         num_count_samples: int = 16,
-        **kwargs,
+        group_size: Optional[int] = 100_000,
+        bin_size: int = 200,
+        num_processes: Optional[int] = None,
+        mp_start_method: Optional[str] = None,
+        seed: Optional[int] = None,
+        plan_cache_dir: Optional[str] = None,
+        fingerprint: Optional[str] = None,
+        packing_algorithm: str = "ffd",
+        cost_model: Optional[PackingCostModel] = None,
+        num_ranks: int = 1,
+        balance_ranks: bool = False,
     ):
         super().__init__(sampler, batch_size, drop_last)
         self.batch_size = batch_size
         self.batch_max_len = batch_max_len
         self.lengths: np.ndarray = lengths
         self.packing_efficiency_estimate = packing_efficiency_estimate or 1.0
+        # "ffd" / "bfd" pack groups in parallel, "multifit" packs the whole epoch
+        # serially with the multifit allocator
+        assert packing_algorithm in [*PACKING_ALGORITHMS, "multifit"]
+        self.packing_algorithm = packing_algorithm
+        # number of samples packed independently of each other, `None` packs the
+        # whole epoch as a single group
+        self.group_size: int = group_size or max(len(sampler), 1)  # type: ignore[arg-type]
+        # max number of samples in a single bin
+        self.bin_size = bin_size
+        self.num_processes = num_processes
+        self.mp_start_method = mp_start_method
+        # started on the first parallel packing and reused for every plan after
+        self._pool: Optional[multiprocessing.pool.Pool] = None
+        # when set, bins are ordered so the estimated compute of every step is
+        # balanced across the batch and across `num_ranks` ranks
+        self.cost_model = cost_model
+        self.num_ranks = num_ranks
+        # distributed-aware planning: accelerate hands batch i to rank
+        # i % num_ranks, so lay out every step for all ranks (balancing tokens
+        # when there is no cost model) and split bins so the epoch ends on a full
+        # step rather than dropping the remainder
+        self.balance_ranks = balance_ranks
+        if balance_ranks and cost_model is None:
+            self.cost_model = PackingCostModel()
 
         assert isinstance(self.lengths, np.ndarray)
 
         self.epoch = 0
 
+        # when seeded, the shuffle (and so the packing plan) is a pure function of
+        # (dataset, seed, epoch), so plans are computed once and reused from memory
+        # or from `plan_cache_dir` across `__len__`, `__iter__` and restarts
+        self.seed = seed
+        self.plan_cache_dir = plan_cache_dir
+        self.fingerprint = fingerprint
+        self._lengths_digest = (
+            hashlib.md5(np.ascontiguousarray(lengths).tobytes()).hexdigest()
+            if seed is not None
+            else None
+        )
+        self._plan: Optional[Tuple[str, np.ndarray]] = None
+        if seed is not None and isinstance(sampler, (RandomSampler, MixtureSampler)):
+            if sampler.generator is None:
+                sampler.generator = torch.Generator()
+
         # statistics
         self.eff_total_used = 0
         self.eff_total_slots = 0
@@ -141,32 +448,185 @@ class MultipackBatchSampler(BatchSampler):
     def set_epoch(self, epoch: int):
         self.epoch = epoch
 
-    def generate_batches(self, set_stats=False):
-        indices = [idx for idx in self.sampler]
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_pool"] = None
+        return state
 
+    def _get_pool(self, num_items: int) -> Optional[multiprocessing.pool.Pool]:
+        num_processes = _num_pack_processes(
+            num_items, self.group_size, self.num_processes
+        )
+        if num_processes == 1:
+            return None
+        if self._pool is None:
+            self._pool = _create_pack_pool(
+                num_processes,
+                self.batch_max_len,
+                self.bin_size,
+                self.packing_algorithm,
+                self.mp_start_method,
+            )
+            weakref.finalize(self, self._pool.terminate)
+        return self._pool
+
+    @property
+    def _shuffled(self) -> bool:
+        return getattr(self.sampler, "generator", None) is not None
+
+    def _plan_key(self) -> str:
+        key = {
+            "fingerprint": self.fingerprint,
+            "lengths": self._lengths_digest,
+            "seed": self.seed,
+            # sequential samplers give the same plan every epoch
+            "epoch": self.epoch if self._shuffled else None,
+            # e.g. the sample ratios of a mixture
+            "sampler": getattr(self.sampler, "cache_key", None),
+            "batch_max_len": self.batch_max_len,
+            "group_size": self.group_size,
+            "bin_size": self.bin_size,
+            "packing_algorithm": self.packing_algorithm,
+            "cost_model": repr(self.cost_model),
+            "num_ranks": self.num_ranks,
+            "balance_ranks": self.balance_ranks,
+        }
+        return hashlib.md5(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+    def _allocate(self, indices: np.ndarray):
+        """
+        pack `indices` into bins, returning the indices flattened in bin order and
+        the end offset of every bin
+        """
         lengths = self.lengths[indices]
-        lengths_cumsum = np.cumsum(lengths)
 
-        batches, total_used, total_slots = allocate(
+        if self.packing_algorithm != "multifit":
+            bin_ids, num_bins = pack_parallel(
+                lengths,
+                c=self.batch_max_len,
+                group_size=self.group_size,
+                bin_size=self.bin_size,
+                num_processes=self.num_processes,
+                mp_start_method=self.mp_start_method,
+                algorithm=self.packing_algorithm,
+                pool=self._get_pool(len(lengths)),
+            )
+            order = np.argsort(bin_ids, kind="stable")
+            bin_ends = np.cumsum(np.bincount(bin_ids, minlength=num_bins))
+            return indices[order], bin_ends
+
+        batches, _, _ = allocate(
             lengths=lengths,
-            lengths_cumsum=lengths_cumsum,
+            lengths_cumsum=np.cumsum(lengths),
             rank=0,
             c=self.batch_max_len,
             n=1,
         )
+        bin_ends = np.cumsum([len(batch) for batch in batches], dtype=np.int64)
+        flat = np.fromiter(
+            (b_idx for batch in batches for b_idx in batch), dtype=np.int64
+        )
+        return indices[flat], bin_ends
+
+    def _plan_rng(self) -> np.random.Generator:
+        if self.seed is not None:
+            # sequential samplers share one plan across epochs
+            return np.random.default_rng(
+                [self.seed, self.epoch if self._shuffled else 0]
+            )
+        # every rank has to lay out the same plan, so draw the seed from
+        # torch's (identically seeded) global RNG like RandomSampler does
+        return np.random.default_rng(
+            int(torch.empty((), dtype=torch.int64).random_().item())
+        )
+
+    def _compute_plan(self) -> np.ndarray:
+        if self.seed is not None and self._shuffled:
+            self.sampler.generator.manual_seed(self.seed + self.epoch)
+        indices = np.fromiter(self.sampler, dtype=np.int64)
+        flat_indices, bin_ends = self._allocate(indices)
+
+        if self.balance_ranks:
+            flat_indices, bin_ends = _split_bins_to_multiple(
+                flat_indices,
+                bin_ends,
+                self.lengths,
+                self.batch_size * self.num_ranks,
+            )
+
+        if self.cost_model is not None and len(bin_ends):
+            bin_starts = np.concatenate([[0], bin_ends[:-1]])
+            item_lengths = self.lengths[flat_indices]
+            bin_costs = np.add.reduceat(self.cost_model(item_lengths), bin_starts)
+            bin_tokens = np.add.reduceat(item_lengths, bin_starts)
+            order = balance_bins(
+                bin_costs,
+                self.batch_size,
+                self.num_ranks,
+                self._plan_rng(),
+                bin_tokens=bin_tokens,
+            )
+            flat_indices, bin_ends = _reorder_bins(flat_indices, bin_ends, order)
+        elif self.packing_algorithm != "multifit" and len(bin_ends):
+            # ffd / bfd open bins from the longest samples down, so shuffle them
+            # rather than train from long to short documents within every group
+            order = self._plan_rng().permutation(len(bin_ends))
+            flat_indices, bin_ends = _reorder_bins(flat_indices, bin_ends, order)
+
+        # compact layout: [num_bins, *bin_ends, *flat_indices]
+        assert len(self.lengths) < np.iinfo(np.int32).max
+        return np.concatenate(
+            [[len(bin_ends)], bin_ends, flat_indices], dtype=np.int64
+        ).astype(np.int32)
+
+    def _get_plan(self) -> np.ndarray:
+        if self.seed is None:
+            return self._compute_plan()
+
+        key = self._plan_key()
+        if self._plan is not None and self._plan[0] == key:
+            return self._plan[1]
+
+        plan_path = None
+        if self.plan_cache_dir:
+            plan_path = os.path.join(self.plan_cache_dir, f"multipack_plan_{key}.npy")
+
+        if plan_path and os.path.exists(plan_path):
+            LOG.debug(f"loading multipack plan from {plan_path}")
+            plan = np.load(plan_path)
+        else:
+            plan = self._compute_plan()
+            if plan_path:
+                try:
+                    # ranks may race on the same plan, write then atomically rename
+                    tmp_path = f"{plan_path}.{os.getpid()}.tmp"
+                    with open(tmp_path, "wb") as fout:
+                        np.save(fout, plan)
+                    os.replace(tmp_path, plan_path)
+                except OSError as exc:
+                    LOG.warning(f"unable to save multipack plan to {plan_path}: {exc}")
+
+        self._plan = (key, plan)
+        return plan
+
+    def generate_batches(self, set_stats=False):
+        plan = self._get_plan()
+        num_bins = int(plan[0])
+        bin_ends = plan[1 : num_bins + 1]
+        flat_indices = plan[num_bins + 1 :]
+
+        bins = [b.tolist() for b in np.split(flat_indices, bin_ends[:-1])]
+        if not num_bins:
+            bins = []
 
         batches = [
-            [
-                [indices[b_idx] for b_idx in batch]
-                for batch in batches[i : i + self.batch_size]
-            ]
-            for i in range(0, len(batches), self.batch_size)
+            bins[i : i + self.batch_size] for i in range(0, len(bins), self.batch_size)
         ]
 
         # statistics
         if set_stats:
-            self.eff_total_used += total_used
-            self.eff_total_slots += total_slots
+            self.eff_total_used += int(self.lengths[flat_indices].sum())
+            self.eff_total_slots += num_bins * self.batch_max_len
 
         return batches
 
@@ -208,8 +668,8 @@ class MultipackBatchSampler(BatchSampler):
 
     def __len__(self):
         if not self.len_across_ranks:
-            len_batches = min(
-                [self.num_batches() for _ in range(self.num_count_samples)]
-            )
+            # a seeded plan is deterministic, so there is nothing to sample
+            num_count_samples = 1 if self.seed is not None else self.num_count_samples
+            len_batches = min([self.num_batches() for _ in range(num_count_samples)])
             self.len_across_ranks = self.gather_len_batches(len_batches)
         return self.len_across_ranks
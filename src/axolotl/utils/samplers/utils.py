@@ -1,20 +1,30 @@
 """
 helper util to calculate dataset lengths
 """
+import os
+from typing import Optional
+
 import numpy as np
 
+from axolotl.datasets import TokenStore
+from axolotl.utils.dataset_stats import get_dataset_stats, get_position_lengths
+
 
-def get_dataset_lengths(dataset, from_arrow=False):
+def get_dataset_lengths(dataset):
+    if isinstance(dataset, TokenStore):
+        return dataset.lengths
     if "length" in dataset.column_names:
         lengths = np.array(dataset["length"])
     elif "position_ids" in dataset.column_names:
-        position_ids = dataset["position_ids"]
-        lengths = np.array([x[-1] + 1 for x in position_ids])
+        lengths = get_position_lengths(dataset)
     else:
-        if from_arrow:
-            input_ids = dataset.data.column("input_ids")
-            lengths = np.vectorize(len)(np.array(input_ids, dtype=object))
-        else:
-            input_ids = dataset["input_ids"]
-            lengths = np.array([len(seq) for seq in input_ids])
+        lengths = get_dataset_stats(dataset).lengths
     return lengths
+
+
+def get_dataset_cache_dir(dataset) -> Optional[str]:
+    """directory holding the arrow files backing `dataset`, if it is on disk"""
+    cache_files = getattr(dataset, "cache_files", None)
+    if cache_files:
+        return os.path.dirname(cache_files[0]["filename"])
+    return None
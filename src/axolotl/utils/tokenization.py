@@ -1,9 +1,19 @@
 """Module for tokenization utilities"""
 
+import json
 import logging
+import tempfile
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
 
 from termcolor import colored
 
+from axolotl.utils.compact_schema import expand_compact_row
+
 LOG = logging.getLogger("axolotl")
 
 
@@ -23,6 +33,7 @@ def check_dataset_labels(
 
 
 def check_example_labels(example, tokenizer, text_only=False):
+    example = expand_compact_row(example)
     # Get the input_ids, labels, and attention_mask from the dataset
     input_ids = example["input_ids"]
     labels = example["labels"]
@@ -118,3 +129,146 @@ def check_rl_example_labels(example, tokenizer, text_only=False):
         LOG.info(f"COMPLETION RESPONSE: {delimiter.join(colored_completion)}\n\n\n")
 
     return delimiter.join(colored_tokens)
+
+
+class PrefixTokenCache:
+    """
+    Bounded LRU cache of the token ids of rendered prompt prefixes, e.g. a system
+    prompt shared by many conversations, so that only the rest of each prompt is
+    tokenized. A prefix is only reused when the text following it starts with a
+    special token, and after checking once that it tokenizes the same on its own
+    as within the full prompt.
+    """
+
+    def __init__(self, tokenizer, maxsize: int = 128):
+        self.tokenizer = tokenizer
+        self.maxsize = maxsize
+        self._entries: OrderedDict[
+            str, Tuple[Optional[List[int]], float]
+        ] = OrderedDict()
+        self._special_tokens: Optional[Tuple[str, ...]] = None
+        self.lookups = 0
+        self.hits = 0
+        self.seconds_saved = 0.0
+        # set by `record_prefix_cache_stats`, every copy saves its counters there
+        self.stats_dir: Optional[str] = None
+        self._stats_file: Optional[str] = None
+
+    def __getstate__(self):
+        # every process starts with an empty cache and its own counters
+        state = self.__dict__.copy()
+        state["_entries"] = OrderedDict()
+        state["_special_tokens"] = None
+        state["_stats_file"] = None
+        state.update(lookups=0, hits=0, seconds_saved=0.0)
+        return state
+
+    @property
+    def special_tokens(self) -> Tuple[str, ...]:
+        if self._special_tokens is None:
+            self._special_tokens = tuple(self.tokenizer.added_tokens_encoder)
+        return self._special_tokens
+
+    def __call__(
+        self, texts: List[str], prefixes: List[Optional[str]]
+    ) -> List[List[int]]:
+        """token ids of `texts`, reusing the cached ids of their `prefixes`"""
+        if not texts:
+            return []
+        heads: List[List[int]] = []
+        tails: List[str] = []
+        for text, prefix in zip(texts, prefixes):
+            prefix_ids = self._lookup(text, prefix)
+            if prefix_ids is None:
+                heads.append([])
+                tails.append(text)
+            else:
+                heads.append(prefix_ids)
+                tails.append(text[len(prefix) :])  # type: ignore[arg-type]
+        tail_ids = self.tokenizer(tails, add_special_tokens=False)["input_ids"]
+        return [head + ids for head, ids in zip(heads, tail_ids)]
+
+    def _lookup(self, text: str, prefix: Optional[str]) -> Optional[List[int]]:
+        self.lookups += 1
+        if (
+            not prefix
+            or len(prefix) >= len(text)
+            or not text.startswith(prefix)
+            or not text.startswith(self.special_tokens, len(prefix))
+        ):
+            return None
+
+        entry = self._entries.get(prefix)
+        if entry is None:
+            self._entries[prefix] = self._check_prefix(text, prefix)
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+            return None
+
+        self._entries.move_to_end(prefix)
+        prefix_ids, seconds = entry
+        if prefix_ids is not None:
+            self.hits += 1
+            self.seconds_saved += seconds
+        return prefix_ids
+
+    def _check_prefix(
+        self, text: str, prefix: str
+    ) -> Tuple[Optional[List[int]], float]:
+        start = time.perf_counter()
+        prefix_ids = self.tokenizer(prefix, add_special_tokens=False)["input_ids"]
+        seconds = time.perf_counter() - start
+
+        suffix_ids = self.tokenizer(text[len(prefix) :], add_special_tokens=False)[
+            "input_ids"
+        ]
+        full_ids = self.tokenizer(text, add_special_tokens=False)["input_ids"]
+        if prefix_ids + suffix_ids != full_ids:
+            LOG.debug("prompt prefix is not tokenized the same on its own, not caching")
+            return None, seconds
+        return prefix_ids, seconds
+
+    def reset_stats(self):
+        self.lookups = 0
+        self.hits = 0
+        self.seconds_saved = 0.0
+
+    def flush_stats(self):
+        """save the counters of this copy of the cache to `stats_dir`, if set"""
+        if self.stats_dir is None or not self.lookups:
+            return
+        # one file per copy of the cache, a process may tokenize several shards
+        if self._stats_file is None:
+            self._stats_file = f"{uuid.uuid4().hex}.json"
+        with open(
+            Path(self.stats_dir) / self._stats_file, "w", encoding="utf-8"
+        ) as fout:
+            json.dump(
+                {
+                    "lookups": self.lookups,
+                    "hits": self.hits,
+                    "seconds_saved": self.seconds_saved,
+                },
+                fout,
+            )
+
+
+@contextmanager
+def record_prefix_cache_stats(prefix_cache: PrefixTokenCache):
+    """
+    Sum the counters of `prefix_cache` over every copy of it flushing its stats
+    within the context, e.g. in the workers of `Dataset.map`, into the yielded dict.
+    Copies pickled within the context carry the directory their stats are saved to.
+    """
+    stats: Dict[str, float] = {"lookups": 0, "hits": 0, "seconds_saved": 0.0}
+    prefix_cache.reset_stats()
+    with tempfile.TemporaryDirectory() as stats_dir:
+        prefix_cache.stats_dir = stats_dir
+        try:
+            yield stats
+        finally:
+            prefix_cache.stats_dir = None
+            for path in Path(stats_dir).glob("*.json"):
+                with open(path, encoding="utf-8") as fin:
+                    for key, value in json.load(fin).items():
+                        stats[key] += value
@@ -13,13 +13,29 @@ import torch
 import torch.cuda
 from accelerate.logging import get_logger
 from datasets import IterableDataset, disable_caching, enable_caching
-from torch.utils.data import DataLoader, RandomSampler
+from torch.utils.data import RandomSampler
 from transformers.utils import is_torch_bf16_gpu_available
 
-from axolotl.core.trainer_builder import HFCausalTrainerBuilder, HFRLTrainerBuilder
+from axolotl.core.trainer_builder import (
+    HFCausalTrainerBuilder,
+    HFRLTrainerBuilder,
+    get_trainer_seed,
+)
+from axolotl.utils.dataset_stats import (
+    carry_dataset_stats,
+    get_dataset_stats,
+    select_rows,
+)
 from axolotl.utils.distributed import reduce_and_broadcast
 from axolotl.utils.environment import check_cuda_p2p_ib_support
-from axolotl.utils.samplers import MultipackBatchSampler, get_dataset_lengths
+from axolotl.utils.samplers import (
+    MultipackBatchSampler,
+    PackingCostModel,
+    get_dataset_cache_dir,
+    get_dataset_lengths,
+    get_mixture_sampler,
+    get_sample_ratios,
+)
 
 LOG = get_logger("axolotl")
 
@@ -262,64 +278,48 @@ def process_datasets_for_packing(cfg, train_dataset, eval_dataset):
         # If it's a list, we assume we're dealing with a batch
         if isinstance(labels[0], int):
             # Single example: return a single bool
-            return np.any(labels != -100)
+            return np.any(np.asarray(labels) != -100)
 
         # Batched: 'labels' is a list of lists
         # Return a list of booleans, one per sub-list
-        results = [np.any(row_labels != -100) for row_labels in labels]
+        results = [
+            not row_labels or np.any(np.asarray(row_labels) != -100)
+            for row_labels in labels
+        ]
         return results
 
-    try:
-        prior_len = len(train_dataset)
-    except TypeError:
-        # handle iterable datasets case
-        prior_len = None
     filter_map_kwargs = {}
     if not isinstance(train_dataset, IterableDataset):
         filter_map_kwargs["num_proc"] = cfg.dataset_processes
         filter_map_kwargs["load_from_cache_file"] = not cfg.is_preprocess
 
-    drop_long_kwargs = {}
-    if filter_map_kwargs:
-        drop_long_kwargs["desc"] = "Drop Samples with Zero Trainable Tokens"
-    train_dataset = train_dataset.filter(
-        drop_no_trainable_tokens,
-        batched=True,
-        **filter_map_kwargs,
-        **drop_long_kwargs,
-    )
-    if prior_len:
-        dropped = prior_len - len(train_dataset)
+    def drop_untrainable_rows(dataset, split):
+        if isinstance(dataset, IterableDataset):
+            return dataset.filter(drop_no_trainable_tokens, batched=True)
+        if "labels" not in dataset.column_names:
+            return dataset
+        stats = get_dataset_stats(dataset)
+        keep = stats.trainable_mask
+        dropped = int((~keep).sum())
         if dropped:
             LOG.warning(
-                f"Dropped {dropped} samples with no trainable tokens from train dataset"
+                f"Dropped {dropped} samples with no trainable tokens from {split} dataset"
             )
+        return select_rows(dataset, keep)
 
+    train_dataset = drop_untrainable_rows(train_dataset, "train")
     if eval_dataset:
-        try:
-            prior_len = len(eval_dataset)
-        except TypeError:
-            # handle iterable datasets case
-            prior_len = None
-        eval_dataset = eval_dataset.filter(
-            drop_no_trainable_tokens,
-            **filter_map_kwargs,
-            **drop_long_kwargs,
-        )
-        if prior_len:
-            dropped = prior_len - len(eval_dataset)
-            if dropped:
-                LOG.warning(
-                    f"Dropped {dropped} samples with no trainable tokens from eval dataset"
-                )
+        eval_dataset = drop_untrainable_rows(eval_dataset, "eval")
 
     if cfg.group_by_length:
-        train_dataset = train_dataset.map(
+        with_length = train_dataset.map(
             add_length,
             num_proc=cfg.dataset_processes,
             load_from_cache_file=not cfg.is_preprocess,
             desc="Group By Length",
         )
+        carry_dataset_stats(with_length, train_dataset)
+        train_dataset = with_length
 
     if cfg.use_pose:
         pose_kwargs = {}
@@ -350,19 +350,23 @@ def process_datasets_for_packing(cfg, train_dataset, eval_dataset):
         drop_long_kwargs = {}
         if filter_map_kwargs:
             drop_long_kwargs["desc"] = "Add position_id column (Sample Packing)"
-        train_dataset = train_dataset.map(
+        with_position_ids = train_dataset.map(
             add_position_ids,
             batched=True,
             **filter_map_kwargs,
             **drop_long_kwargs,
         )
+        carry_dataset_stats(with_position_ids, train_dataset)
+        train_dataset = with_position_ids
         if cfg.eval_sample_packing is not False:
             if eval_dataset:
-                eval_dataset = eval_dataset.map(
+                with_position_ids = eval_dataset.map(
                     add_position_ids,
                     **filter_map_kwargs,
                     **drop_long_kwargs,
                 )
+                carry_dataset_stats(with_position_ids, eval_dataset)
+                eval_dataset = with_position_ids
 
     return train_dataset, eval_dataset
 
@@ -394,17 +398,18 @@ def calculate_total_num_steps(cfg, train_dataset, update=True):
         and not cfg.skip_prepare_dataset
         and not cfg.reward_model
     ):
-        total_num_tokens = np.sum(
-            train_dataset.select_columns("input_ids")
-            .to_pandas()["input_ids"]
-            .apply(len)
-            .values
-        )
+        total_num_tokens = get_dataset_stats(train_dataset).num_tokens
         LOG.debug(f"total_num_tokens: {total_num_tokens:_}", main_process_only=True)
         if update:
             cfg.total_num_tokens = total_num_tokens
 
     skip_estimates = cfg.model_config_type == "mamba"
+    # same draws as the trainer's sampler when datasets have a `sample_ratio`
+    mixture_sampler = get_mixture_sampler(
+        train_dataset,
+        get_sample_ratios(cfg.datasets),
+        shuffle=not cfg.curriculum_sampling,
+    )
 
     if (
         not skip_estimates
@@ -412,12 +417,7 @@ def calculate_total_num_steps(cfg, train_dataset, update=True):
         and not cfg.skip_prepare_dataset
         and not cfg.reward_model
     ):
-        total_supervised_tokens = (
-            train_dataset.data.column("labels")
-            .to_pandas()
-            .apply(lambda x: np.sum(np.array(x) != -100))
-            .sum()
-        )
+        total_supervised_tokens = get_dataset_stats(train_dataset).num_supervised_tokens
         LOG.debug(
             f"`total_supervised_tokens: {total_supervised_tokens:_}`",
             main_process_only=True,
@@ -430,12 +430,17 @@ def calculate_total_num_steps(cfg, train_dataset, update=True):
         # flash attention with position ids fails
 
         if cfg.sample_packing_eff_est:
+            epoch_num_tokens = cfg.total_num_tokens
+            if mixture_sampler is not None:
+                epoch_num_tokens = mixture_sampler.num_tokens(
+                    get_dataset_lengths(train_dataset)
+                )
             total_num_steps = (
                 # match count to len est in dataloader
                 int(
                     math.floor(
                         0.99
-                        * cfg.total_num_tokens
+                        * epoch_num_tokens
                         / cfg.sample_packing_eff_est
                         / cfg.sequence_len
                         // cfg.batch_size
@@ -455,21 +460,46 @@ def calculate_total_num_steps(cfg, train_dataset, update=True):
             else:
                 sampler_batch_size = cfg.micro_batch_size
                 batch_max_len = cfg.sequence_len
+            plan_kwargs = {}
+            if cfg.sample_packing_balance_cost:
+                # bin order doesn't change the step count, but it is part of the
+                # plan so it has to match the trainer for the plan cache to hit
+                plan_kwargs["cost_model"] = PackingCostModel.from_terms(
+                    linear=cfg.sample_packing_cost_linear,
+                    quadratic=cfg.sample_packing_cost_quadratic,
+                )
+                plan_kwargs["num_ranks"] = cfg.world_size or 1
+            if cfg.sample_packing_balance_ranks:
+                plan_kwargs["num_ranks"] = cfg.world_size or 1
+                plan_kwargs["balance_ranks"] = True
+            if cfg.sample_packing_plan_cache or cfg.sample_packing_balance_ranks:
+                # same seed as the trainer so its sampler picks up the plan
+                # computed here
+                plan_kwargs["seed"] = get_trainer_seed(cfg)
+            if cfg.sample_packing_plan_cache:
+                plan_kwargs["plan_cache_dir"] = get_dataset_cache_dir(train_dataset)
+                plan_kwargs["fingerprint"] = getattr(
+                    train_dataset, "_fingerprint", None
+                )
             sampler = MultipackBatchSampler(
-                sampler=RandomSampler(train_dataset),
+                sampler=(
+                    RandomSampler(train_dataset)
+                    if mixture_sampler is None
+                    else mixture_sampler
+                ),
                 lengths=get_dataset_lengths(train_dataset),
                 batch_size=sampler_batch_size,
                 batch_max_len=batch_max_len,
                 group_size=cfg.sample_packing_group_size,
                 bin_size=cfg.sample_packing_bin_size,
+                mp_start_method=cfg.sample_packing_mp_start_method,
+                packing_algorithm=cfg.sample_packing_algorithm or "ffd",
                 drop_last=True,
+                **plan_kwargs,
             )
 
-            data_loader = DataLoader(
-                train_dataset.remove_columns(["length"]),
-                batch_sampler=sampler,
-            )
-            data_loader_len = len(data_loader) * cfg.micro_batch_size // cfg.batch_size
+            # len(DataLoader) with a batch sampler is just len(batch_sampler)
+            data_loader_len = len(sampler) * cfg.micro_batch_size // cfg.batch_size
             LOG.debug(f"data_loader_len: {data_loader_len}", main_process_only=True)
             # FIXME: is there a bug here somewhere? the total num steps depends
             # on the agreed on value for sample_packing_eff_est
@@ -493,9 +523,8 @@ def calculate_total_num_steps(cfg, train_dataset, update=True):
                 main_process_only=True,
             )
     else:
-        total_num_steps = int(
-            math.ceil(len(train_dataset) * cfg.num_epochs / cfg.batch_size)
-        )
+        num_samples = len(train_dataset if mixture_sampler is None else mixture_sampler)
+        total_num_steps = int(math.ceil(num_samples * cfg.num_epochs / cfg.batch_size))
     LOG.debug(f"total_num_steps: {total_num_steps}", main_process_only=True)
     return total_num_steps
 
@@ -8,8 +8,10 @@ import sys
 import tempfile
 import time
 
+import numpy as np
 import pytest
 import requests
+from datasets import Dataset
 from huggingface_hub import snapshot_download
 
 
@@ -108,6 +110,27 @@ def download_arcee_ai_distilabel_intel_orca_dpo_pairs_dataset():
     )
 
 
+@pytest.fixture(name="tokenized_dataset")
+def fixture_tokenized_dataset():
+    rng = np.random.default_rng(0)
+    rows = []
+    for _ in range(200):
+        length = int(rng.integers(0, 50))
+        input_ids = rng.integers(0, 70_000, length).tolist()
+        train = rng.random(length) < 0.5
+        rows.append(
+            {
+                "input_ids": input_ids,
+                "labels": [tok if t else -100 for tok, t in zip(input_ids, train)],
+                "attention_mask": [1] * length,
+                "position_ids": list(range(length)),
+                "length": length,
+            }
+        )
+    # select through an indices mapping like a train/test split would
+    return Dataset.from_list(rows).train_test_split(test_size=0.1, seed=42)["train"]
+
+
 @pytest.fixture
 def temp_dir():
     # Create a temporary directory
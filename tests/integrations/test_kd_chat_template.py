@@ -0,0 +1,141 @@
+"""
+Test module for the teacher logprob transform of the KD chat template strategy
+"""
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+import torch
+
+from axolotl.integrations.kd.chat_template import ChatTemplateStrategyWithKD
+from axolotl.integrations.kd.topk_logprob.forward_kl import loss as topk_kd_loss
+
+
+def _reference_transform(sample, logprobs, top_k, gen_temperature, kd_temperature):
+    """the per-position transform the batched one replaced"""
+    input_seq_len = len(sample["input_ids"])
+    input_padding_len = input_seq_len - len(logprobs)
+    target_logprobs = [[-float("inf")] * top_k] * input_padding_len
+    target_token_ids = [list(range(top_k))] * input_padding_len
+    target_mask = [[0] * top_k] * input_padding_len
+    for position in range(input_padding_len, input_seq_len):
+        target_mask.append([int(sample["labels"][position] != -100)] * top_k)
+    for entries in logprobs:
+        probs = torch.tensor([entry["logprob"] for entry in entries[:top_k]]).exp()
+        probs = probs ** (gen_temperature / kd_temperature)
+        target_logprobs.append(torch.log(probs / probs.sum()).tolist())
+        target_token_ids.append(
+            [int(entry["token"].split(":")[1]) for entry in entries[:top_k]]
+        )
+    return target_logprobs, target_token_ids, target_mask
+
+
+def _strategy(gen_temperature=1.0, kd_temperature=1.0):
+    return ChatTemplateStrategyWithKD(
+        SimpleNamespace(chat_template_msg_variables=set()),
+        None,
+        False,
+        2048,
+        gen_temperature=gen_temperature,
+        kd_temperature=kd_temperature,
+    )
+
+
+def _sample(rng, input_seq_len, num_logprobs, top_k):
+    logprobs = []
+    for _ in range(num_logprobs):
+        values = np.sort(np.log(rng.dirichlet(np.ones(top_k))))[::-1]
+        token_ids = rng.choice(32_000, top_k, replace=False)
+        logprobs.append(
+            [
+                {"token": f"token_id:{token_id}", "logprob": float(value)}
+                for token_id, value in zip(token_ids, values)
+            ]
+        )
+    input_ids = rng.integers(0, 32_000, input_seq_len).tolist()
+    labels = [tok if rng.random() < 0.6 else -100 for tok in input_ids]
+    return {"input_ids": input_ids, "labels": labels, "logprobs": logprobs}
+
+
+@pytest.mark.parametrize("kd_temperature", [1.0, 2.0])
+def test_batch_matches_per_position_transform(kd_temperature):
+    rng = np.random.default_rng(0)
+    samples = [
+        _sample(rng, 40, 40, 5),
+        _sample(rng, 30, 12, 8),
+        _sample(rng, 7, 7, 3),
+    ]
+    expected = [
+        _reference_transform(
+            sample, sample["logprobs"], top_k, 1.0, kd_temperature=kd_temperature
+        )
+        for sample, top_k in zip(samples, [5, 8, 3])
+    ]
+
+    transformed = _strategy(kd_temperature=kd_temperature).transform_logprobs_batch(
+        samples
+    )
+    for sample, (target_logprobs, target_token_ids, target_mask) in zip(
+        transformed, expected
+    ):
+        assert "logprobs" not in sample
+        np.testing.assert_allclose(
+            sample["target_logprobs"], target_logprobs, rtol=1e-6
+        )
+        assert sample["target_token_ids"] == target_token_ids
+        assert sample["target_mask"] == target_mask
+
+
+def test_truncated_input_keeps_leading_logprobs():
+    rng = np.random.default_rng(1)
+    sample = _sample(rng, 10, 16, 4)
+    target_logprobs, target_token_ids, _ = _reference_transform(
+        sample, sample["logprobs"][:10], 4, 1.0, 1.0
+    )
+
+    transformed = _strategy().transform_logprobs(sample)
+    assert len(transformed["target_logprobs"]) == 10
+    np.testing.assert_allclose(
+        transformed["target_logprobs"], target_logprobs, rtol=1e-6
+    )
+    assert transformed["target_token_ids"] == target_token_ids
+
+
+def test_missing_positions_are_padded():
+    rng = np.random.default_rng(2)
+    sample = _sample(rng, 4, 4, 3)
+    # the vllm data step leaves no logprobs for some positions
+    sample["logprobs"][1] = None
+
+    transformed = _strategy().transform_logprobs(sample)
+    assert transformed["target_logprobs"][1] == [-float("inf")] * 3
+    assert transformed["target_token_ids"][1] == [0, 0, 0]
+    assert np.exp(transformed["target_logprobs"][2]).sum() == pytest.approx(1.0)
+
+
+def test_padded_entries_are_masked_out():
+    rng = np.random.default_rng(3)
+    sample = _sample(rng, 7, 7, 4)
+    sample["labels"] = sample["input_ids"]
+    # positions with fewer than top_k (3) entries and one without logprobs
+    sample["logprobs"][1] = sample["logprobs"][1][:2]
+    sample["logprobs"][2] = sample["logprobs"][2][:2]
+    sample["logprobs"][3] = sample["logprobs"][3][:3]
+    sample["logprobs"][4] = None
+
+    transformed = _strategy().transform_logprobs(sample)
+    target_mask = np.array(transformed["target_mask"])
+    np.testing.assert_array_equal(
+        target_mask, np.isfinite(transformed["target_logprobs"])
+    )
+    assert target_mask[2].tolist() == [1, 1, 0]
+    assert target_mask[3].tolist() == [1, 1, 1]
+    assert target_mask[4].tolist() == [0, 0, 0]
+
+    kd_loss = topk_kd_loss(
+        torch.randn(1, 7, 32_000),
+        torch.tensor([transformed["target_token_ids"]]),
+        torch.tensor([transformed["target_logprobs"]]),
+        torch.tensor([transformed["target_mask"]]),
+    )
+    assert torch.isfinite(kd_loss)
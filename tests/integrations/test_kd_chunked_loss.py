@@ -0,0 +1,86 @@
+"""
+Test module for the chunked top_k KD loss
+"""
+import pytest
+import torch
+
+from axolotl.integrations.kd.topk_logprob.chunked_forward_kl import chunked_topk_kd_loss
+from axolotl.integrations.kd.topk_logprob.forward_kl import loss as topk_kd_loss
+from axolotl.integrations.kd.topk_logprob.forward_kl import topk_kd_loss_with_zscore
+
+
+def _inputs(batch_size=2, seq_len=37, vocab_size=101, top_k=5):
+    generator = torch.Generator().manual_seed(0)
+    student_logits = torch.randn(
+        batch_size, seq_len + 3, vocab_size, generator=generator
+    )
+    target_token_ids = torch.stack(
+        [
+            torch.randperm(vocab_size, generator=generator)[:top_k]
+            for _ in range(batch_size * seq_len)
+        ]
+    ).view(batch_size, seq_len, top_k)
+    target_logprobs = torch.log_softmax(
+        torch.randn(batch_size, seq_len, top_k, generator=generator), dim=-1
+    )
+    target_mask = (
+        (torch.rand(batch_size, seq_len, 1, generator=generator) < 0.7)
+        .int()
+        .expand(-1, -1, top_k)
+        .clone()
+    )
+    # padding, like the collator
+    target_mask[1, -10:] = 0
+    target_logprobs[1, -10:] = -1e9
+    return student_logits, target_token_ids, target_logprobs, target_mask
+
+
+def _loss_and_grad(loss_fn, student_logits, *args, **kwargs):
+    student_logits = student_logits.clone().requires_grad_(True)
+    kd_loss = loss_fn(student_logits, *args, **kwargs)
+    kd_loss.backward()
+    return kd_loss.detach(), student_logits.grad
+
+
+@pytest.mark.parametrize("kd_temperature", [1.0, 2.0])
+@pytest.mark.parametrize("top_k_before_softmax", [0, 1])
+@pytest.mark.parametrize("num_items_in_batch", [-1, 17])
+def test_matches_topk_kd_loss(kd_temperature, top_k_before_softmax, num_items_in_batch):
+    inputs = _inputs()
+    expected_loss, expected_grad = _loss_and_grad(
+        topk_kd_loss,
+        *inputs,
+        num_items_in_batch=num_items_in_batch,
+        kd_temperature=kd_temperature,
+        top_k_before_softmax=top_k_before_softmax,
+    )
+    kd_loss, grad = _loss_and_grad(
+        chunked_topk_kd_loss,
+        *inputs,
+        num_items_in_batch=num_items_in_batch,
+        kd_temperature=kd_temperature,
+        top_k_before_softmax=top_k_before_softmax,
+        chunk_size=8,
+    )
+    torch.testing.assert_close(kd_loss, expected_loss)
+    torch.testing.assert_close(grad, expected_grad)
+
+
+@pytest.mark.parametrize("kd_temperature", [1.0, 2.0])
+def test_matches_topk_kd_loss_with_zscore(kd_temperature):
+    inputs = _inputs()
+    expected_loss, expected_grad = _loss_and_grad(
+        topk_kd_loss_with_zscore,
+        *inputs,
+        kd_temperature=kd_temperature,
+        zscore_base_temp=2.0,
+    )
+    kd_loss, grad = _loss_and_grad(
+        chunked_topk_kd_loss,
+        *inputs,
+        kd_temperature=kd_temperature,
+        zscore_base_temp=2.0,
+        chunk_size=8,
+    )
+    torch.testing.assert_close(kd_loss, expected_loss)
+    torch.testing.assert_close(grad, expected_grad)
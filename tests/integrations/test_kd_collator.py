@@ -0,0 +1,87 @@
+"""
+Test module for padding the teacher data of the KD collators
+"""
+import numpy as np
+import pytest
+import torch
+from tokenizers import Tokenizer
+from tokenizers.models import WordLevel
+from transformers import PreTrainedTokenizerFast
+
+from axolotl.integrations.kd.collator import (
+    DataCollatorForKD,
+    KDBatchSamplerDataCollatorForSeq2Seq,
+)
+
+
+@pytest.fixture(name="tokenizer")
+def fixture_tokenizer():
+    return PreTrainedTokenizerFast(
+        tokenizer_object=Tokenizer(
+            WordLevel({"<pad>": 0, "<unk>": 1}, unk_token="<unk>")
+        ),
+        pad_token="<pad>",
+    )
+
+
+def _row(rng, length, top_k, as_arrays=False):
+    input_ids = rng.integers(2, 100, length)
+    trained = rng.random(length) < 0.7
+    row = {
+        "input_ids": input_ids.tolist(),
+        "labels": np.where(trained, input_ids, -100).tolist(),
+        "attention_mask": [1] * length,
+        "target_logprobs": np.log(rng.dirichlet(np.ones(top_k), length)),
+        "target_token_ids": rng.integers(0, 100, (length, top_k)),
+        "target_mask": np.repeat(trained[:, None], top_k, 1).astype(np.int64),
+    }
+    if not as_arrays:
+        for name in ["target_logprobs", "target_token_ids", "target_mask"]:
+            row[name] = row[name].tolist()
+    return row
+
+
+def _expected(rows, seq_len, max_k):
+    target_logprobs = torch.full((len(rows), seq_len, max_k), -1e9)
+    target_token_ids = torch.zeros((len(rows), seq_len, max_k), dtype=torch.long)
+    target_mask = torch.zeros((len(rows), seq_len, max_k), dtype=torch.int)
+    for i, pack in enumerate(rows):
+        offset = 0
+        for row in pack:
+            length, top_k = np.shape(row["target_logprobs"])
+            block = slice(offset, offset + length), slice(0, top_k)
+            target_logprobs[i][block] = torch.tensor(row["target_logprobs"])
+            target_token_ids[i][block] = torch.tensor(row["target_token_ids"])
+            target_mask[i][block] = torch.tensor(row["target_mask"])
+            offset += length
+    return target_logprobs, target_token_ids, target_mask
+
+
+@pytest.mark.parametrize("as_arrays", [False, True])
+def test_pads_teacher_data(tokenizer, as_arrays):
+    rng = np.random.default_rng(0)
+    rows = [_row(rng, 7, 4, as_arrays), _row(rng, 3, 2, as_arrays)]
+    target_logprobs, target_token_ids, target_mask = _expected(
+        [[row] for row in rows], 7, 4
+    )
+
+    batch = DataCollatorForKD(tokenizer=tokenizer)([dict(row) for row in rows])
+    assert batch["input_ids"].shape == (2, 7)
+    torch.testing.assert_close(batch["target_logprobs"], target_logprobs)
+    assert torch.equal(batch["target_token_ids"], target_token_ids)
+    assert torch.equal(batch["target_mask"], target_mask)
+
+
+def test_writes_packed_teacher_data_at_offsets(tokenizer):
+    rng = np.random.default_rng(1)
+    packs = [
+        [_row(rng, 5, 3), _row(rng, 4, 3, as_arrays=True)],
+        [_row(rng, 6, 3)],
+    ]
+    target_logprobs, target_token_ids, target_mask = _expected(packs, 9, 3)
+
+    batch = KDBatchSamplerDataCollatorForSeq2Seq(tokenizer=tokenizer)(packs)
+    assert batch["attention_mask"][0].tolist() == [1] * 5 + [2] * 4
+    torch.testing.assert_close(batch["target_logprobs"], target_logprobs)
+    assert torch.equal(batch["target_token_ids"], target_token_ids)
+    assert torch.equal(batch["target_mask"], target_mask)
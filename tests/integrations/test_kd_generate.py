@@ -0,0 +1,208 @@
+"""
+Test module for generating the teacher logprobs of KD datasets
+"""
+import shutil
+
+import numpy as np
+import pytest
+import torch
+from datasets import Dataset
+from tokenizers import Tokenizer
+from tokenizers.models import WordLevel
+from transformers import (
+    Gemma2Config,
+    Gemma2ForCausalLM,
+    LlamaConfig,
+    LlamaForCausalLM,
+    PreTrainedTokenizerFast,
+)
+
+from axolotl.datasets import TokenStore
+from axolotl.integrations.kd.collator import (
+    DataCollatorForKD,
+    KDBatchSamplerDataCollatorForSeq2Seq,
+)
+from axolotl.integrations.kd.generate import (
+    TEACHER_ROW_IDX,
+    TeacherLogprobs,
+    generate_teacher_logprobs,
+    join_teacher_logprobs,
+)
+
+
+@pytest.fixture(name="teacher")
+def fixture_teacher():
+    torch.manual_seed(0)
+    return LlamaForCausalLM(
+        LlamaConfig(
+            vocab_size=64,
+            hidden_size=16,
+            intermediate_size=32,
+            num_hidden_layers=1,
+            num_attention_heads=2,
+            num_key_value_heads=2,
+        )
+    )
+
+
+@pytest.fixture(name="softcapped_teacher")
+def fixture_softcapped_teacher():
+    torch.manual_seed(0)
+    # softcaps its logits after the lm_head
+    return Gemma2ForCausalLM(
+        Gemma2Config(
+            vocab_size=64,
+            hidden_size=16,
+            intermediate_size=32,
+            num_hidden_layers=1,
+            num_attention_heads=2,
+            num_key_value_heads=1,
+            head_dim=8,
+            final_logit_softcapping=0.5,
+            attn_implementation="eager",
+        )
+    )
+
+
+@pytest.fixture(name="dataset")
+def fixture_dataset():
+    rng = np.random.default_rng(0)
+    rows = []
+    for _ in range(23):
+        length = int(rng.integers(2, 30))
+        input_ids = rng.integers(1, 64, length).tolist()
+        prompt_len = int(rng.integers(0, length))
+        rows.append(
+            {
+                "input_ids": input_ids,
+                "labels": [-100] * prompt_len + input_ids[prompt_len:],
+                "attention_mask": [1] * length,
+            }
+        )
+    return Dataset.from_list(rows)
+
+
+@pytest.mark.parametrize("teacher_name", ["teacher", "softcapped_teacher"])
+def test_matches_unbatched_teacher(teacher_name, dataset, tmp_path, request):
+    teacher = request.getfixturevalue(teacher_name)
+    path = generate_teacher_logprobs(
+        teacher, dataset, tmp_path, top_k=4, batch_tokens=64, shard_size=10
+    )
+    assert path.name == dataset._fingerprint  # pylint: disable=protected-access
+    logprobs = TeacherLogprobs(path)
+    assert len(logprobs) == len(dataset)
+
+    for idx, row in enumerate(dataset):
+        labels = np.array(row["labels"])
+        expected_positions = np.flatnonzero(labels != -100)
+        expected_positions = expected_positions[expected_positions > 0]
+        with torch.no_grad():
+            logits = teacher(torch.tensor([row["input_ids"]])).logits[0]
+        top_logits, top_ids = torch.topk(logits[expected_positions - 1], 4)
+        expected = torch.log_softmax(top_logits, dim=-1)
+
+        targets = logprobs[idx]
+        assert targets["positions"].tolist() == expected_positions.tolist()
+        assert targets["target_token_ids"].tolist() == top_ids.tolist()
+        np.testing.assert_allclose(
+            targets["target_logprobs"].astype(np.float32), expected, atol=2e-3
+        )
+
+        dense = logprobs.dense_targets(idx, len(row["input_ids"]))
+        assert dense["target_mask"].any(-1).tolist() == [
+            pos in expected_positions for pos in range(len(labels))
+        ]
+
+
+def test_resumes_missing_shards(teacher, dataset, tmp_path):
+    path = generate_teacher_logprobs(
+        teacher, dataset, tmp_path, top_k=4, batch_tokens=64, shard_size=10
+    )
+    expected = TeacherLogprobs(path)[15]["target_logprobs"].copy()
+    shutil.rmtree(path / "shard-00001")
+    with pytest.raises(FileNotFoundError, match="kd-generate"):
+        TeacherLogprobs(path)
+
+    batch_sizes = []
+    teacher.model.register_forward_hook(
+        lambda module, args, kwargs, output: batch_sizes.append(
+            len(kwargs["input_ids"])
+        ),
+        with_kwargs=True,
+    )
+    generate_teacher_logprobs(
+        teacher, dataset, tmp_path, top_k=4, batch_tokens=64, shard_size=10
+    )
+    # only the 10 rows of the missing shard are run again
+    assert sum(batch_sizes) == 10
+    np.testing.assert_array_equal(
+        TeacherLogprobs(path)[15]["target_logprobs"], expected
+    )
+
+    with pytest.raises(ValueError, match="generated with"):
+        generate_teacher_logprobs(teacher, dataset, tmp_path, top_k=8, shard_size=10)
+
+
+@pytest.mark.parametrize("packed", [False, True])
+def test_collator_fills_joined_targets(teacher, dataset, tmp_path, packed):
+    generate_teacher_logprobs(teacher, dataset, tmp_path, top_k=4, shard_size=10)
+    joined, logprobs = join_teacher_logprobs(dataset, tmp_path)
+    assert joined[TEACHER_ROW_IDX] == list(range(len(dataset)))
+
+    tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=Tokenizer(
+            WordLevel({"<pad>": 0, "<unk>": 1}, unk_token="<unk>")
+        ),
+        pad_token="<pad>",
+    )
+    rows = [3, 17, 12]
+    if packed:
+        collator = KDBatchSamplerDataCollatorForSeq2Seq(
+            tokenizer, teacher_logprobs=logprobs
+        )
+        batch = collator([[joined[idx] for idx in rows]])
+    else:
+        collator = DataCollatorForKD(tokenizer, teacher_logprobs=logprobs)
+        batch = collator([joined[idx] for idx in rows])
+    assert TEACHER_ROW_IDX not in batch
+
+    offset = 0
+    for i, idx in enumerate(rows):
+        seq_len = len(dataset[idx]["input_ids"])
+        dense = logprobs.dense_targets(idx, seq_len)
+        item = 0 if packed else i
+        block = slice(offset, offset + seq_len)
+        assert (
+            batch["target_mask"][item, block].bool().tolist()
+            == dense["target_mask"].tolist()
+        )
+        assert (
+            batch["target_token_ids"][item, block].tolist()
+            == dense["target_token_ids"].tolist()
+        )
+        if packed:
+            offset += seq_len
+
+
+def test_join_checks_the_fingerprint(teacher, dataset, tmp_path):
+    with pytest.raises(FileNotFoundError, match="kd-generate"):
+        join_teacher_logprobs(dataset, tmp_path)
+
+    path = generate_teacher_logprobs(teacher, dataset, tmp_path, top_k=4, shard_size=10)
+    # logprobs of another dataset where the ones of `dataset` are looked up
+    other = dataset.select(range(10))
+    other_path = generate_teacher_logprobs(
+        teacher, other, tmp_path, top_k=4, shard_size=10
+    )
+    shutil.rmtree(path)
+    other_path.rename(path)
+    with pytest.raises(ValueError, match="another dataset"):
+        join_teacher_logprobs(dataset, tmp_path)
+
+
+def test_joins_token_store(teacher, dataset, tmp_path):
+    store = TokenStore.write(dataset, tmp_path / "store", vocab_size=64)
+    generate_teacher_logprobs(teacher, store, tmp_path, top_k=4, shard_size=10)
+    joined, logprobs = join_teacher_logprobs(store, tmp_path)
+    assert [joined[idx][TEACHER_ROW_IDX] for idx in [0, 7]] == [0, 7]
+    assert len(logprobs) == len(store)
@@ -0,0 +1,70 @@
+"""
+tests for finding the turns of the chat_template prompt strategy by offsets
+"""
+
+import logging
+
+import pytest
+
+from axolotl.prompt_strategies.chat_template import (
+    ChatTemplatePrompter,
+    ChatTemplateStrategy,
+)
+from axolotl.utils.chat_templates import get_chat_template
+
+from .test_chat_templates_advanced import PARAMETRIZE_KEYS, PARAMETRIZE_PARAMS
+from .test_chat_templates_advanced import (
+    TestChatTemplateConfigurations as ChatTemplateConfigurations,
+)
+
+LOG = logging.getLogger("axolotl")
+
+
+@pytest.mark.parametrize(
+    PARAMETRIZE_KEYS,
+    PARAMETRIZE_PARAMS,
+)
+class TestChatTemplateTurnBoundaries:
+    """
+    Test class for turn_boundaries: offsets of ChatTemplateStrategy.
+    """
+
+    @pytest.mark.parametrize("train_on_eos", ["turn", "all", "last"])
+    def test_turn_boundaries_offsets_matches_diff(
+        self,
+        tokenizer,
+        chat_template,
+        chat_template_jinja,
+        eos_token,
+        train_on_eos,
+        basic_dataset,
+        request,
+    ):
+        LOG.info("Testing turn_boundaries=offsets against the default diff")
+
+        tokenizer, chat_template_jinja = ChatTemplateConfigurations.setup_tokenizer(
+            tokenizer, chat_template, chat_template_jinja, eos_token, request
+        )
+
+        results = {}
+        for turn_boundaries in ["diff", "offsets"]:
+            strategy = ChatTemplateStrategy(
+                ChatTemplatePrompter(
+                    tokenizer,
+                    chat_template=get_chat_template(
+                        chat_template, jinja_template=chat_template_jinja
+                    ),
+                    message_property_mappings={"role": "from", "content": "value"},
+                    field_messages="conversations",
+                ),
+                tokenizer=tokenizer,
+                train_on_inputs=False,
+                sequence_len=512,
+                roles_to_train=["assistant", "human"],
+                train_on_eos=train_on_eos,
+                turn_boundaries=turn_boundaries,
+            )
+            results[turn_boundaries] = strategy.tokenize_prompt(basic_dataset[0])
+
+        assert results["offsets"]["input_ids"] == results["diff"]["input_ids"]
+        assert results["offsets"]["labels"] == results["diff"]["labels"]
@@ -0,0 +1,120 @@
+"""
+tests for the prompt prefix cache of the chat_template prompt strategy
+"""
+
+import logging
+
+import pytest
+from datasets import concatenate_datasets
+
+from axolotl.prompt_strategies.chat_template import (
+    ChatTemplatePrompter,
+    ChatTemplateStrategy,
+)
+from axolotl.utils.chat_templates import get_chat_template
+from axolotl.utils.tokenization import record_prefix_cache_stats
+
+from .test_chat_templates_advanced import PARAMETRIZE_KEYS, PARAMETRIZE_PARAMS
+from .test_chat_templates_advanced import (
+    TestChatTemplateConfigurations as ChatTemplateConfigurations,
+)
+
+LOG = logging.getLogger("axolotl")
+
+
+def load_strategy(tokenizer, chat_template, chat_template_jinja, prefix_cache_size):
+    # pylint: disable=duplicate-code
+    prompter = ChatTemplatePrompter(
+        tokenizer,
+        chat_template=get_chat_template(
+            chat_template, jinja_template=chat_template_jinja
+        ),
+        message_property_mappings={"role": "from", "content": "value"},
+        field_messages="conversations",
+        prefix_cache_size=prefix_cache_size,
+    )
+    return ChatTemplateStrategy(
+        prompter,
+        tokenizer=tokenizer,
+        train_on_inputs=False,
+        sequence_len=512,
+        roles_to_train=["assistant"],
+    )
+
+
+@pytest.mark.parametrize(
+    PARAMETRIZE_KEYS,
+    PARAMETRIZE_PARAMS,
+)
+class TestChatTemplatePrefixCache:
+    """
+    Test class for the prefix_cache_size option of ChatTemplatePrompter.
+    """
+
+    def test_prefix_cache_matches_uncached(
+        self,
+        tokenizer,
+        chat_template,
+        chat_template_jinja,
+        eos_token,
+        basic_dataset,
+        request,
+    ):
+        LOG.info("Testing the system prompt prefix cache against no cache")
+
+        tokenizer, chat_template_jinja = ChatTemplateConfigurations.setup_tokenizer(
+            tokenizer, chat_template, chat_template_jinja, eos_token, request
+        )
+
+        results = {}
+        for prefix_cache_size in [None, 8]:
+            strategy = load_strategy(
+                tokenizer, chat_template, chat_template_jinja, prefix_cache_size
+            )
+            prompter = strategy.prompter
+            results[prefix_cache_size] = [strategy.tokenize_prompt(basic_dataset[0])]
+            hits = prompter.prefix_cache.hits if prefix_cache_size else 0
+            results[prefix_cache_size].append(
+                strategy.tokenize_prompt(basic_dataset[0])
+            )
+            if prefix_cache_size and chat_template == "llama3":
+                # the system prompt is followed by a special token, so the second
+                # tokenization reuses its cached ids
+                assert prompter.prefix_cache.hits > hits
+
+        for cached, uncached in zip(results[8], results[None]):
+            assert cached["input_ids"] == uncached["input_ids"]
+            assert cached["labels"] == uncached["labels"]
+
+    def test_prefix_cache_stats_are_summed_over_workers(
+        self,
+        tokenizer,
+        chat_template,
+        chat_template_jinja,
+        eos_token,
+        basic_dataset,
+        request,
+    ):
+        LOG.info("Testing the prefix cache stats of a multiprocess map")
+
+        tokenizer, chat_template_jinja = ChatTemplateConfigurations.setup_tokenizer(
+            tokenizer, chat_template, chat_template_jinja, eos_token, request
+        )
+        strategy = load_strategy(tokenizer, chat_template, chat_template_jinja, 8)
+        prompter = strategy.prompter
+        dataset = concatenate_datasets([basic_dataset] * 4)
+
+        recorded = []
+        for num_proc in [None, 2]:
+            with record_prefix_cache_stats(prompter.prefix_cache) as stats:
+                dataset.map(
+                    strategy.tokenize_prompts,
+                    batched=True,
+                    num_proc=num_proc,
+                    remove_columns=dataset.column_names,
+                )
+            recorded.append(stats)
+
+        assert prompter.prefix_cache.stats_dir is None
+        assert recorded[0]["lookups"] > 0
+        assert recorded[1]["lookups"] == recorded[0]["lookups"]
@@ -0,0 +1,45 @@
+"""
+tests for completion prompt strategy
+"""
+
+from datasets import Dataset
+
+from axolotl.datasets import TokenizedPromptDataset
+from axolotl.prompt_strategies.completion import load
+from axolotl.utils.dict import DictDefault
+
+
+class TestCompletionPromptTokenizingStrategy:
+    """
+    Test class for completion prompt strategy
+    """
+
+    def test_completion_chunks_and_trains_on_text(self, smollm2_tokenizer):
+        cfg = DictDefault(train_on_inputs=False, sequence_len=16)
+        strategy = load(smollm2_tokenizer, cfg)
+        texts = [
+            " ".join(f"word{idx}" for idx in range(40)),
+            "a short text",
+        ]
+        dataset = Dataset.from_list([{"text": text} for text in texts])
+
+        dataset_wrapper = TokenizedPromptDataset(strategy, dataset, process_count=1)
+
+        expected_chunks = []
+        for text in texts:
+            input_ids = smollm2_tokenizer(text)["input_ids"]
+            if input_ids[-1] != smollm2_tokenizer.eos_token_id:
+                input_ids.append(smollm2_tokenizer.eos_token_id)
+            expected_chunks.extend(
+                input_ids[i : i + cfg.sequence_len]
+                for i in range(0, len(input_ids), cfg.sequence_len)
+            )
+        # the long text is split into several `sequence_len` rows
+        assert len(expected_chunks) > len(texts)
+        assert dataset_wrapper["input_ids"] == expected_chunks
+        # the whole text is trained on, even with train_on_inputs: false
+        assert dataset_wrapper["labels"] == expected_chunks
+        for attention_mask, input_ids in zip(
+            dataset_wrapper["attention_mask"], expected_chunks
+        ):
+            assert attention_mask == [1] * len(input_ids)
@@ -0,0 +1,58 @@
+"""
+Test module for the compact Arrow schema of prepared datasets
+"""
+
+import unittest
+
+import numpy as np
+import pytest
+from datasets import Dataset
+
+from axolotl.utils.compact_schema import (
+    CompactSchemaCollator,
+    compact_dataset,
+    expand_compact_row,
+)
+from axolotl.utils.dataset_stats import compute_dataset_stats
+
+
+class TestCompactSchema(unittest.TestCase):
+    """
+    Test class for compacting prepared datasets and expanding their rows
+    """
+
+    dataset: Dataset
+
+    @pytest.fixture(autouse=True)
+    def inject_fixtures(self, tokenized_dataset):
+        self.dataset = tokenized_dataset
+
+    def test_round_trip(self):
+        compacted = compact_dataset(self.dataset, vocab_size=70_000)
+        assert compacted.features["input_ids"].feature.dtype == "uint32"
+        assert sorted(compacted.column_names) == ["input_ids", "label_mask", "length"]
+        for idx, row in enumerate(compacted):
+            expanded = expand_compact_row(row)
+            expected = self.dataset[idx]
+            assert sorted(expanded) == sorted(expected)
+            for column, values in expected.items():
+                assert np.asarray(expanded[column]).tolist() == values
+
+        stats = compute_dataset_stats(compacted)
+        expected_stats = compute_dataset_stats(self.dataset)
+        np.testing.assert_array_equal(stats.lengths, expected_stats.lengths)
+        np.testing.assert_array_equal(
+            stats.supervised_tokens, expected_stats.supervised_tokens
+        )
+
+    def test_collator_expands_packs(self):
+        compacted = compact_dataset(self.dataset, vocab_size=70_000)
+        collator = CompactSchemaCollator(lambda features: features)
+        packs = collator([[compacted[0], compacted[1]], [compacted[2]]])
+        assert packs[0][1]["labels"].tolist() == self.dataset[1]["labels"]
+        assert packs[1][0]["position_ids"].tolist() == self.dataset[2]["position_ids"]
+
+    def test_rejects_other_labels(self):
+        dataset = Dataset.from_list([{"input_ids": [1, 2, 3], "labels": [1, 5, 3]}])
+        with pytest.raises(ValueError, match="labels"):
+            compact_dataset(dataset, vocab_size=100)
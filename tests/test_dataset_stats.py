@@ -0,0 +1,170 @@
+"""
+Test module for the vectorized per row statistics of tokenized datasets
+"""
+
+import json
+import tempfile
+import unittest
+from pathlib import Path
+from unittest.mock import patch
+
+import numpy as np
+from datasets import Dataset, concatenate_datasets, load_from_disk
+
+from axolotl.utils.data.utils import drop_long_seq_in_dataset
+from axolotl.utils.dataset_stats import (
+    SOURCE_COLUMN,
+    STATS_CACHE_SIZE,
+    STATS_DIR,
+    add_dataset_sources,
+    get_dataset_stats,
+    load_dataset_stats,
+    remap_dataset_sources,
+    save_dataset_stats,
+)
+from axolotl.utils.dict import DictDefault
+from axolotl.utils.samplers import get_dataset_lengths
+
+
+class TestDatasetStats(unittest.TestCase):
+    """
+    Test class for the statistics engine and the passes using it
+    """
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        rows = []
+        for _ in range(300):
+            length = int(rng.integers(0, 40))
+            input_ids = rng.integers(0, 32_000, length).tolist()
+            train = rng.random(length) < rng.random()
+            rows.append(
+                {
+                    "input_ids": input_ids,
+                    "labels": [tok if t else -100 for tok, t in zip(input_ids, train)],
+                }
+            )
+        # several chunks, and a shuffle leaves an indices mapping over them
+        self.dataset = concatenate_datasets(
+            [Dataset.from_list(rows[:100]), Dataset.from_list(rows[100:])]
+        ).shuffle(seed=42)
+
+    def test_matches_python(self):
+        stats = get_dataset_stats(self.dataset)
+        input_ids = self.dataset["input_ids"]
+        labels = self.dataset["labels"]
+        assert stats.lengths.tolist() == [len(row) for row in input_ids]
+        assert stats.supervised_tokens.tolist() == [
+            sum(label != -100 for label in row) for row in labels
+        ]
+        assert stats.trainable_mask.tolist() == [
+            not row or any(label != -100 for label in row) for row in labels
+        ]
+        assert stats.num_tokens == sum(len(row) for row in input_ids)
+        np.testing.assert_array_equal(get_dataset_lengths(self.dataset), stats.lengths)
+
+    def test_drop_long_seq_carries_stats(self):
+        cfg = DictDefault({"sequence_len": 30, "min_sample_len": 2})
+        dataset = drop_long_seq_in_dataset(self.dataset, cfg)
+        lengths = [len(row) for row in dataset["input_ids"]]
+        assert lengths == [
+            len(row) for row in self.dataset["input_ids"] if 2 <= len(row) <= 30
+        ]
+        assert get_dataset_stats(dataset).lengths.tolist() == lengths
+
+    def test_position_ids_lengths(self):
+        dataset = self.dataset.map(
+            lambda row: {"position_ids": list(range(len(row["input_ids"])))}
+        )
+        np.testing.assert_array_equal(
+            get_dataset_lengths(dataset),
+            [len(row) for row in dataset["input_ids"]],
+        )
+
+    def test_sidecar_round_trip(self):
+        dataset = self.dataset.map(
+            lambda row: {"position_ids": list(range(len(row["input_ids"])))}
+        )
+        dataset = add_dataset_sources(dataset, np.arange(len(dataset)) % 2)
+        stats = get_dataset_stats(dataset)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            dataset.save_to_disk(tmp_dir)
+            save_dataset_stats(
+                tmp_dir, dataset, [{"path": "first"}, {"path": "second"}]
+            )
+            with open(
+                Path(tmp_dir) / STATS_DIR / "stats.json", encoding="utf-8"
+            ) as fin:
+                summary = json.load(fin)
+            assert summary["num_tokens"] == stats.num_tokens
+            assert summary["sources"] == [
+                {"path": "first", "num_rows": 150},
+                {"path": "second", "num_rows": 150},
+            ]
+
+            loaded = load_from_disk(tmp_dir)
+            assert load_dataset_stats(tmp_dir, loaded)
+            with patch(
+                "axolotl.utils.dataset_stats.compute_dataset_stats",
+                side_effect=AssertionError("stats should be loaded"),
+            ):
+                loaded_stats = get_dataset_stats(loaded)
+                lengths = get_dataset_lengths(loaded)
+            np.testing.assert_array_equal(loaded_stats.lengths, stats.lengths)
+            np.testing.assert_array_equal(
+                loaded_stats.supervised_tokens, stats.supervised_tokens
+            )
+            np.testing.assert_array_equal(lengths, stats.lengths)
+
+    def test_remaps_sources_to_configured_order(self):
+        sources = (np.arange(len(self.dataset)) % 3).astype(np.int32)
+        dataset = add_dataset_sources(self.dataset, sources)
+        saved_sources = [{"path": "first"}, {"path": "second"}, {"path": "third"}]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            dataset.save_to_disk(tmp_dir)
+            save_dataset_stats(tmp_dir, dataset, saved_sources)
+
+            # the same datasets configured in another order
+            loaded = load_from_disk(tmp_dir)
+            assert load_dataset_stats(tmp_dir, loaded)
+            remapped = remap_dataset_sources(tmp_dir, loaded, saved_sources[::-1])
+            np.testing.assert_array_equal(
+                get_dataset_stats(remapped).sources, 2 - sources
+            )
+            assert remapped[0][SOURCE_COLUMN] == 2 - sources[0]
+
+            loaded = load_from_disk(tmp_dir)
+            remapped = remap_dataset_sources(tmp_dir, loaded, [{"path": "other"}])
+            assert SOURCE_COLUMN not in remapped.column_names
+            assert get_dataset_stats(remapped).sources is None
+
+    def test_sources_survive_cache_eviction(self):
+        sources = (np.arange(len(self.dataset)) % 3).astype(np.int32)
+        dataset = add_dataset_sources(self.dataset, sources)
+        subset = dataset.filter(lambda row: len(row["input_ids"]) > 10)
+        expected = sources[[len(row) > 10 for row in self.dataset["input_ids"]]]
+        # the stats of other datasets push out the ones of `subset`
+        for length in range(STATS_CACHE_SIZE + 1):
+            get_dataset_stats(Dataset.from_dict({"input_ids": [[1] * length]}))
+        np.testing.assert_array_equal(get_dataset_stats(subset).sources, expected)
+
+    def test_ignores_stale_sidecar_of_same_length(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path, other_path = Path(tmp_dir) / "prepared", Path(tmp_dir) / "other"
+            self.dataset.save_to_disk(str(path))
+            save_dataset_stats(path, self.dataset)
+
+            # another dataset of as many rows saved over it, with the old stats
+            other = self.dataset.map(
+                lambda row: {"input_ids": row["input_ids"] + [1]}
+            ).flatten_indices()
+            other.save_to_disk(str(other_path))
+            for name in ["state.json", "data-00000-of-00001.arrow"]:
+                (other_path / name).replace(path / name)
+
+            loaded = load_from_disk(str(path))
+            assert len(loaded) == len(self.dataset)
+            assert not load_dataset_stats(path, loaded)
+            assert get_dataset_stats(loaded).lengths.tolist() == [
+                len(row) for row in other["input_ids"]
+            ]
@@ -6,6 +6,7 @@ import shutil
 import tempfile
 import unittest
 from pathlib import Path
+from unittest.mock import patch
 
 from constants import (
     ALPACA_MESSAGES_CONFIG_OG,
@@ -16,8 +17,11 @@ from datasets import Dataset
 from huggingface_hub import snapshot_download
 from transformers import AutoTokenizer
 
+from axolotl.prompters import AlpacaPrompter
 from axolotl.utils.data import load_tokenized_prepared_datasets
+from axolotl.utils.data.pieces import tokenize_dataset_slices
 from axolotl.utils.data.rl import load_prepare_preference_datasets
+from axolotl.utils.data.sft import get_dataset_wrapper, prepared_datasets_exist
 from axolotl.utils.dict import DictDefault
 
 
@@ -135,6 +139,134 @@ class TestDatasetPreparation(unittest.TestCase):
             assert "attention_mask" in dataset.features
             assert "labels" in dataset.features
 
+    def test_reuses_tokenized_datasets_across_mixes(self):
+        """Verify each dataset is tokenized once and reused when the mix changes."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            ds_paths = []
+            for idx in range(2):
+                ds_paths.append(str(Path(tmp_dir) / f"tmp_dataset_{idx}"))
+                self.dataset.save_to_disk(ds_paths[-1])
+
+            prepared_path = Path(tmp_dir) / "prepared"
+
+            def load_mix(ds_types, **ds_config):
+                cfg = DictDefault(
+                    {
+                        "tokenizer_config": "huggyllama/llama-7b",
+                        "sequence_len": 256,
+                        "dataset_prepared_path": str(prepared_path),
+                        "local_rank": 0,
+                        "datasets": [
+                            {"path": path, "type": ds_type, **ds_config}
+                            for path, ds_type in zip(ds_paths, ds_types)
+                        ],
+                    }
+                )
+                dataset, prompters = load_tokenized_prepared_datasets(
+                    self.tokenizer, cfg, prepared_path
+                )
+                assert len(dataset) == len(ds_types)
+                # the prompters are the same whether the pieces are cached or not
+                assert [type(prompter) for prompter in prompters] == [
+                    AlpacaPrompter
+                ] * len(ds_types)
+                return set((prepared_path / "datasets").iterdir())
+
+            pieces = load_mix(["alpaca", "alpaca"])
+            assert len(pieces) == 2
+
+            # only the dataset whose prompt strategy changed is re-tokenized
+            new_pieces = load_mix(["alpaca", "alpaca:chat"])
+            assert len(new_pieces) == 3
+            assert pieces < new_pieces
+
+            assert load_mix(["alpaca"]) == new_pieces
+            # options that only change how fast a dataset is tokenized still hit
+            assert (
+                load_mix(["alpaca"], prefix_cache_size=8, turn_boundaries="offsets")
+                == new_pieces
+            )
+
+    def test_preprocess_retokenizes_cached_datasets(self):
+        """Verify `axolotl preprocess` tokenizes again instead of loading a piece."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tmp_ds_path = Path(tmp_dir) / "tmp_dataset"
+            self.dataset.save_to_disk(str(tmp_ds_path))
+            prepared_path = Path(tmp_dir) / "prepared"
+
+            def make_cfg(**kwargs):
+                return DictDefault(
+                    {
+                        "tokenizer_config": "huggyllama/llama-7b",
+                        "sequence_len": 256,
+                        "dataset_prepared_path": str(prepared_path),
+                        "local_rank": 0,
+                        "datasets": [{"path": str(tmp_ds_path), "type": "alpaca"}],
+                        **kwargs,
+                    }
+                )
+
+            load_tokenized_prepared_datasets(self.tokenizer, make_cfg(), prepared_path)
+            pieces = set((prepared_path / "datasets").iterdir())
+            assert len(pieces) == 1
+
+            with patch(
+                "axolotl.utils.data.sft.get_dataset_wrapper", wraps=get_dataset_wrapper
+            ) as wrapper:
+                dataset, _ = load_tokenized_prepared_datasets(
+                    self.tokenizer, make_cfg(is_preprocess=True), prepared_path
+                )
+            assert wrapper.call_count == 1
+            assert len(dataset) == 1
+            # the piece is replaced in place
+            assert set((prepared_path / "datasets").iterdir()) == pieces
+
+    def test_merges_tokenized_dataset_slices(self):
+        """Verify tokenizing slices separately matches tokenizing in one go."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tmp_ds_path = Path(tmp_dir) / "tmp_dataset"
+            Dataset.from_list(
+                [
+                    {"instruction": f"instruction {idx}", "input": "", "output": "ok"}
+                    for idx in range(10)
+                ]
+            ).save_to_disk(str(tmp_ds_path))
+
+            def make_cfg(prepared_path):
+                return DictDefault(
+                    {
+                        "tokenizer_config": "huggyllama/llama-7b",
+                        "sequence_len": 256,
+                        "dataset_prepared_path": str(prepared_path),
+                        "local_rank": 0,
+                        "datasets": [{"path": str(tmp_ds_path), "type": "alpaca"}],
+                    }
+                )
+
+            expected, _ = load_tokenized_prepared_datasets(
+                self.tokenizer, make_cfg(Path(tmp_dir) / "full"), Path(tmp_dir)
+            )
+
+            cfg = make_cfg(Path(tmp_dir) / "sliced")
+            for index in range(3):
+                tokenize_dataset_slices(self.tokenizer, cfg, index, 3)
+            assert len(list((Path(tmp_dir) / "sliced" / "datasets").iterdir())) == 3
+
+            assert not prepared_datasets_exist(cfg, Path(tmp_dir))
+            dataset, _ = load_tokenized_prepared_datasets(
+                self.tokenizer, cfg, Path(tmp_dir)
+            )
+            assert dataset["input_ids"] == expected["input_ids"]
+            assert dataset["labels"] == expected["labels"]
+            assert prepared_datasets_exist(cfg, Path(tmp_dir))
+
+            # the merged slices are saved as the whole dataset, so slicing it
+            # differently doesn't tokenize it again
+            pieces = set((Path(tmp_dir) / "sliced" / "datasets").iterdir())
+            assert len(pieces) == 4
+            tokenize_dataset_slices(self.tokenizer, cfg, 0, 2)
+            assert set((Path(tmp_dir) / "sliced" / "datasets").iterdir()) == pieces
+
     def test_load_from_dir_of_parquet(self):
         """Usual use case.  Verify a directory of parquet files can be loaded."""
         with tempfile.TemporaryDirectory() as tmp_dir:
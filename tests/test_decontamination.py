@@ -0,0 +1,51 @@
+"""
+Test module for benchmark decontamination with a hashed n-gram index
+"""
+
+import unittest
+
+import numpy as np
+from datasets import Dataset
+
+from axolotl.utils.data.decontamination import build_ngram_index, find_contaminated_rows
+
+
+class TestDecontamination(unittest.TestCase):
+    """
+    Test class for the n-gram index and the contamination scan
+    """
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.benchmark = Dataset.from_dict(
+            {"input_ids": [rng.integers(0, 32_000, 40).tolist() for _ in range(10)]}
+        )
+        question = self.benchmark[3]["input_ids"]
+        self.train = Dataset.from_dict(
+            {
+                "input_ids": [
+                    rng.integers(0, 32_000, 100).tolist(),
+                    # the benchmark question inside a longer conversation
+                    [1, 2, 3] + question[5:25] + [4, 5],
+                    # too short an overlap
+                    [7] + question[:12] + [8],
+                    question[:13],
+                    [],
+                ]
+            }
+        )
+
+    def test_index_is_sorted_and_unique(self):
+        index = build_ngram_index([self.benchmark, self.benchmark], ngram_size=13)
+        assert len(index) == 10 * (40 - 13 + 1)
+        assert (np.diff(index.astype(np.float64)) > 0).all()
+
+    def test_finds_rows_sharing_an_ngram(self):
+        index = build_ngram_index([self.benchmark], ngram_size=13)
+        contaminated = find_contaminated_rows(self.train, index, ngram_size=13)
+        assert contaminated.tolist() == [False, True, False, True, False]
+
+    def test_empty_index(self):
+        index = build_ngram_index([], ngram_size=13)
+        contaminated = find_contaminated_rows(self.train, index, ngram_size=13)
+        assert not contaminated.any()
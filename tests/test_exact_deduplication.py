@@ -3,14 +3,15 @@ Test suite for functions in the axolotl.utils.data.utils module, focusing on the
 
 Additionally, this test suite includes tests for functions that indirectly call deduplicate_and_log_datasets during the execution of the preprocess command.
 """
-import hashlib
 import unittest
 from unittest.mock import patch
 
+import numpy as np
 from constants import ALPACA_MESSAGES_CONFIG_REVISION, SPECIAL_TOKENS
 from datasets import Dataset
 from transformers import AutoTokenizer
 
+from axolotl.datasets import SOURCE_COLUMN
 from axolotl.utils.data import prepare_dataset
 from axolotl.utils.data.rl import load_prepare_preference_datasets
 from axolotl.utils.data.utils import deduplicate_and_log_datasets
@@ -211,6 +212,21 @@ class TestDeduplicateIndividualFunctions(unittest.TestCase):
         verify_deduplication(train_dataset, expected_dataset_train, "train_dataset")
         verify_deduplication(eval_dataset, expected_dataset_eval, "eval_dataset")
 
+    def test_duplicates_across_sources(self):
+        # rows from different datasets are duplicates of each other
+        dataset = self.dataset.add_column(
+            SOURCE_COLUMN, [0, 0, 1, 1, 2], new_fingerprint="duplicates_across_sources"
+        )
+
+        train_dataset, _, _ = deduplicate_and_log_datasets(train_dataset=dataset)
+
+        assert train_dataset[SOURCE_COLUMN] == [0, 0, 1]
+        verify_deduplication(
+            train_dataset.remove_columns(SOURCE_COLUMN),
+            self.expected_dataset,
+            "train_dataset",
+        )
+
 
 class TestDeduplicateRLDataset(unittest.TestCase):
     """Test a configured dataloader with deduplication."""
@@ -385,12 +401,10 @@ class TestWrongCollisions(unittest.TestCase):
         self.dataset = Dataset.from_dict(self.dataset_data)
 
     @patch(
-        "axolotl.utils.data.utils.sha256",
-        side_effect=lambda x: hashlib.sha256(
-            "forced_collision_hash".encode("utf-8")
-        ).hexdigest()
-        if "sample 5" in x
-        else hashlib.sha256(x.encode("utf-8")).hexdigest(),
+        "axolotl.utils.data.dedup.hash_rows",
+        side_effect=lambda table, num_proc=None: np.zeros(
+            table.num_rows, dtype=np.uint64
+        ),
     )
     def test_deduplication_wrong_collision_train_eval(self, _mock_sha256):
         dedup_train, dedup_eval, _ = deduplicate_and_log_datasets(
@@ -0,0 +1,72 @@
+"""
+Test module for weighted dataset mixtures drawn by the sampler
+"""
+
+import numpy as np
+import pytest
+import torch
+from datasets import Dataset
+
+from axolotl.utils.dict import DictDefault
+from axolotl.utils.samplers import (
+    MixtureSampler,
+    MultipackBatchSampler,
+    get_mixture_sampler,
+    get_sample_ratios,
+)
+
+
+class TestMixtureSampler:
+    """
+    Test class for MixtureSampler
+    """
+
+    sources = np.repeat(np.arange(3, dtype=np.int32), [100, 50, 10])
+
+    def test_draws_ratios_of_every_dataset(self):
+        sampler = MixtureSampler(self.sources, [0.5, 2.0, 1.3])
+        indices = np.fromiter(sampler, dtype=np.int64)
+        assert len(indices) == len(sampler) == 50 + 100 + 13
+        counts = np.bincount(self.sources[indices], minlength=3)
+        assert counts.tolist() == [50, 100, 13]
+        # a fraction of a dataset is sampled without replacement
+        assert len(np.unique(indices[self.sources[indices] == 0])) == 50
+        # whole multiples repeat every row
+        assert np.bincount(indices[self.sources[indices] == 1]).max() == 2
+
+    def test_redrawn_from_generator(self):
+        generator = torch.Generator()
+        sampler = MixtureSampler(self.sources, [0.5, 1.0, 1.0], generator=generator)
+        generator.manual_seed(0)
+        first = list(sampler)
+        second = list(sampler)
+        generator.manual_seed(0)
+        assert list(sampler) == first
+        assert first != second
+
+    def test_multipack_plan(self):
+        lengths = np.random.default_rng(0).integers(16, 512, size=len(self.sources))
+        batch_sampler = MultipackBatchSampler(
+            sampler=MixtureSampler(self.sources, [0.5, 2.0, 1.0]),
+            lengths=lengths,
+            batch_size=1,
+            batch_max_len=2048,
+            seed=42,
+        )
+        packed = [idx for batch in batch_sampler for pack in batch for idx in pack]
+        assert len(packed) == 50 + 100 + 10
+        assert np.bincount(self.sources[packed]).tolist() == [50, 100, 10]
+
+    def test_sample_ratios_follow_merge_order(self):
+        cfg_datasets = [
+            DictDefault({"path": "a", "name": ["x", "y"], "sample_ratio": 0.5}),
+            DictDefault({"path": "b"}),
+        ]
+        assert get_sample_ratios(cfg_datasets) == [0.5, 0.5, 1.0]
+        assert get_sample_ratios([DictDefault({"path": "b"})]) is None
+
+    def test_raises_without_sources(self):
+        dataset = Dataset.from_dict({"input_ids": [[1, 2], [3]]})
+        assert get_mixture_sampler(dataset, None) is None
+        with pytest.raises(ValueError, match="sample_ratio"):
+            get_mixture_sampler(dataset, [1.0])
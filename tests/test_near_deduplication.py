@@ -0,0 +1,87 @@
+"""
+Test module for MinHash near deduplication
+"""
+
+import tempfile
+import unittest
+from pathlib import Path
+from unittest.mock import patch
+
+import numpy as np
+from datasets import Dataset
+
+from axolotl.utils.data.dedup import (
+    find_near_duplicate_clusters,
+    lsh_params,
+    minhash_signatures,
+)
+from axolotl.utils.data.utils import near_deduplicate_and_log_dataset
+from axolotl.utils.dict import DictDefault
+
+
+class TestNearDeduplication(unittest.TestCase):
+    """
+    Test class for near deduplication of tokenized datasets
+    """
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        originals = [rng.integers(0, 32_000, 400).tolist() for _ in range(50)]
+        near_duplicates = []
+        for row in originals[:20]:
+            row = list(row)
+            row[int(rng.integers(0, 400))] = int(rng.integers(0, 32_000))
+            near_duplicates.append(row)
+        self.dataset = Dataset.from_dict({"input_ids": originals + near_duplicates})
+        self.cfg = DictDefault({"local_rank": 0, "dataset_processes": 1})
+
+    def test_lsh_params(self):
+        bands, rows = lsh_params(0.8, 128)
+        assert bands * rows <= 128
+        assert (1 / bands) ** (1 / rows) <= 0.8
+
+    def test_signatures_of_identical_rows_match(self):
+        dataset = Dataset.from_dict({"input_ids": [[1, 2, 3], [4, 5], [1, 2, 3], []]})
+        signatures = minhash_signatures(dataset, ngram_size=2)
+        assert signatures.shape == (4, 128)
+        np.testing.assert_array_equal(signatures[0], signatures[2])
+        assert (signatures[0] != signatures[1]).any()
+
+    def test_links_rows_sharing_a_bucket_with_a_dissimilar_row(self):
+        rng = np.random.default_rng(1)
+        bands, rows = lsh_params(0.8, 128)
+        # rows 1 and 2 are similar but only share the bucket of the first band,
+        # whose first row 0 is similar to neither
+        signatures = rng.integers(0, 2**32, (3, 128), dtype=np.uint64)
+        signatures[:, :rows] = signatures[0, :rows]
+        signatures[2] = signatures[1]
+        signatures[2, rows * np.arange(1, bands)] += 1
+        clusters = find_near_duplicate_clusters(signatures, 0.8)
+        assert clusters.tolist() == [0, 1, 1]
+
+    def test_all_distinct_rows_are_their_own_cluster(self):
+        rng = np.random.default_rng(2)
+        signatures = rng.integers(0, 2**32, (5, 128), dtype=np.uint64)
+        clusters = find_near_duplicate_clusters(signatures, 0.8)
+        assert clusters.tolist() == [0, 1, 2, 3, 4]
+
+    def test_single_row(self):
+        signatures = np.arange(128, dtype=np.uint64).reshape(1, 128)
+        clusters = find_near_duplicate_clusters(signatures, 0.8)
+        assert clusters.tolist() == [0]
+
+    def test_keeps_first_row_of_each_cluster(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            self.cfg["dataset_prepared_path"] = tmp_dir
+            deduped = near_deduplicate_and_log_dataset(self.dataset, self.cfg, tmp_dir)
+            assert deduped["input_ids"] == self.dataset["input_ids"][:50]
+            assert len(list((Path(tmp_dir) / "minhash").glob("*.npy"))) == 1
+
+            with patch(
+                "axolotl.utils.data.utils.minhash_signatures",
+                side_effect=AssertionError("signatures should be cached"),
+            ):
+                cached = near_deduplicate_and_log_dataset(
+                    self.dataset, self.cfg, tmp_dir
+                )
+            assert cached["input_ids"] == deduped["input_ids"]
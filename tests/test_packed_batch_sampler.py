@@ -1,4 +1,7 @@
 """Module for testing streaming dataset sequence packing"""
+import math
+
+import numpy as np
 import pytest
 from datasets import concatenate_datasets, load_dataset
 from torch.utils.data import DataLoader, RandomSampler
@@ -9,7 +12,13 @@ from axolotl.prompt_strategies.completion import load
 from axolotl.utils.collators import V2BatchSamplerDataCollatorForSeq2Seq
 from axolotl.utils.data.utils import drop_long_seq_in_dataset
 from axolotl.utils.dict import DictDefault
-from axolotl.utils.samplers import MultipackBatchSampler, get_dataset_lengths
+from axolotl.utils.samplers import (
+    MultipackBatchSampler,
+    PackingCostModel,
+    get_dataset_lengths,
+)
+from axolotl.utils.samplers.cost import balance_bins, rank_imbalance
+from axolotl.utils.samplers.multipack import pack_parallel
 
 
 @pytest.fixture(name="tokenizer")
@@ -95,3 +104,266 @@ class TestBatchedSamplerPacking:
 
         original_idxs = set(range(len(train_dataset)))
         assert original_idxs == set(batch_idxs)
+
+
+class TestGroupedPacking:
+    """
+    Test the grouped/parallel multipack planner on synthetic lengths
+    """
+
+    @pytest.mark.parametrize("num_processes", [1, 2])
+    def test_pack_parallel_is_deterministic(self, num_processes):
+        rng = np.random.default_rng(42)
+        lengths = rng.integers(1, 512, size=5_000)
+
+        bin_ids, num_bins = pack_parallel(
+            lengths, c=2048, group_size=1_000, bin_size=200, num_processes=1
+        )
+        other_bin_ids, other_num_bins = pack_parallel(
+            lengths,
+            c=2048,
+            group_size=1_000,
+            bin_size=200,
+            num_processes=num_processes,
+        )
+
+        assert num_bins == other_num_bins
+        np.testing.assert_array_equal(bin_ids, other_bin_ids)
+        bin_totals = np.bincount(bin_ids, weights=lengths, minlength=num_bins)
+        assert bin_totals.max() <= 2048
+        # groups never share bins
+        assert len(np.intersect1d(bin_ids[:1_000], bin_ids[1_000:])) == 0
+
+    def test_sampler_reuses_its_pool(self):
+        rng = np.random.default_rng(3)
+        lengths = rng.integers(16, 1024, size=2_000)
+
+        batch_sampler = MultipackBatchSampler(
+            sampler=RandomSampler(range(len(lengths))),
+            lengths=lengths,
+            batch_size=2,
+            batch_max_len=2048,
+            group_size=500,
+            num_processes=2,
+        )
+        assert len(batch_sampler) > 0
+        pool = batch_sampler._pool  # pylint: disable=protected-access
+        assert pool is not None
+        batch_idxs = [idx for batch in batch_sampler for pack in batch for idx in pack]
+
+        assert batch_sampler._pool is pool  # pylint: disable=protected-access
+        assert len(set(batch_idxs)) == len(batch_idxs)
+
+    def test_bin_size_is_respected(self):
+        lengths = np.ones(1_000, dtype=np.int64)
+
+        bin_ids, num_bins = pack_parallel(
+            lengths, c=2048, group_size=1_000, bin_size=16
+        )
+
+        assert num_bins == math.ceil(1_000 / 16)
+        assert np.bincount(bin_ids).max() <= 16
+
+    @pytest.mark.parametrize("packing_algorithm", ["ffd", "bfd"])
+    def test_bfd_packs_at_least_as_well_as_ffd(self, packing_algorithm):
+        rng = np.random.default_rng(1)
+        lengths = np.clip(rng.lognormal(6.0, 1.0, size=5_000), 1, 4096).astype(np.int64)
+
+        _, ffd_num_bins = pack_parallel(
+            lengths, c=4096, group_size=None, bin_size=200, algorithm="ffd"
+        )
+        bin_ids, num_bins = pack_parallel(
+            lengths,
+            c=4096,
+            group_size=None,
+            bin_size=200,
+            algorithm=packing_algorithm,
+        )
+
+        assert num_bins <= ffd_num_bins
+        assert np.bincount(bin_ids, weights=lengths).max() <= 4096
+        assert np.bincount(bin_ids).max() <= 200
+
+    @pytest.mark.parametrize(
+        "group_size, packing_algorithm",
+        [
+            (None, "multifit"),
+            (None, "bfd"),
+            (500, "ffd"),
+            (500, "bfd"),
+            (100_000, "ffd"),
+        ],
+    )
+    def test_sampler_covers_all_samples(self, group_size, packing_algorithm):
+        rng = np.random.default_rng(0)
+        lengths = rng.integers(16, 1024, size=2_000)
+
+        batch_sampler = MultipackBatchSampler(
+            sampler=RandomSampler(range(len(lengths))),
+            lengths=lengths,
+            batch_size=2,
+            batch_max_len=2048,
+            group_size=group_size,
+            bin_size=200,
+            packing_algorithm=packing_algorithm,
+        )
+
+        batch_idxs = []
+        for batch in batch_sampler:
+            assert len(batch) <= 2
+            for pack in batch:
+                assert lengths[pack].sum() <= 2048
+                batch_idxs.extend(pack)
+
+        assert sorted(batch_idxs) == list(range(len(lengths)))
+        if packing_algorithm != "multifit":
+            assert batch_sampler.efficiency() > 0.95
+
+    def test_bins_are_not_ordered_by_length(self):
+        rng = np.random.default_rng(5)
+        lengths = rng.integers(16, 1024, size=2_000)
+
+        batch_sampler = MultipackBatchSampler(
+            sampler=RandomSampler(range(len(lengths))),
+            lengths=lengths,
+            batch_size=1,
+            batch_max_len=2048,
+        )
+        longest = np.array([lengths[batch[0]].max() for batch in batch_sampler])
+
+        # ffd opens bins from the longest sample down
+        assert (np.diff(longest) > 0).any()
+
+
+class TestPackingPlanCache:
+    """
+    Test seeded, cached multipack plans
+    """
+
+    @staticmethod
+    def _sampler(lengths, **kwargs):
+        return MultipackBatchSampler(
+            sampler=RandomSampler(range(len(lengths))),
+            lengths=lengths,
+            batch_size=1,
+            batch_max_len=2048,
+            group_size=500,
+            bin_size=200,
+            seed=42,
+            **kwargs,
+        )
+
+    def test_seeded_plan_is_reused(self, tmp_path):
+        lengths = np.random.default_rng(0).integers(16, 1024, size=2_000)
+
+        batch_sampler = self._sampler(lengths, plan_cache_dir=str(tmp_path))
+        num_batches = len(batch_sampler)
+        epoch_0 = list(batch_sampler)
+        # iterating leaves the epoch alone, so a resumed run sees the same plan
+        assert list(batch_sampler) == epoch_0
+        batch_sampler.set_epoch(1)
+        epoch_1 = list(batch_sampler)
+
+        assert len(epoch_0) == num_batches
+        assert epoch_0 != epoch_1
+        plan_files = list(tmp_path.glob("multipack_plan_*.npy"))
+        assert len(plan_files) == 2
+        assert all(np.load(f).dtype == np.int32 for f in plan_files)
+
+        # a fresh sampler (e.g. after a restart) loads the same plans from disk
+        restarted = self._sampler(lengths, plan_cache_dir=str(tmp_path))
+        assert list(restarted) == epoch_0
+        restarted.set_epoch(1)
+        assert list(restarted) == epoch_1
+        assert len(list(tmp_path.glob("multipack_plan_*.npy"))) == 2
+
+    def test_plan_depends_on_seed(self):
+        lengths = np.random.default_rng(0).integers(16, 1024, size=2_000)
+
+        assert list(self._sampler(lengths)) == list(self._sampler(lengths))
+        other = MultipackBatchSampler(
+            sampler=RandomSampler(range(len(lengths))),
+            lengths=lengths,
+            batch_size=1,
+            batch_max_len=2048,
+            group_size=500,
+            seed=7,
+        )
+        assert list(other) != list(self._sampler(lengths))
+
+
+class TestCostBalancedPacking:
+    """
+    Test attention-cost-aware ordering of packed bins
+    """
+
+    def test_balance_reduces_rank_imbalance(self):
+        rng = np.random.default_rng(0)
+        bin_costs = rng.lognormal(0.0, 1.0, size=1_000)
+
+        order = balance_bins(bin_costs, bins_per_rank=2, num_ranks=4, rng=rng)
+
+        assert sorted(order) == list(range(1_000))
+        before = rank_imbalance(bin_costs, bins_per_rank=2, num_ranks=4)
+        after = rank_imbalance(bin_costs[order], bins_per_rank=2, num_ranks=4)
+        assert after < before / 10
+
+    def test_cost_model_keeps_explicit_zero_terms(self):
+        assert PackingCostModel.from_terms() == PackingCostModel()
+        cost_model = PackingCostModel.from_terms(linear=0, quadratic=None)
+        assert cost_model == PackingCostModel(linear=0.0, quadratic=0.0)
+        assert cost_model(np.array([3, 4])).tolist() == [0.0, 0.0]
+
+    def test_sampler_balances_bins(self):
+        lengths = np.concatenate(
+            [np.full(200, 2048, dtype=np.int64), np.full(3_200, 128, dtype=np.int64)]
+        )
+        cost_model = PackingCostModel.for_hidden_size(64)
+
+        batch_sampler = MultipackBatchSampler(
+            sampler=RandomSampler(range(len(lengths))),
+            lengths=lengths,
+            batch_size=1,
+            batch_max_len=2048,
+            group_size=None,
+            seed=42,
+            cost_model=cost_model,
+            num_ranks=2,
+        )
+        batches = list(batch_sampler)
+
+        assert sorted(idx for batch in batches for idx in batch[0]) == list(
+            range(len(lengths))
+        )
+        # consecutive batches go to different ranks and should cost the same
+        bin_costs = np.array([cost_model(lengths[batch[0]]).sum() for batch in batches])
+        assert rank_imbalance(bin_costs, bins_per_rank=1, num_ranks=2) == 0.0
+
+    @pytest.mark.parametrize("batch_size", [1, 2])
+    def test_balance_ranks_keeps_every_bin(self, batch_size):
+        from accelerate.data_loader import BatchSamplerShard
+
+        lengths = np.random.default_rng(3).integers(16, 1024, size=1_001)
+
+        def rank_batches(rank):
+            batch_sampler = MultipackBatchSampler(
+                sampler=RandomSampler(range(len(lengths))),
+                lengths=lengths,
+                batch_size=batch_size,
+                batch_max_len=2048,
+                group_size=None,
+                seed=42,
+                num_ranks=3,
+                balance_ranks=True,
+            )
+            assert len(batch_sampler) % 3 == 0
+            shard = BatchSamplerShard(
+                batch_sampler, num_processes=3, process_index=rank, even_batches=False
+            )
+            return list(shard)
+
+        per_rank = [rank_batches(rank) for rank in range(3)]
+
+        assert len({len(batches) for batches in per_rank}) == 1
+        seen = [idx for batches in per_rank for b in batches for p in b for idx in p]
+        assert sorted(seen) == list(range(len(lengths)))
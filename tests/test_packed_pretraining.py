@@ -2,6 +2,7 @@
 import functools
 import unittest
 
+import numpy as np
 import pytest
 import torch
 from datasets import load_dataset
@@ -9,9 +10,40 @@ from torch.utils.data import DataLoader
 from transformers import AutoTokenizer
 
 from axolotl.utils.data import get_dataset_wrapper, wrap_pretraining_dataset
+from axolotl.utils.data.pretraining import OnlineBinPacker
 from axolotl.utils.dict import DictDefault
 
 
+class TestOnlineBinPacker(unittest.TestCase):
+    """
+    Test class for the streaming best-fit bin packer
+    """
+
+    def test_packs_every_row_within_capacity(self):
+        rng = np.random.default_rng(0)
+        lengths = rng.integers(2, 512, size=5_000)
+        packer = OnlineBinPacker(1024, buffer_size=64)
+
+        bins = []
+        for idx, length in enumerate(lengths):
+            bins.extend(packer.add({"idx": idx}, int(length)))
+            assert packer._buffered <= 64  # pylint: disable=protected-access
+        bins.extend(packer.flush())
+
+        packed = sorted(row["idx"] for rows in bins for row in rows)
+        assert packed == list(range(len(lengths)))
+        bin_lengths = [sum(lengths[row["idx"]] for row in rows) for rows in bins]
+        assert max(bin_lengths) <= 1024
+        assert sum(bin_lengths) / (len(bins) * 1024) > 0.95
+
+    def test_emits_full_bins_immediately(self):
+        packer = OnlineBinPacker(10, buffer_size=100, fill_target=1.0)
+        assert not packer.add({"idx": 0}, 6)
+        assert not packer.add({"idx": 1}, 5)
+        assert packer.add({"idx": 2}, 4) == [[{"idx": 0}, {"idx": 2}]]
+        assert packer.flush() == [[{"idx": 1}]]
+
+
 class TestPretrainingPacking(unittest.TestCase):
     """
     Test class for packing streaming dataset sequences
@@ -113,6 +113,46 @@ class TestPromptTokenizationStrategies(unittest.TestCase):
         assert example["labels"][world_idx] == 6324
         assert example["labels"][world_idx - 1] == -100
 
+    def test_alpaca_batched(self):
+        """
+        tests a batch tokenizes the same as each of its rows did one at a time
+        """
+        # pylint: disable=duplicate-code
+        prompter = AlpacaPrompter()
+        strat = AlpacaPromptTokenizingStrategy(
+            prompter,
+            self.tokenizer,
+            False,
+            2048,
+        )
+        samples = [
+            {"instruction": "hello!", "input": "", "output": "Hi! How can I help?"},
+            {"instruction": "add", "input": "2 + 2", "output": "4"},
+            {"instruction": "say nothing", "input": "", "output": ""},
+        ]
+        assert strat.supports_batched
+        batch = strat.tokenize_prompts(
+            {key: [sample[key] for sample in samples] for key in samples[0]}
+        )
+        for idx, sample in enumerate(samples):
+            # what the per-row path tokenized: the user prompt with its BOS, then
+            # the response without BOS and with EOS, each in its own call
+            user_ids = self.tokenizer(
+                next(prompter.build_prompt(sample["instruction"], sample["input"]))
+            )["input_ids"]
+            response_ids = []
+            if sample["output"]:
+                response_ids = self.tokenizer(sample["output"])["input_ids"][1:] + [
+                    self.tokenizer.eos_token_id
+                ]
+            assert batch["input_ids"][idx] == user_ids + response_ids
+            assert batch["attention_mask"][idx] == [1] * len(user_ids + response_ids)
+            assert batch["labels"][idx] == [-100] * len(user_ids) + response_ids
+            # a single row is never mistaken for a batch
+            assert strat.tokenize_prompt(sample) == {
+                key: value[idx] for key, value in batch.items()
+            }
+
 
 class InstructionWSystemPromptTokenizingStrategyTest(unittest.TestCase):
     """
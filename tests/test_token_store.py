@@ -0,0 +1,150 @@
+"""
+Test module for the memory-mapped token store prepared dataset format
+"""
+
+import tempfile
+import unittest
+from pathlib import Path
+
+import numpy as np
+import pytest
+from datasets import Dataset
+
+from axolotl.datasets import SOURCE_COLUMN, TokenStore
+from axolotl.utils.samplers import get_dataset_lengths
+
+
+class TestTokenStore(unittest.TestCase):
+    """
+    Test class for TokenStore
+    """
+
+    dataset: Dataset
+
+    @pytest.fixture(autouse=True)
+    def inject_fixtures(self, tokenized_dataset):
+        self.dataset = tokenized_dataset
+
+    def test_round_trip(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            store = TokenStore.write(
+                self.dataset, Path(tmp_dir) / "store", vocab_size=70_000, batch_size=7
+            )
+            assert store.meta["dtype"] == "uint32"
+            assert len(store) == len(self.dataset)
+            for idx, row in enumerate(store.__getitems__(list(range(len(store))))):
+                expected = self.dataset[idx]
+                for column in TokenStore.COLUMNS:
+                    assert row[column].tolist() == expected[column]
+
+            np.testing.assert_array_equal(
+                get_dataset_lengths(store), self.dataset["length"]
+            )
+            assert store.num_supervised_tokens == sum(
+                sum(label != -100 for label in labels)
+                for labels in self.dataset["labels"]
+            )
+
+    def test_select_and_remove_columns(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            store = TokenStore.write(
+                self.dataset, Path(tmp_dir) / "store", vocab_size=70_000
+            )
+            subset = store.select([4, 2]).remove_columns(["length", "attention_mask"])
+            assert len(subset) == 2
+            assert subset[1]["input_ids"].tolist() == self.dataset[2]["input_ids"]
+            assert "attention_mask" not in subset[0]
+            assert list(subset.features.keys()) == [
+                "input_ids",
+                "labels",
+                "position_ids",
+            ]
+            assert subset.num_tokens == sum(self.dataset.select([4, 2])["length"])
+            # pylint: disable=protected-access
+            assert subset._fingerprint != store._fingerprint
+
+    def test_add_column(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            store = TokenStore.write(
+                self.dataset, Path(tmp_dir) / "store", vocab_size=70_000
+            )
+            with_idx = store.add_column("row_idx", np.arange(len(store)))
+            # pylint: disable=protected-access
+            assert with_idx._fingerprint != store._fingerprint
+            assert with_idx[3]["row_idx"] == 3
+            assert with_idx.features["row_idx"].dtype == "int64"
+
+            subset = with_idx.select([4, 2]).remove_columns(["attention_mask"])
+            assert [row["row_idx"] for row in subset] == [4, 2]
+            assert "row_idx" not in subset.remove_columns("row_idx")[0]
+            with pytest.raises(ValueError, match="one value per row"):
+                store.add_column("row_idx", [0, 1])
+
+    def test_sources(self):
+        sources = np.arange(len(self.dataset)) % 3
+        dataset = self.dataset.add_column(SOURCE_COLUMN, sources)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            store = TokenStore.write(
+                dataset, Path(tmp_dir) / "store", vocab_size=70_000
+            )
+            assert SOURCE_COLUMN not in store.features
+            np.testing.assert_array_equal(store.sources, sources)
+            np.testing.assert_array_equal(store.select([4, 2]).sources, sources[[4, 2]])
+
+            reloaded = TokenStore(Path(tmp_dir) / "store")
+            np.testing.assert_array_equal(reloaded.sources, sources)
+            store = TokenStore.write(
+                self.dataset, Path(tmp_dir) / "plain", vocab_size=70_000
+            )
+            assert store.sources is None
+
+    def test_rejects_other_labels(self):
+        dataset = Dataset.from_list([{"input_ids": [1, 2, 3], "labels": [1, 5, -100]}])
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with pytest.raises(ValueError, match="labels"):
+                TokenStore.write(dataset, Path(tmp_dir) / "store", vocab_size=32_000)
+            assert not any(Path(tmp_dir).iterdir())
+
+    def test_teacher_targets(self):
+        rng = np.random.default_rng(1)
+        rows = []
+        for row in self.dataset.select(range(20)):
+            top_k = int(rng.integers(2, 6))
+            length, padding = len(row["input_ids"]), int(rng.integers(0, 3))
+            logprobs = np.log(rng.dirichlet(np.ones(top_k), length))
+            logprobs[:padding] = -np.inf
+            trained = np.array(row["labels"]) != -100
+            trained[:padding] = False
+            rows.append(
+                {
+                    "input_ids": row["input_ids"],
+                    "labels": row["labels"],
+                    "target_logprobs": logprobs.tolist(),
+                    "target_token_ids": rng.integers(
+                        0, 70_000, (length, top_k)
+                    ).tolist(),
+                    "target_mask": np.repeat(trained[:, None], top_k, 1).tolist(),
+                }
+            )
+        dataset = Dataset.from_list(rows)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            store = TokenStore.write(
+                dataset, Path(tmp_dir) / "store", vocab_size=70_000, batch_size=7
+            )
+            assert store.meta["top_k"] == 5
+            for row, expected in zip(store, rows):
+                top_k = len(expected["target_logprobs"][0])
+                assert row["target_logprobs"].dtype == np.float16
+                np.testing.assert_allclose(
+                    row["target_logprobs"][:, :top_k].astype(np.float32),
+                    expected["target_logprobs"],
+                    rtol=1e-3,
+                )
+                assert (row["target_logprobs"][:, top_k:] == -np.inf).all()
+                assert (
+                    row["target_token_ids"][:, :top_k].tolist()
+                    == expected["target_token_ids"]
+                )
+                assert row["target_mask"][:, :top_k].tolist() == expected["target_mask"]
+                assert not row["target_mask"][:, top_k:].any()